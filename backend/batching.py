@@ -0,0 +1,155 @@
+"""Dynamic micro-batching for the search server.
+
+Concurrent callers ``submit()`` single queries; one background thread gathers
+them into batches (up to ``max_batch_size`` items, waiting at most
+``max_wait_ms`` after the first one arrives) and runs ``batch_fn`` once per
+batch.  ``batch_fn`` takes a list of items and must return a list of results
+in the same order; each result is delivered to its caller's future.
+
+``BoundedExecutor`` is a thread pool with a hard cap on queued + running
+work; ``submit`` raises ``PoolFull`` instead of queueing without limit, so
+the server can shed load with 429 / 503 rather than grow latency.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+
+import metrics
+
+_STOP = object()
+
+
+class MicroBatcher:
+    """Gather concurrent single-item calls into batched ``batch_fn`` calls."""
+
+    def __init__(self, batch_fn: Callable[[List[Any]], List[Any]], max_batch_size: int = 16,
+                 max_wait_ms: float = 5.0, name: str = "micro-batcher"):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be >= 1")
+        self.batch_fn = batch_fn
+        self.name = name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        # counters, read by /metrics style consumers
+        self.batches = 0
+        self.items = 0
+
+        self._queue: "queue.Queue" = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    # ------------------------------------------------------------------
+    #  Public API
+    # ------------------------------------------------------------------
+
+    def submit(self, item: Any) -> Future:
+        """Queue ``item``; the returned future resolves to its result."""
+        if self._closed:
+            raise RuntimeError("MicroBatcher is closed")
+        fut: Future = Future()
+        self._queue.put((item, fut))
+        return fut
+
+    def __call__(self, item: Any, timeout: Optional[float] = None) -> Any:
+        """Blocking convenience wrapper around ``submit``."""
+        return self.submit(item).result(timeout=timeout)
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def mean_batch_size(self) -> float:
+        return self.items / self.batches if self.batches else 0.0
+
+    def close(self, timeout: Optional[float] = None):
+        """Stop accepting work; queued items are still processed."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    # ------------------------------------------------------------------
+    #  Worker loop
+    # ------------------------------------------------------------------
+
+    def _collect(self):
+        """Block for one item, then gather more until the batch is full or the wait expires."""
+        first = self._queue.get()
+        if first is _STOP:
+            return [], True
+
+        batch, stop = [first], False
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                nxt = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if nxt is _STOP:
+                stop = True
+                break
+            batch.append(nxt)
+        return batch, stop
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._collect()
+            # drop callers that gave up before we got to them
+            batch = [(item, fut) for item, fut in batch if fut.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            items = [item for item, _ in batch]
+            try:
+                results = self.batch_fn(items)
+                if len(results) != len(items):
+                    raise RuntimeError(f"batch_fn returned {len(results)} results for {len(items)} items")
+            except Exception as e:
+                for _, fut in batch:
+                    fut.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.items += len(items)
+            metrics.observe_batch(self.name, len(items))
+            for (_, fut), res in zip(batch, results):
+                fut.set_result(res)
+
+
+class PoolFull(RuntimeError):
+    """Raised by ``BoundedExecutor.submit`` when its queue is at capacity."""
+
+
+class BoundedExecutor:
+    """ThreadPoolExecutor admitting at most ``workers + max_queue`` pending calls."""
+
+    def __init__(self, workers: int, max_queue: int, name: str = "pool"):
+        self.workers = workers
+        self.capacity = workers + max_queue
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise PoolFull(f"{self.capacity} calls already pending")
+        try:
+            fut = self._pool.submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        fut.add_done_callback(lambda _: self._slots.release())
+        return fut
+
+    def pending(self) -> int:
+        return self.capacity - self._slots._value
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait)
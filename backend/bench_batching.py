@@ -0,0 +1,91 @@
+"""Compare per-request search against the micro-batched path under concurrency.
+
+    python bench_batching.py --clients 16 --requests 32 --max-batch 16 --max-wait-ms 5
+
+Each client thread issues ``--requests`` image queries back to back, which is
+what the threaded Flask server does per connection.  Reports p50 / p99 latency
+and overall throughput for both paths.
+"""
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from batching import MicroBatcher
+from search import ImageSearcher
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+TEST_IMG_DIR = os.path.join(SCRIPT_DIR, "data", "test_imgs")
+
+
+def load_query_images(n: int):
+    """Use data/test_imgs when available, otherwise random noise images."""
+    imgs = []
+    if os.path.isdir(TEST_IMG_DIR):
+        for fn in sorted(os.listdir(TEST_IMG_DIR)):
+            if fn.lower().endswith((".png", ".jpg", ".jpeg")):
+                imgs.append(Image.open(os.path.join(TEST_IMG_DIR, fn)).convert("RGB"))
+    rng = np.random.default_rng(0)
+    while len(imgs) < n:
+        imgs.append(Image.fromarray(rng.integers(0, 255, (512, 512, 3), dtype=np.uint8)))
+    return imgs[:n]
+
+
+def run_load(fn, imgs, clients: int, requests: int):
+    """Run ``clients`` threads × ``requests`` calls of ``fn``; returns (latencies_ms, wall_s)."""
+    latencies = []
+    lock = threading.Lock()
+
+    def client(cid):
+        local = []
+        for r in range(requests):
+            img = imgs[(cid * requests + r) % len(imgs)]
+            t0 = time.perf_counter()
+            fn(img)
+            local.append((time.perf_counter() - t0) * 1000)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=client, args=(c,)) for c in range(clients)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return np.asarray(latencies), time.perf_counter() - t0
+
+
+def report(name: str, lat: np.ndarray, wall: float):
+    print(f"{name:<12} p50 {np.percentile(lat, 50):8.1f} ms   p99 {np.percentile(lat, 99):8.1f} ms   "
+          f"throughput {len(lat) / wall:7.1f} q/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=32, help="Requests per client")
+    parser.add_argument("--max-batch", type=int, default=16)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    searcher = ImageSearcher(top_k=5)
+    imgs = load_query_images(64)
+
+    # warm-up so neither path pays first-call allocation cost
+    searcher.search_batch(imgs[:args.max_batch])
+
+    lat, wall = run_load(searcher.search, imgs, args.clients, args.requests)
+    report("per-request", lat, wall)
+
+    batcher = MicroBatcher(searcher.search_batch, max_batch_size=args.max_batch, max_wait_ms=args.max_wait_ms)
+    lat, wall = run_load(batcher, imgs, args.clients, args.requests)
+    batcher.close()
+    report("batched", lat, wall)
+    print(f"mean batch size: {batcher.mean_batch_size():.1f}")
+
+
+if __name__ == "__main__":
+    main()
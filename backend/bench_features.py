@@ -0,0 +1,109 @@
+"""Peak memory / throughput of the truncated extractor vs. output_hidden_states.
+
+    python bench_features.py --batch-size 64 --iters 5
+
+Each mode runs in a fresh process.  On CPU the forward pass is measured as
+current RSS (``metrics.rss_bytes``, i.e. /proc/self/statm) sampled while it
+runs, relative to the RSS just before it; ``ru_maxrss`` would also count
+the peak of loading the model.  On CUDA it is peak allocated memory.  Also
+checks that both paths give the same vectors.
+"""
+import argparse
+import multiprocessing as mp
+import threading
+import time
+
+import torch
+from transformers import CLIPModel
+
+import metrics
+from clip_features import StackedVisionEncoder
+
+CLIP_MODEL_ID = "openai/clip-vit-large-patch14"
+RSS_SAMPLE_S = 0.002
+
+
+def _load(device):
+    model = CLIPModel.from_pretrained(CLIP_MODEL_ID).eval().to(device)
+    return StackedVisionEncoder(model.vision_model, model.visual_projection).eval()
+
+
+def _forward_mb(fn, pixels, device):
+    """Run ``fn(pixels)`` once; (peak MB above the memory in use before it, MB still held after it)."""
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        before = torch.cuda.memory_allocated()
+        torch.cuda.reset_peak_memory_stats()
+        fn(pixels)
+        torch.cuda.synchronize()
+        return ((torch.cuda.max_memory_allocated() - before) / 2**20,
+                (torch.cuda.memory_allocated() - before) / 2**20)
+
+    before = peak = metrics.rss_bytes()
+    done = threading.Event()
+
+    def sample():
+        nonlocal peak
+        while not done.wait(RSS_SAMPLE_S):
+            peak = max(peak, metrics.rss_bytes())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        fn(pixels)
+    finally:
+        done.set()
+        sampler.join()
+    after = metrics.rss_bytes()
+    return (max(peak, after) - before) / 2**20, (after - before) / 2**20
+
+
+def _run(mode: str, batch_size: int, iters: int, out):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    encoder = _load(device)
+    fn = encoder if mode == "truncated" else encoder.reference_forward
+    pixels = torch.randn(batch_size, 3, 224, 224, device=device)
+
+    with torch.no_grad():
+        fn(pixels)                                          # warm-up
+        peaks, held = [], []
+        t0 = time.perf_counter()
+        for _ in range(iters):
+            peak, kept = _forward_mb(fn, pixels, device)
+            peaks.append(peak)
+            held.append(kept)
+        elapsed = time.perf_counter() - t0
+    out.put((mode, batch_size * iters / elapsed, max(peaks), max(held)))
+
+
+def check_parity(batch_size: int):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    encoder = _load(device)
+    pixels = torch.randn(batch_size, 3, 224, 224, device=device)
+    with torch.no_grad():
+        a_stack, a_final = encoder(pixels)
+        b_stack, b_final = encoder.reference_forward(pixels)
+    print(f"max |Δ| stacked: {(a_stack - b_stack).abs().max().item():.2e}   "
+          f"final: {(a_final - b_final).abs().max().item():.2e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--iters", type=int, default=5)
+    args = parser.parse_args()
+
+    check_parity(min(args.batch_size, 8))
+
+    ctx = mp.get_context("spawn")
+    out = ctx.Queue()
+    for mode in ("hidden_states", "truncated"):
+        p = ctx.Process(target=_run, args=(mode, args.batch_size, args.iters, out))
+        p.start()
+        name, ips, peak, held = out.get()
+        p.join()
+        print(f"{name:<14} {ips:8.1f} img/s   forward peak +{peak:8.0f} MB   held after +{held:6.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""HTTP load test for the search servers (Flask server.py vs. ASGI server_asgi.py).
+
+    python server.py                                   # or: uvicorn server_asgi:app --port 5001
+    python bench_load.py --url http://localhost:5001 --concurrency 32 --requests 2000
+
+Each of ``--concurrency`` async clients posts ``/api/search`` queries back to
+back (image uploads by default, ``--mode embedding`` for 1536-d vectors,
+``--mode url --image-url ...`` for URL fetches).  Reports throughput,
+p50 / p95 / p99 latency and the status-code mix, so shed load (429 / 503)
+shows up instead of hiding in latency.  ``--json`` appends one result line
+to a file for comparing runs.
+"""
+import argparse
+import asyncio
+import collections
+import io
+import json
+import os
+import time
+
+import httpx
+import numpy as np
+from PIL import Image
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+TEST_IMG_DIR = os.path.join(SCRIPT_DIR, "data", "test_imgs")
+
+
+def query_payloads(n: int):
+    """PNG bytes from data/test_imgs, padded with noise images."""
+    out = []
+    if os.path.isdir(TEST_IMG_DIR):
+        for fn in sorted(os.listdir(TEST_IMG_DIR)):
+            if fn.lower().endswith((".png", ".jpg", ".jpeg")):
+                with open(os.path.join(TEST_IMG_DIR, fn), "rb") as fp:
+                    out.append((fn, fp.read()))
+    rng = np.random.default_rng(0)
+    while len(out) < n:
+        buf = io.BytesIO()
+        Image.fromarray(rng.integers(0, 255, (512, 512, 3), dtype=np.uint8)).save(buf, format="PNG")
+        out.append((f"noise-{len(out)}.png", buf.getvalue()))
+    return out[:n]
+
+
+def make_request(args, i: int, images, embeddings):
+    if args.mode == "embedding":
+        return {"json": {"embedding": embeddings[i % len(embeddings)].tolist()}}
+    if args.mode == "url":
+        return {"json": {"image_url": args.image_url}}
+    name, data = images[i % len(images)]
+    return {"files": {"image": (name, data, "application/octet-stream")}}
+
+
+async def client(http, args, counter, images, embeddings, latencies, statuses):
+    while True:
+        i = next(counter)
+        if i >= args.requests:
+            return
+        t0 = time.perf_counter()
+        try:
+            resp = await http.post(args.url.rstrip("/") + "/api/search", **make_request(args, i, images, embeddings))
+            statuses[resp.status_code] += 1
+        except httpx.HTTPError as e:
+            statuses[type(e).__name__] += 1
+            continue
+        latencies.append((time.perf_counter() - t0) * 1000)
+
+
+async def run(args):
+    images = query_payloads(args.distinct) if args.mode == "image" else []
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((args.distinct, 1536)).astype(np.float32)
+    latencies, statuses = [], collections.Counter()
+    counter = iter(range(args.requests + args.concurrency))
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as http:
+        t0 = time.perf_counter()
+        await asyncio.gather(*(client(http, args, counter, images, embeddings, latencies, statuses)
+                               for _ in range(args.concurrency)))
+        wall = time.perf_counter() - t0
+
+    ok = statuses.get(200, 0)
+    lat = np.asarray(latencies) if latencies else np.zeros(1)
+    result = {
+        "url": args.url, "mode": args.mode, "concurrency": args.concurrency, "requests": args.requests,
+        "ok_per_s": ok / wall, "p50_ms": float(np.percentile(lat, 50)), "p95_ms": float(np.percentile(lat, 95)),
+        "p99_ms": float(np.percentile(lat, 99)), "statuses": {str(k): v for k, v in sorted(statuses.items(), key=str)},
+    }
+    print(f"{args.mode} × {args.requests} @ {args.concurrency} clients → {args.url}")
+    print(f"   200 OK/s : {result['ok_per_s']:8.1f}")
+    print(f"   latency  : p50 {result['p50_ms']:7.1f} ms   p95 {result['p95_ms']:7.1f} ms   p99 {result['p99_ms']:7.1f} ms")
+    print(f"   statuses : {result['statuses']}")
+    if args.json:
+        with open(args.json, "a", encoding="utf-8") as fp:
+            fp.write(json.dumps(result) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5001")
+    parser.add_argument("--mode", choices=("image", "embedding", "url"), default="image")
+    parser.add_argument("--image-url", help="Image URL for --mode url")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--distinct", type=int, default=64,
+                        help="Distinct queries cycled through (keep above the cache size to measure misses)")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--json", help="Append the result as one JSON line to this file")
+    args = parser.parse_args()
+    if args.mode == "url" and not args.image_url:
+        parser.error("--mode url needs --image-url")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+"""Build + search benchmark and recall regression suite on synthetic corpora (CPU).
+
+    python bench_suite.py --sizes 10k --index-types flat hnsw ivf_pq --out bench.json
+    python bench_suite.py --sizes 10k 1m --baseline bench.json          # exit 1 on regressions
+
+Corpora are normalised random or clustered float32 vectors (10k, 1m, 10m
+rows, cached under data/bench/ as .npy so 10m is generated once).  For
+each corpus × index type, in a fresh process so peak RSS is per case:
+
+  build   decode, preprocess (synthetic JPEGs through preprocess.py),
+          embed (``--clip`` only), index train + add, index write
+  search  decode, embed (``--clip`` only), search (single-query latency
+          and batched QPS, recall@k vs an exact scan), format (metadata
+          rows through ``ImageSearcher._format_results``)
+
+Every stage reports QPS and p50 / p99 latency where they apply; results go
+to ``--out`` as JSON.  With ``--baseline`` each metric is compared to the
+same case in an earlier result file and the run fails when one regresses
+past its threshold (``--max-slowdown``, ``--max-recall-drop``,
+``--max-rss-growth``).  A case whose process dies (e.g. OOM-killed) or runs
+past ``--case-timeout`` is recorded as failed and the suite moves on.
+"""
+import argparse
+import io
+import json
+import multiprocessing as mp
+import os
+import platform
+import queue
+import resource
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_DIR = os.path.join(SCRIPT_DIR, "data", "bench")
+
+SIZES = {"10k": 10_000, "1m": 1_000_000, "10m": 10_000_000}
+CORPUS_KINDS = ("random", "clustered")
+N_CLUSTERS = 1024
+CLUSTER_NOISE = 0.35
+GEN_CHUNK = 262_144                  # rows generated / written per step
+
+BENCH_IMAGES = 64                    # synthetic JPEGs for decode / preprocess
+BENCH_IMAGE_SIZE = (768, 768)
+LATENCY_QUERIES = 200                # single-query calls timed per stage
+BATCH_QUERIES = 1000                 # queries of the batched QPS / recall run
+FORMAT_METADATA_ROWS = 100_000       # metadata rows behind the format stage
+CASE_POLL_S = 5                      # how often a waiting parent checks the case process is alive
+
+# metric name suffix → direction; anything else is informational
+LOWER_IS_BETTER = ("_ms", "_s", "_mb")
+HIGHER_IS_BETTER = ("_qps", "_per_s")
+
+
+# ------------------------------------------------------------------
+#  Synthetic data
+# ------------------------------------------------------------------
+
+def _normalise(x: np.ndarray) -> np.ndarray:
+    return x / (np.linalg.norm(x, axis=1, keepdims=True) + 1e-8)
+
+
+def corpus_path(size: str, kind: str, dim: int) -> str:
+    return os.path.join(BENCH_DIR, f"corpus-{kind}-{size}-{dim}d.npy")
+
+
+def make_corpus(size: str, kind: str, dim: int, seed: int = 0) -> np.ndarray:
+    """Memory-mapped (n, dim) corpus of L2-normalised vectors, generated in chunks on first use."""
+    path = corpus_path(size, kind, dim)
+    n = SIZES[size]
+    if not os.path.exists(path):
+        os.makedirs(BENCH_DIR, exist_ok=True)
+        rng = np.random.default_rng(seed)
+        centres = _normalise(rng.standard_normal((N_CLUSTERS, dim), dtype=np.float32))
+        tmp = path + ".tmp"
+        out = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=(n, dim))
+        for start in range(0, n, GEN_CHUNK):
+            m = min(GEN_CHUNK, n - start)
+            noise = rng.standard_normal((m, dim), dtype=np.float32)
+            if kind == "clustered":
+                noise = centres[rng.integers(0, N_CLUSTERS, m)] + CLUSTER_NOISE * noise / np.sqrt(dim)
+            out[start:start + m] = _normalise(noise)
+        out.flush()
+        del out
+        os.replace(tmp, path)
+    return np.load(path, mmap_mode="r")
+
+
+def make_queries(corpus: np.ndarray, n: int, seed: int = 1) -> np.ndarray:
+    """Perturbed corpus rows, so queries have near (not exact) neighbours as real ones do."""
+    rng = np.random.default_rng(seed)
+    rows = np.asarray(corpus[np.sort(rng.choice(len(corpus), n, replace=False))], dtype=np.float32)
+    return np.ascontiguousarray(_normalise(rows + 0.05 * rng.standard_normal(rows.shape, dtype=np.float32)))
+
+
+def make_jpegs(n: int, size=BENCH_IMAGE_SIZE, seed: int = 2) -> List[bytes]:
+    """Smooth random JPEGs (noise compresses unrealistically badly)."""
+    from PIL import Image
+    rng = np.random.default_rng(seed)
+    out = []
+    for _ in range(n):
+        small = rng.integers(0, 255, (size[1] // 32, size[0] // 32, 3), dtype=np.uint8)
+        img = Image.fromarray(small).resize(size, Image.BILINEAR)
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=90)
+        out.append(buf.getvalue())
+    return out
+
+
+def synthetic_metadata(n: int, seed: int = 3):
+    rng = np.random.default_rng(seed)
+    samplers = ["k_euler_a", "k_euler", "k_lms", "ddim", "plms"]
+    for i in range(n):
+        yield {"image_name": f"{i:08}.png", "prompt": f"synthetic prompt {i % 9973}",
+               "seed": int(rng.integers(2**31)), "cfg": 7.5, "steps": 30, "sampler": samplers[i % len(samplers)]}
+
+
+# ------------------------------------------------------------------
+#  Measurement helpers
+# ------------------------------------------------------------------
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10     # bytes on macOS, KiB on Linux
+
+
+def time_calls(fn: Callable, items, warmup: int = 2) -> Dict[str, float]:
+    """Per-call latency p50 / p99 (ms) and sequential QPS of ``fn`` over ``items``."""
+    items = list(items)
+    for item in items[:warmup]:
+        fn(item)
+    lat = []
+    t0 = time.perf_counter()
+    for item in items:
+        t = time.perf_counter()
+        fn(item)
+        lat.append((time.perf_counter() - t) * 1000)
+    wall = time.perf_counter() - t0
+    return {"p50_ms": float(np.percentile(lat, 50)), "p99_ms": float(np.percentile(lat, 99)),
+            "calls_qps": len(lat) / wall}
+
+
+def recall(ground_truth: np.ndarray, approx: np.ndarray) -> float:
+    return sum(len(np.intersect1d(g, a)) for g, a in zip(ground_truth, approx)) / float(ground_truth.size)
+
+
+# ------------------------------------------------------------------
+#  One case (runs in its own process)
+# ------------------------------------------------------------------
+
+def _clip_encoder():
+    import torch
+    from transformers import CLIPVisionModelWithProjection
+    from inference_backends import load_backend
+    model = CLIPVisionModelWithProjection.from_pretrained("openai/clip-vit-large-patch14").eval()
+    return torch, load_backend(model, "fp32", torch.device("cpu"))
+
+
+def run_case(size: str, kind: str, index_type: str, args) -> Dict:
+    import faiss
+    from index_factory import exact_knn, make_index, train_index, apply_search_params, read_index
+    from metadata_store import MetadataStore, write_metadata_store
+    from preprocess import open_image, to_pixel_values
+    from search import ImageSearcher
+
+    stages: Dict[str, Dict[str, float]] = {}
+    corpus = make_corpus(size, kind, args.dim)
+    n, d = corpus.shape
+    jpegs = make_jpegs(BENCH_IMAGES)
+
+    # ---- build: decode → preprocess → embed ----
+    stages["build/decode"] = time_calls(open_image, jpegs)
+    imgs = [open_image(b) for b in jpegs]
+    batch = args.batch_size
+    t0 = time.perf_counter()
+    pixels = [to_pixel_values(imgs[i:i + batch]) for i in range(0, len(imgs), batch)]
+    stages["build/preprocess"] = {"images_per_s": len(imgs) / (time.perf_counter() - t0),
+                                  **time_calls(lambda img: to_pixel_values([img]), imgs)}
+    encode = None
+    if args.clip:
+        torch, encode = _clip_encoder()
+        t0 = time.perf_counter()
+        for px in pixels:
+            encode(torch.from_numpy(px))
+        stages["build/embed"] = {"images_per_s": len(imgs) / (time.perf_counter() - t0)}
+
+    # ---- build: index train + add → write ----
+    index = make_index(index_type, d, n, nlist=args.nlist)
+    t0 = time.perf_counter()
+    train_index(index, corpus, args.train_size)
+    t_train = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for start in range(0, n, GEN_CHUNK):
+        index.add(np.ascontiguousarray(corpus[start:start + GEN_CHUNK]))
+    t_add = time.perf_counter() - t0
+    apply_search_params(index, nprobe=args.nprobe, ef_search=args.ef_search)
+    stages["build/index_add"] = {"train_s": t_train, "add_s": t_add, "add_vectors_per_s": n / max(t_add, 1e-9)}
+
+    with tempfile.TemporaryDirectory(dir=BENCH_DIR) as tmp:
+        path = os.path.join(tmp, "index.faiss")
+        t0 = time.perf_counter()
+        faiss.write_index(index, path)
+        t_write = time.perf_counter() - t0
+        size_mb = os.path.getsize(path) / 2**20
+        stages["build/write"] = {"write_s": t_write, "index_size_mb": size_mb, "write_mb_per_s": size_mb / max(t_write, 1e-9)}
+
+        # ---- search: decode → embed → search → format ----
+        stages["search/decode"] = time_calls(open_image, jpegs)
+        if encode is not None:
+            stages["search/embed"] = time_calls(lambda img: encode(torch.from_numpy(to_pixel_values([img]))),
+                                                imgs[:16])
+
+        queries = make_queries(corpus, BATCH_QUERIES)
+        served = read_index(path, mmap=True)
+        apply_search_params(served, nprobe=args.nprobe, ef_search=args.ef_search)
+        k = args.k
+        single = time_calls(lambda q: served.search(q[None, :], k), queries[:LATENCY_QUERIES])
+        t0 = time.perf_counter()
+        _, approx = served.search(queries, k)
+        batch_qps = len(queries) / (time.perf_counter() - t0)
+        _, truth = exact_knn(corpus, queries, k)
+        stages["search/search"] = {**single, "batch_qps": batch_qps, f"recall@{k}": recall(truth, approx)}
+
+        meta_dir = os.path.join(tmp, "metadata")
+        rows = min(n, FORMAT_METADATA_ROWS)
+        write_metadata_store(meta_dir, list(synthetic_metadata(rows)))
+        bundle = SimpleNamespace(metadata=MetadataStore(meta_dir))
+        d_hits, i_hits = served.search(queries[:LATENCY_QUERIES], k)
+        hits = [(dq, iq % rows) for dq, iq in zip(d_hits, i_hits)]
+        stages["search/format"] = time_calls(lambda h: ImageSearcher._format_results(bundle, *h), hits)
+
+    return {"corpus": f"{kind}-{size}", "rows": n, "dim": d, "index_type": index_type,
+            "peak_rss_mb": peak_rss_mb(), "stages": stages}
+
+
+def _case_worker(size, kind, index_type, args, out):
+    try:
+        out.put(run_case(size, kind, index_type, args))
+    except Exception as e:
+        out.put({"corpus": f"{kind}-{size}", "index_type": index_type, "error": f"{type(e).__name__}: {e}"})
+
+
+def wait_case(proc, out, size, kind, index_type, timeout: float = 0) -> Dict:
+    """The case ``proc`` reports on ``out``, or an error case if it dies first or runs past ``timeout`` s.
+
+    A worker killed by the OOM killer or a crash in native code never
+    reaches its ``except``, so the parent must not block on the queue alone.
+    """
+    def failed(msg):
+        return {"corpus": f"{kind}-{size}", "index_type": index_type, "error": msg}
+
+    deadline = time.monotonic() + timeout if timeout else None
+    while True:
+        try:
+            return out.get(timeout=CASE_POLL_S)
+        except queue.Empty:
+            pass
+        if proc.exitcode is not None:
+            try:
+                return out.get(timeout=1)                # reported just before exiting
+            except queue.Empty:
+                how = f"killed by signal {-proc.exitcode}" if proc.exitcode < 0 else f"exit code {proc.exitcode}"
+                return failed(f"case process died without a result ({how})")
+        if deadline is not None and time.monotonic() > deadline:
+            proc.terminate()
+            proc.join()
+            return failed(f"timed out after {timeout:.0f} s")
+
+
+# ------------------------------------------------------------------
+#  Regression check
+# ------------------------------------------------------------------
+
+def case_key(case: Dict) -> str:
+    return f"{case['corpus']}/{case['index_type']}"
+
+
+def flatten(case: Dict) -> Dict[str, float]:
+    flat = {"peak_rss_mb": case["peak_rss_mb"]}
+    for stage, metrics in case["stages"].items():
+        for name, value in metrics.items():
+            flat[f"{stage}.{name}"] = value
+    return flat
+
+
+def regressions(current: Dict, baseline: Dict, args) -> List[str]:
+    """Metrics of ``current`` worse than ``baseline`` by more than the thresholds."""
+    base_cases = {case_key(c): c for c in baseline["cases"] if "error" not in c}
+    failures = []
+    for case in current["cases"]:
+        if "error" in case or case_key(case) not in base_cases:
+            continue
+        now, then = flatten(case), flatten(base_cases[case_key(case)])
+        for name, value in now.items():
+            old = then.get(name)
+            if old is None or old == 0:
+                continue
+            metric = name.rsplit(".", 1)[-1]
+            if metric.startswith("recall@"):
+                bad = old - value > args.max_recall_drop
+            elif metric == "peak_rss_mb":
+                bad = value > old * (1 + args.max_rss_growth)
+            elif metric.endswith(HIGHER_IS_BETTER):         # before LOWER: "_per_s" ends in "_s"
+                bad = value < old / (1 + args.max_slowdown)
+            elif metric.endswith(LOWER_IS_BETTER):
+                bad = value > old * (1 + args.max_slowdown)
+            else:
+                continue
+            if bad:
+                failures.append(f"{case_key(case)} {name}: {old:.4g} → {value:.4g}")
+    return failures
+
+
+# ------------------------------------------------------------------
+#  CLI
+# ------------------------------------------------------------------
+
+def print_case(case: Dict):
+    if "error" in case:
+        print(f"❌ {case_key(case)}: {case['error']}")
+        return
+    print(f"\n=== {case_key(case)}  ({case['rows']:,} × {case['dim']}, peak RSS {case['peak_rss_mb']:.0f} MB)")
+    for stage, metrics in case["stages"].items():
+        print(f"   {stage:<18} " + "  ".join(f"{k} {v:.4g}" for k, v in metrics.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", choices=SIZES, default=["10k"])
+    parser.add_argument("--kinds", nargs="+", choices=CORPUS_KINDS, default=["clustered"])
+    parser.add_argument("--index-types", nargs="+", default=["flat"], help="See index_factory.INDEX_TYPES")
+    parser.add_argument("--dim", type=int, default=768, help="768 = final-layer, 1536 = stacked vectors")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--ef-search", type=int, default=64)
+    parser.add_argument("--train-size", type=int, default=200_000)
+    parser.add_argument("--batch-size", type=int, default=16, help="Images per preprocess / embed batch")
+    parser.add_argument("--clip", action="store_true", help="Also time CLIP embedding (loads the model)")
+    parser.add_argument("--out", default=None, help="Write results as JSON")
+    parser.add_argument("--baseline", default=None, help="Earlier --out file to compare against")
+    parser.add_argument("--max-slowdown", type=float, default=0.20, help="Allowed latency / throughput regression")
+    parser.add_argument("--max-recall-drop", type=float, default=0.01, help="Allowed absolute recall@k drop")
+    parser.add_argument("--max-rss-growth", type=float, default=0.25, help="Allowed peak RSS growth")
+    parser.add_argument("--case-timeout", type=float, default=0, help="Seconds per corpus × index case (0 = none)")
+    args = parser.parse_args()
+
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "args": {k: v for k, v in vars(args).items() if k not in ("out", "baseline")},
+        "cases": [],
+    }
+    ctx = mp.get_context("spawn")
+    for size in args.sizes:
+        for kind in args.kinds:
+            make_corpus(size, kind, args.dim)                    # generate once, outside the timed processes
+            for index_type in args.index_types:
+                out = ctx.Queue()
+                p = ctx.Process(target=_case_worker, args=(size, kind, index_type, args, out))
+                p.start()
+                case = wait_case(p, out, size, kind, index_type, args.case_timeout)
+                p.join()
+                print_case(case)
+                results["cases"].append(case)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fp:
+            json.dump(results, fp, indent=2)
+        print(f"\n📝 Results written to {args.out}")
+
+    failed = any("error" in c for c in results["cases"])
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as fp:
+            baseline = json.load(fp)
+        bad = regressions(results, baseline, args)
+        for line in bad:
+            print(f"❌ regression  {line}")
+        if not bad:
+            print(f"✅ no regressions vs {args.baseline}")
+        failed = failed or bool(bad)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,53 @@
 import os
-import pickle
 import gc
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
+import time
 
 import faiss
 import numpy as np
 import torch
-from PIL import Image
 from tqdm import tqdm
 from transformers import CLIPModel, CLIPProcessor
-import json
+import argparse
+import itertools
+from typing import Iterable
+
+from index_factory import (INDEX_TYPES, DEFAULT_NPROBE, DEFAULT_EF_SEARCH, DEFAULT_HNSW_M,
+                           make_index, train_index, apply_search_params, index_kind,
+                           save_params, recall_at_k)
+from embedding_store import EmbeddingStore
+from metadata_ingest import MetadataTable, ingest
+from data_loader import BatchLoader
+from metadata_store import write_metadata_store, write_prompt_groups, normalise_prompt
+from clip_features import StackedVisionEncoder
+from filter_index import write_filter_index
+from preprocess import open_image, to_pixel_values
+import rerank
+import shards
+from index_bundle import new_version_dir, publish, prune_versions
 
 # === CONFIGURATION ===
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 IMAGES_DIR = os.path.join(SCRIPT_DIR, "data", "images")
 SAVE_DIR = os.path.join(SCRIPT_DIR, "data", "embedded_subset")
+STORE_DIR = os.path.join(SCRIPT_DIR, "data", "embedding_store")
+METADATA_DB = os.path.join(SCRIPT_DIR, "data", "metadata.sqlite")
 CACHE_DIR = os.environ.get("HF_CACHE", "E:/ml_cache/huggingface")
 
 BATCH_SIZE = 64                      # plenty of VRAM head‑room
 CLIP_MODEL_ID = "openai/clip-vit-large-patch14"
 CLIP_DIM_FINAL = 768                 # native dim from projection layer
 CLIP_DIM_COMBINED = CLIP_DIM_FINAL * 2  # stacked mid-layer + final-layer
-MAX_WORKERS = 8
+MAX_WORKERS = 8                      # decode / preprocess worker processes
+PREFETCH_BATCHES = 4                 # batches preprocessed ahead of the model
 MAX_PROMPT_TOKENS = 77               # CLIP text encoder hard limit
+CHECKPOINT_EVERY = 4096              # images per embedding-store shard
+ADD_CHUNK = CHECKPOINT_EVERY         # rows read from the store per index.add
+
+INDEX_TYPE = "flat"                  # see index_factory.INDEX_TYPES
+TRAIN_SIZE = 200_000                 # max vectors sampled for IVF / PQ training
+RECALL_K = 10
+RECALL_QUERIES = 1000
 
 os.makedirs(SAVE_DIR, exist_ok=True)
 os.makedirs(CACHE_DIR, exist_ok=True)
@@ -36,17 +60,33 @@ os.environ["HF_DATASETS_CACHE"] = os.path.join(CACHE_DIR, "datasets")
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print(f"Running on {DEVICE}")
 
-# === LOAD CLIP ===
-print(f"Loading {CLIP_MODEL_ID} …")
-model: CLIPModel = CLIPModel.from_pretrained(CLIP_MODEL_ID, cache_dir=CACHE_DIR)
-model.eval().to(DEVICE)
-processor = CLIPProcessor.from_pretrained(CLIP_MODEL_ID, cache_dir=CACHE_DIR)
-print("Model loaded ✅")
+# === CLIP (loaded on first use, so assembling from the store needs no model) ===
+model: CLIPModel = None
+processor: CLIPProcessor = None
+vision_encoder: StackedVisionEncoder = None
+
+# image vectors keyed by file name; text vectors keyed by normalised prompt,
+# so a prompt shared by many seeds is embedded once
+IMAGE_STORE_ARRAYS = {"stacked": CLIP_DIM_COMBINED, "final": CLIP_DIM_FINAL}
+PROMPT_STORE_ARRAYS = {"text": CLIP_DIM_FINAL}
+TEXT_BATCH_SIZE = 256
 
 # ------------------------------------------------------------
 #  HELPER FUNCTIONS
 # ------------------------------------------------------------
 
+def load_clip():
+    global model, processor, vision_encoder
+    if model is not None:
+        return
+    print(f"Loading {CLIP_MODEL_ID} …")
+    model = CLIPModel.from_pretrained(CLIP_MODEL_ID, cache_dir=CACHE_DIR)
+    model.eval().to(DEVICE)
+    processor = CLIPProcessor.from_pretrained(CLIP_MODEL_ID, cache_dir=CACHE_DIR)
+    vision_encoder = StackedVisionEncoder(model.vision_model, model.visual_projection).eval()
+    print("Model loaded ✅")
+
+
 def clear_gpu():
     """Aggressively free GPU memory."""
     if torch.cuda.is_available():
@@ -55,37 +95,23 @@ def clear_gpu():
 
 
 def _extract_stacked_features(pixel_values: torch.Tensor):
-    """Return stacked (final ‖ mid) CLIP visual embeddings, *L2‑normalised*."""
-    vision_out = model.vision_model(pixel_values=pixel_values, output_hidden_states=True, return_dict=True)
-
-    # CLS token from final & mid transformer block
-    cls_final = vision_out.last_hidden_state[:, 0, :]
-    hidden_states = vision_out.hidden_states
-    mid_idx = len(hidden_states) // 2
-    cls_mid = hidden_states[mid_idx][:, 0, :]
-
-    # layernorm + projection identical to forward() logic
-    cls_final = model.vision_model.post_layernorm(cls_final)
-    cls_mid = model.vision_model.post_layernorm(cls_mid)
+    """Return stacked (final ‖ mid) CLIP visual embeddings, *L2‑normalised*.
 
-    proj_final = model.visual_projection(cls_final)
-    proj_mid = model.visual_projection(cls_mid)
+    Same extractor as search.ImageSearcher, so build and query vectors match.
+    """
+    return vision_encoder(pixel_values)
 
-    stacked = torch.cat([proj_final, proj_mid], dim=-1)
 
-    # L2‑normalise
-    stacked = stacked / stacked.norm(dim=-1, keepdim=True)
-    proj_final = proj_final / proj_final.norm(dim=-1, keepdim=True)
-
-    return stacked, proj_final
+def get_pixel_embeddings(pixel_values: torch.Tensor):
+    """Compute (stacked, final) embeddings for preprocessed CLIP pixel values."""
+    with torch.no_grad():
+        stacked, final_only = _extract_stacked_features(pixel_values.to(DEVICE, non_blocking=True))
+    return stacked.cpu().numpy(), final_only.cpu().numpy()
 
 
 def get_image_embeddings(img_list):
     """Compute (stacked, final) embeddings for a list of PIL images."""
-    inputs = processor(images=img_list, return_tensors="pt", padding=True).to(DEVICE)
-    with torch.no_grad():
-        stacked, final_only = _extract_stacked_features(inputs["pixel_values"].to(DEVICE))
-    return stacked.cpu().numpy(), final_only.cpu().numpy()
+    return get_pixel_embeddings(torch.from_numpy(to_pixel_values(img_list)))
 
 
 def get_text_embeddings(prompt_list):
@@ -106,88 +132,278 @@ def get_text_embeddings(prompt_list):
 
 def load_image(path: str):
     try:
-        return Image.open(path).convert("RGB")
+        return open_image(path)
     except Exception:
         return None
 
 
-def load_metadata() -> dict:
-    """Concatenate all *.json files into a single dict keyed by image filename."""
-    meta = {}
-    json_files = [f for f in os.listdir(IMAGES_DIR) if f.endswith(".json")]
-    for jf in tqdm(json_files, desc="Loading JSON metadata"):
-        with open(os.path.join(IMAGES_DIR, jf), "r", encoding="utf-8") as fp:
-            meta.update(json.load(fp))
-    return meta
-
-# ------------------------------------------------------------
-#  MAIN PIPELINE
-# ------------------------------------------------------------
-
-def main():
-    start = datetime.now()
-    clear_gpu()
-
-    meta_all = load_metadata()
-    print(f"Loaded metadata for {len(meta_all):,} images")
-
-    image_files = [f for f in os.listdir(IMAGES_DIR) if f.lower().endswith((".png", ".jpg", ".jpeg"))]
-    print(f"Found {len(image_files):,} image files")
-
-    # two FAISS indexes: images (1536‑d) and prompts (768‑d)
-    index_img = faiss.IndexFlatIP(CLIP_DIM_COMBINED)
-    index_txt = faiss.IndexFlatIP(CLIP_DIM_FINAL)
-    metadata = []
-
-    with tqdm(total=len(image_files), desc="Embedding images") as pbar:
-        for i in range(0, len(image_files), BATCH_SIZE):
-            batch_files = image_files[i : i + BATCH_SIZE]
-            # parallel load
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
-                imgs = list(ex.map(lambda fn: load_image(os.path.join(IMAGES_DIR, fn)), batch_files))
-
-            valid_imgs, valid_meta = [], []
-            for fn, img in zip(batch_files, imgs):
-                if img is None:
-                    continue
-                md = meta_all.get(fn, {})
-                valid_imgs.append(img)
-                valid_meta.append({
-                    "image_name": fn,
-                    "prompt": md.get("p", ""),
-                    "seed": md.get("se"),
-                    "cfg": md.get("c", 7.5),
-                    "steps": md.get("st", 30),
-                    "sampler": md.get("sa", "unknown"),
-                })
-
-            if not valid_imgs:
-                pbar.update(len(batch_files))
+def add_in_chunks(index: faiss.Index, vectors, chunk: int = ADD_CHUNK):
+    """``index.add`` ``chunk`` rows at a time, so only one chunk is in memory."""
+    for start in range(0, vectors.shape[0], chunk):
+        index.add(np.ascontiguousarray(vectors[start:start + chunk], dtype=np.float32))
+
+
+def write_vectors(path: str, vectors, chunk: int = ADD_CHUNK):
+    """Stream ``vectors`` into a float32 .npy file without holding them all."""
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=vectors.shape)
+    for start in range(0, vectors.shape[0], chunk):
+        out[start:start + chunk] = np.asarray(vectors[start:start + chunk], dtype=np.float32)
+    out.flush()
+    del out
+
+
+def build_index(name: str, vectors, args, index_type: str = None):
+    """Build, train, fill and recall-check one index; returns (index, params).
+
+    ``vectors`` is an (n, d) array or a lazy ``EmbeddingStore.rows`` view:
+    training reads a sample of at most ``--train-size`` rows and the index is
+    filled ADD_CHUNK rows at a time.
+    """
+    index_type = index_type or args.index_type
+    n, d = vectors.shape
+    print(f"\n🔧 Building {name} ({index_type}, {n:,} × {d})")
+    index = make_index(index_type, d, n, nlist=args.nlist, pq_m=args.pq_m, hnsw_m=args.hnsw_m)
+    train_index(index, vectors, args.train_size)
+    add_in_chunks(index, vectors)
+    applied = apply_search_params(index, nprobe=args.nprobe, ef_search=args.ef_search)
+
+    recall = recall_at_k(index, vectors, k=RECALL_K, n_queries=RECALL_QUERIES)
+    print(f"   recall@{RECALL_K} vs flat : {recall:.4f}")
+    params = {"type": index_type, "kind": index_kind(index), **applied, f"recall@{RECALL_K}": round(recall, 4)}
+    return index, params
+
+
+def save_index(name: str, vectors, args, out_dir: str, layout: dict, index_type: str = None):
+    """Build ``name`` and write it to ``out_dir`` – whole, or as ``args.shards`` shards recorded in ``layout``.
+
+    Returns (index, params); the index is None when sharded.
+    """
+    if args.shards <= 1:
+        index, params = build_index(name, vectors, args, index_type)
+        faiss.write_index(index, os.path.join(out_dir, f"{name}.faiss"))
+        return index, params
+    params, layout[name] = shards.save_sharded(out_dir, name, vectors, args.shards,
+                                               lambda label, part: build_index(label, part, args, index_type))
+    return None, params
+
+
+def fingerprint(fn: str) -> str:
+    """Changes whenever the image file changes."""
+    st = os.stat(os.path.join(IMAGES_DIR, fn))
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+
+def embed_missing_images(store: EmbeddingStore, image_files: Iterable[str]):
+    """Embed every image whose fingerprint is not already in ``store``, checkpointing as we go.
+
+    ``image_files`` is consumed lazily (in part order from the metadata
+    table), so only the loader's prefetch window is held in memory.
+    """
+    counts = {"current": 0, "todo": 0}
+
+    def todo():
+        for fn in image_files:
+            if store.is_current(fn, fingerprint(fn)):
+                counts["current"] += 1
+            else:
+                counts["todo"] += 1
+                yield os.path.join(IMAGES_DIR, fn)
+
+    paths = todo()
+    first = next(paths, None)
+    if first is None:
+        print(f"{counts['current']:,} images already embedded, 0 to go")
+        return
+    paths = itertools.chain([first], paths)
+
+    load_clip()
+    pending = {"keys": [], "fps": [], "stacked": [], "final": []}
+
+    def flush():
+        if not pending["keys"]:
+            return
+        store.append(pending["keys"], pending["fps"],
+                     {name: np.vstack(pending[name]) for name in IMAGE_STORE_ARRAYS})
+        for v in pending.values():
+            v.clear()
+
+    embed_s = 0.0
+    loader = BatchLoader(paths, BATCH_SIZE, MAX_WORKERS, CLIP_MODEL_ID, cache_dir=CACHE_DIR,
+                         prefetch=PREFETCH_BATCHES, pin_memory=DEVICE.type == "cuda")
+    with loader, tqdm(desc="Embedding images", unit="img") as pbar:
+        for batch in loader:
+            if not batch.indices:
+                pbar.update(batch.n_requested)
                 continue
+            valid = [os.path.basename(p) for p in batch.paths]
 
             # ---- embeddings ----
-            emb_stacked, emb_final = get_image_embeddings(valid_imgs)
-            prompt_list = [m["prompt"] for m in valid_meta]
-            emb_text = get_text_embeddings(prompt_list)
-
-            # ---- add to indexes ----
-            index_img.add(emb_stacked)
-            index_txt.add(emb_text)
-            metadata.extend(valid_meta)
-            pbar.update(len(valid_meta))
+            t0 = time.perf_counter()
+            emb_stacked, emb_final = get_pixel_embeddings(batch.pixel_values)
+            embed_s += time.perf_counter() - t0
+
+            pending["keys"].extend(valid)
+            pending["fps"].extend(fingerprint(fn) for fn in valid)
+            pending["stacked"].append(emb_stacked)
+            pending["final"].append(emb_final)
+            if len(pending["keys"]) >= CHECKPOINT_EVERY:
+                flush()
+            pbar.update(batch.n_requested)
 
             clear_gpu()
+        flush()
+        loader.report({"image embed": embed_s})
+    print(f"{counts['current']:,} images were already embedded, {counts['todo']:,} processed")
+
+
+def embed_missing_prompts(store: EmbeddingStore, prompts):
+    """Embed every distinct normalised prompt not yet in ``store``."""
+    todo = [p for p in prompts if p not in store]
+    print(f"{len(prompts) - len(todo):,} prompts already embedded, {len(todo):,} to go")
+    if not todo:
+        return
+
+    load_clip()
+    t0 = time.perf_counter()
+    for start in tqdm(range(0, len(todo), CHECKPOINT_EVERY), desc="Embedding prompts"):
+        chunk = todo[start : start + CHECKPOINT_EVERY]
+        emb = np.vstack([get_text_embeddings(chunk[i : i + TEXT_BATCH_SIZE])
+                         for i in range(0, len(chunk), TEXT_BATCH_SIZE)])
+        store.append(chunk, [None] * len(chunk), {"text": emb})
+        clear_gpu()
+    elapsed = time.perf_counter() - t0
+    print(f"   text embed  : {len(todo) / elapsed:8.1f} prompts/s ({elapsed:.1f} s)")
+
+
+def main(args):
+    start = datetime.now()
+    clear_gpu()
 
-    # --- save ---
-    faiss.write_index(index_img, os.path.join(SAVE_DIR, "image_index.faiss"))
-    faiss.write_index(index_txt, os.path.join(SAVE_DIR, "prompt_index.faiss"))
-    with open(os.path.join(SAVE_DIR, "prompt_metadata.pkl"), "wb") as f:
-        pickle.dump(metadata, f)
+    # ---- metadata: streamed into an on-disk table, looked up part by part ----
+    table = MetadataTable(args.metadata_db)
+    ingest(table, IMAGES_DIR, parquet=args.metadata_parquet)
+    n_files = table.scan_files(IMAGES_DIR)
+    print(f"Found {n_files:,} image files")
+
+    # ---- embed (resumable), walking the images in part order ----
+    image_store = EmbeddingStore(os.path.join(args.store_dir, "images"), IMAGE_STORE_ARRAYS)
+    prompt_store = EmbeddingStore(os.path.join(args.store_dir, "prompts"), PROMPT_STORE_ARRAYS)
+    if not args.assemble_only:
+        embed_missing_images(image_store, table.iter_files())
+
+    keys = [fn for fn in table.iter_files() if fn in image_store]
+    if not keys:
+        print("❌ No images embedded – nothing to index")
+        return
+    metadata = table.rows(keys)
+
+    # one prompt_index row per distinct normalised prompt, with a posting list
+    # of the images generated from it
+    prompt_ids, prompts = {}, []
+    image_prompt_id = np.empty(len(metadata), dtype=np.int64)
+    for i, row in enumerate(metadata):
+        norm = normalise_prompt(row["prompt"])
+        pid = prompt_ids.get(norm)
+        if pid is None:
+            pid = prompt_ids[norm] = len(prompts)
+            prompts.append(norm)
+        image_prompt_id[i] = pid
+    print(f"{len(prompts):,} distinct prompts across {len(metadata):,} images "
+          f"({1 - len(prompts) / len(metadata):.1%} fewer text embeddings and prompt_index rows)")
+    if not args.assemble_only:
+        embed_missing_prompts(prompt_store, prompts)
+    missing = [p for p in prompts if p not in prompt_store]
+    if missing:
+        print(f"❌ {len(missing):,} prompts have no text embedding – run without --assemble-only")
+        return
+
+    # ---- assemble indexes from the stores, no CLIP needed ----
+    # written straight into a fresh version directory; servers only see it once published
+    out_dir = new_version_dir(SAVE_DIR)
+    layout = {}                          # sharded builds: index name → shard entries
+
+    # two FAISS indexes: images (1536‑d) and distinct prompts (768‑d), read from
+    # the stores chunk by chunk rather than gathered into RAM
+    stacked = image_store.rows("stacked", keys)
+    _, params_img = save_index("image_index", stacked, args, out_dir, layout)
+    _, params_txt = save_index("prompt_index", prompt_store.rows("text", prompts), args, out_dir, layout)
+    all_params = {"image_index": params_img, "prompt_index": params_txt}
+
+    # two-stage sidecars: 768-d coarse image index + raw 1536-d vectors for rescoring
+    if args.coarse_index_type != "none":
+        vectors_path = os.path.join(out_dir, rerank.VECTORS_FILE)
+        write_vectors(vectors_path, stacked)
+        stacked = np.load(vectors_path, mmap_mode="r")     # sequential reads for the recall checks
+        final = image_store.rows("final", keys)
+        index_coarse, params_coarse = save_index("image_coarse_index", final, args, out_dir, layout,
+                                                 index_type=args.coarse_index_type)
+        if index_coarse is not None:         # sharded: per-shard recall@k above instead
+            recalls = rerank.two_stage_recall(index_coarse, stacked, final, k=RECALL_K, n_queries=RECALL_QUERIES)
+            for c, r in recalls.items():
+                print(f"   two-stage recall@{RECALL_K} ({c:>4} candidates) vs flat 1536-d : {r:.4f}")
+            params_coarse[f"two_stage_recall@{RECALL_K}"] = {str(c): round(r, 4) for c, r in recalls.items()}
+        all_params["image_coarse_index"] = params_coarse
+    if layout:
+        shards.write_manifest(out_dir, layout, {"image_index": CLIP_DIM_COMBINED, "prompt_index": CLIP_DIM_FINAL,
+                                                "image_coarse_index": CLIP_DIM_FINAL})
+    save_params(out_dir, all_params)
+    write_metadata_store(os.path.join(out_dir, "metadata"), metadata)
+    write_filter_index(os.path.join(out_dir, "metadata"))
+    write_prompt_groups(os.path.join(out_dir, "metadata"), image_prompt_id)
+    table.close()
+
+    version = os.path.basename(out_dir)
+    if args.no_publish:
+        print(f"\n📦 Built version {version} (not published; `python index_bundle.py publish {version}`)")
+    else:
+        publish(SAVE_DIR, version)
+        prune_versions(SAVE_DIR, args.keep_versions)
+        print(f"\n📦 Published version {version} – running servers pick it up on reload")
 
     print("\n✅ All done!")
-    print(f"   Images embedded   : {index_img.ntotal:,}")
+    print(f"   Images indexed    : {len(keys):,}{f' in {args.shards} shards' if layout else ''}")
+    print(f"   Distinct prompts  : {len(prompts):,}")
     print(f"   Runtime           : {datetime.now() - start}")
 
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Embed DiffusionDB images and build FAISS indexes")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default=INDEX_TYPE,
+                        help="FAISS index type for both image_index and prompt_index")
+    parser.add_argument("--nlist", type=int, default=None,
+                        help="IVF lists (default ~4·sqrt(n))")
+    parser.add_argument("--pq-m", type=int, default=None,
+                        help="PQ sub-quantisers (default dim/16)")
+    parser.add_argument("--hnsw-m", type=int, default=DEFAULT_HNSW_M,
+                        help="HNSW neighbours per node")
+    parser.add_argument("--nprobe", type=int, default=DEFAULT_NPROBE,
+                        help="IVF lists probed at search time (persisted)")
+    parser.add_argument("--ef-search", type=int, default=DEFAULT_EF_SEARCH,
+                        help="HNSW efSearch at search time (persisted)")
+    parser.add_argument("--train-size", type=int, default=TRAIN_SIZE,
+                        help="Max vectors sampled for IVF / PQ training")
+    parser.add_argument("--coarse-index-type", choices=INDEX_TYPES + ("none",), default=None,
+                        help="Index over 768-d image vectors for two-stage search "
+                             "(default: --index-type; 'none' skips the sidecars)")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="Split every index into this many row-range shards, searched by "
+                             "parallel worker processes (shards.py)")
+    parser.add_argument("--no-publish", action="store_true",
+                        help="Build the new index version but leave CURRENT pointing at the old one")
+    parser.add_argument("--keep-versions", type=int, default=3,
+                        help="Index versions kept under versions/ after publishing (0 = keep all)")
+    parser.add_argument("--metadata-db", default=METADATA_DB,
+                        help="On-disk metadata table (SQLite), updated incrementally")
+    parser.add_argument("--metadata-parquet", default=None,
+                        help="DiffusionDB metadata.parquet to ingest instead of / besides part JSON files")
+    parser.add_argument("--store-dir", default=STORE_DIR,
+                        help="On-disk embedding stores (images/ and prompts/; resumable, incremental)")
+    parser.add_argument("--assemble-only", action="store_true",
+                        help="Skip embedding; rebuild the indexes from the store only")
+    args = parser.parse_args(argv)
+    args.coarse_index_type = args.coarse_index_type or args.index_type
+    return args
+
+
 if __name__ == "__main__":
-    main()
+    main(parse_args())
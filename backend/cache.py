@@ -0,0 +1,142 @@
+"""Bounded in-memory caches for the search server.
+
+``LRUCache`` is a thread-safe LRU with optional TTL and hit/miss counters.
+``QueryCache`` adds content-addressed keys for uploaded images and drops
+everything when the index files it watches change on disk.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from PIL import Image
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by entry count, with optional TTL (seconds)."""
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None):
+        if max_entries < 1:
+            raise ValueError("max_entries must be >= 1")
+        self.max_entries = max_entries
+        self.ttl = ttl or None
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING and self.ttl is not None and time.monotonic() - item[0] > self.ttl:
+                del self._data[key]
+                item = _MISSING
+            if item is _MISSING:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# ------------------------------------------------------------------
+#  Query result cache
+# ------------------------------------------------------------------
+
+def bytes_key(data: bytes) -> str:
+    """Key for the raw uploaded bytes."""
+    return "b:" + hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def pixel_key(img: Image.Image) -> str:
+    """Key for decoded pixels, so re-encoded copies of an image still hit."""
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"{img.mode}:{img.size[0]}x{img.size[1]}".encode())
+    h.update(img.tobytes())
+    return "p:" + h.hexdigest()
+
+
+def files_fingerprint(paths: Iterable[str]) -> Tuple:
+    """(path, mtime, size) for every path; missing files count as changes too."""
+    fp = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            fp.append((p, st.st_mtime_ns, st.st_size))
+        except OSError:
+            fp.append((p, None, None))
+    return tuple(fp)
+
+
+class QueryCache(LRUCache):
+    """LRU of search results that empties itself when the watched index files change.
+
+    The files are stat()-ed at most every ``check_interval`` seconds.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None,
+                 watch_paths: Iterable[str] = (), check_interval: float = 2.0):
+        super().__init__(max_entries=max_entries, ttl=ttl)
+        self.watch_paths = list(watch_paths)
+        self.check_interval = check_interval
+        self.invalidations = 0
+        self._fingerprint = files_fingerprint(self.watch_paths)
+        self._last_check = time.monotonic()
+
+    def _check_files(self):
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        fp = files_fingerprint(self.watch_paths)
+        if fp != self._fingerprint:
+            self._fingerprint = fp
+            self.clear()
+            self.invalidations += 1
+            print("♻️  Index files changed – query cache cleared")
+
+    def watch(self, paths: Iterable[str]):
+        """Watch a new set of files (e.g. after an index reload) and drop every entry."""
+        self.watch_paths = list(paths)
+        self._fingerprint = files_fingerprint(self.watch_paths)
+        self.clear()
+        self.invalidations += 1
+
+    def get(self, key, default=None):
+        self._check_files()
+        return super().get(key, default)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), "invalidations": self.invalidations}
@@ -0,0 +1,83 @@
+"""Compare inference backends against fp32 before switching SEARCH_BACKEND.
+
+    python check_backend_parity.py --backends bf16 int8 onnx --images 64
+
+For every backend reports, relative to fp32 on the same images:
+  * cosine similarity of the stacked 1536-d and final 768-d embeddings
+  * overlap of the image_index / prompt_index top-k ids
+  * per-image embedding latency
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from inference_backends import BACKENDS, load_backend
+from search import ImageSearcher
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGE_DIRS = [os.path.join(SCRIPT_DIR, "data", "test_imgs"), os.path.join(SCRIPT_DIR, "data", "images")]
+
+
+def sample_images(n: int):
+    from PIL import Image
+    paths = []
+    for d in IMAGE_DIRS:
+        if os.path.isdir(d):
+            paths += [os.path.join(d, f) for f in sorted(os.listdir(d)) if f.lower().endswith((".png", ".jpg", ".jpeg"))]
+    if not paths:
+        raise FileNotFoundError(f"no images found in {IMAGE_DIRS}")
+    return [Image.open(p).convert("RGB") for p in paths[:n]]
+
+
+def embed_all(encode, pixel_values, batch_size: int):
+    stacked, final = [], []
+    t0 = time.perf_counter()
+    for i in range(0, len(pixel_values), batch_size):
+        s, f = encode(pixel_values[i : i + batch_size])
+        stacked.append(s)
+        final.append(f)
+    elapsed = time.perf_counter() - t0
+    return np.vstack(stacked), np.vstack(final), elapsed / len(pixel_values) * 1000
+
+
+def cosine(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return np.sum(a * b, axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+
+
+def topk_overlap(index, ref: np.ndarray, cand: np.ndarray, k: int) -> float:
+    _, i_ref = index.search(np.ascontiguousarray(ref), k)
+    _, i_cand = index.search(np.ascontiguousarray(cand), k)
+    return float(np.mean([len(np.intersect1d(a, b)) / k for a, b in zip(i_ref, i_cand)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=[b for b in BACKENDS if b != "fp32"], choices=BACKENDS)
+    parser.add_argument("--images", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    searcher = ImageSearcher(top_k=args.k, backend="fp32")
+    imgs = sample_images(args.images)
+    pixel_values = searcher.processor(images=imgs, return_tensors="pt")["pixel_values"]
+
+    ref_stack, ref_final, ref_ms = embed_all(searcher._encode, pixel_values, args.batch_size)
+    print(f"\n{'backend':<8} {'ms/img':>8} {'cos1536 mean/min':>18} {'cos768 mean/min':>18} "
+          f"{'img top-k':>10} {'prompt top-k':>13}")
+    print(f"{'fp32':<8} {ref_ms:8.1f} {'1.0000 / 1.0000':>18} {'1.0000 / 1.0000':>18} {1.0:10.3f} {1.0:13.3f}")
+
+    for name in args.backends:
+        encode = load_backend(searcher.model, name, searcher.device)
+        embed_all(encode, pixel_values[: args.batch_size], args.batch_size)        # warm-up
+        stack, final, ms = embed_all(encode, pixel_values, args.batch_size)
+        c_stack, c_final = cosine(ref_stack, stack), cosine(ref_final, final)
+        print(f"{name:<8} {ms:8.1f} {c_stack.mean():>9.4f} / {c_stack.min():.4f} {c_final.mean():>9.4f} / {c_final.min():.4f} "
+              f"{topk_overlap(searcher.image_index, ref_stack, stack, args.k):10.3f} "
+              f"{topk_overlap(searcher.prompt_index, ref_final, final, args.k):13.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Shared CLIP vision feature extractor for search.py and build_faiss_index.py.
+
+The stacked embedding needs only the CLS token of the middle and final
+transformer blocks.  Calling the HF vision model with
+``output_hidden_states=True`` keeps every block's full (batch, 257, 1024)
+activation alive until the forward pass ends, so instead we run the
+encoder blocks ourselves and keep only the middle CLS token.  Peak
+activation memory no longer grows with the depth of the model, and the
+vectors are the same ones the hidden-states path produces.
+"""
+import inspect
+
+import torch
+from torch import nn
+
+# Masks passed to each encoder block.  CLIPEncoderLayer.forward in the pinned
+# transformers 4.30.2 is (hidden_states, attention_mask, causal_attention_mask,
+# output_attentions=False); later releases drop causal_attention_mask, so the
+# masks are passed by name and only those the installed layer accepts.
+LAYER_MASKS = ("attention_mask", "causal_attention_mask")
+
+
+class StackedVisionEncoder(nn.Module):
+    """CLIP vision tower + projection returning normalised (stacked1536, final768) embeddings."""
+
+    def __init__(self, vision_model: nn.Module, visual_projection: nn.Module):
+        super().__init__()
+        self.vision_model = vision_model
+        self.visual_projection = visual_projection
+        # hidden_states[len // 2] of the HF output, i.e. the output of this many blocks
+        self.mid_layer = (len(vision_model.encoder.layers) + 1) // 2
+        params = inspect.signature(type(vision_model.encoder.layers[0]).forward).parameters
+        if "attention_mask" not in params:
+            raise TypeError(f"unsupported CLIP encoder layer signature {list(params)}; "
+                            "see LAYER_MASKS in clip_features.py")
+        self.layer_kwargs = {name: None for name in LAYER_MASKS if name in params}
+
+    def forward(self, pixel_values: torch.Tensor):
+        vm = self.vision_model
+        hidden = vm.pre_layrnorm(vm.embeddings(pixel_values))
+
+        cls_mid = None
+        for i, layer in enumerate(vm.encoder.layers, start=1):
+            out = layer(hidden, **self.layer_kwargs)
+            hidden = out[0] if isinstance(out, tuple) else out
+            if i == self.mid_layer:
+                cls_mid = hidden[:, 0, :].clone()      # don't pin the whole block output
+        cls_final = hidden[:, 0, :]
+        del hidden
+
+        return self._project(cls_final, cls_mid)
+
+    def reference_forward(self, pixel_values: torch.Tensor):
+        """Original ``output_hidden_states=True`` path, kept for parity checks."""
+        vis_out = self.vision_model(pixel_values=pixel_values, output_hidden_states=True, return_dict=True)
+        hidden_states = vis_out.hidden_states
+        return self._project(vis_out.last_hidden_state[:, 0, :], hidden_states[len(hidden_states)//2][:, 0, :])
+
+    def _project(self, cls_final: torch.Tensor, cls_mid: torch.Tensor):
+        # layernorm + projection identical to CLIPModel.forward() logic
+        cls_final = self.vision_model.post_layernorm(cls_final)
+        cls_mid = self.vision_model.post_layernorm(cls_mid)
+        proj_final = self.visual_projection(cls_final)
+        proj_mid = self.visual_projection(cls_mid)
+        final_768 = proj_final / proj_final.norm(dim=-1, keepdim=True)
+        stacked_1536 = torch.cat([proj_final, proj_mid], dim=-1)
+        stacked_1536 = stacked_1536 / stacked_1536.norm(dim=-1, keepdim=True)
+        return stacked_1536, final_768
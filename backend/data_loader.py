@@ -0,0 +1,200 @@
+"""Streaming multiprocess image loader for build_faiss_index.py.
+
+Worker processes decode (JPEGs at reduced scale, see preprocess.py),
+resize and normalise whole batches to CLIP ``pixel_values`` and write them straight into a ring of shared-memory
+slots, so the model process only copies a finished float32 block out of
+shared memory.  Up to ``prefetch`` batches are in flight at once, which
+keeps preprocessing running while the model does its forward pass.
+
+    with BatchLoader(paths, batch_size=64, workers=8) as loader:
+        for batch in loader:
+            model(pixel_values=batch.pixel_values.to(device, non_blocking=True))
+        loader.report()
+"""
+import itertools
+import multiprocessing as mp
+import time
+from collections import deque
+from multiprocessing import shared_memory
+from typing import Iterable, List, NamedTuple, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+
+from preprocess import IMAGE_SIZE, open_image, to_pixel_values
+
+# ------------------------------------------------------------------
+#  Worker side
+# ------------------------------------------------------------------
+
+_processor = None                    # CLIPImageProcessor, only when fast_preprocess is off
+_slots = {}
+
+
+def _init_worker(model_id: str, cache_dir: Optional[str], fast_preprocess: bool):
+    global _processor
+    if not fast_preprocess:
+        from transformers import CLIPImageProcessor
+        _processor = CLIPImageProcessor.from_pretrained(model_id, cache_dir=cache_dir)
+
+
+def _slot_view(name: str, batch_size: int) -> np.ndarray:
+    shm = _slots.get(name)
+    if shm is None:
+        shm = _slots[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray((batch_size, 3, IMAGE_SIZE, IMAGE_SIZE), dtype=np.float32, buffer=shm.buf)
+
+
+def _load_one(path: str):
+    try:
+        return Image.open(path).convert("RGB") if _processor is not None else open_image(path)
+    except Exception:
+        return None
+
+
+def _load_batch(task):
+    """Decode + preprocess ``paths`` into shared-memory slot ``slot_name``."""
+    slot_name, batch_size, paths = task
+
+    t0 = time.perf_counter()
+    imgs = [_load_one(p) for p in paths]
+    ok = [i for i, img in enumerate(imgs) if img is not None]
+    t1 = time.perf_counter()
+
+    if ok:
+        ok_imgs = [imgs[i] for i in ok]
+        if _processor is not None:
+            pixels = _processor(images=ok_imgs, return_tensors="np")["pixel_values"]
+        else:
+            pixels = to_pixel_values(ok_imgs)
+        _slot_view(slot_name, batch_size)[: len(ok)] = pixels
+    t2 = time.perf_counter()
+    return ok, t1 - t0, t2 - t1
+
+
+# ------------------------------------------------------------------
+#  Main-process side
+# ------------------------------------------------------------------
+
+class LoadedBatch(NamedTuple):
+    indices: List[int]               # positions in the loader's ``paths`` that decoded OK
+    pixel_values: torch.Tensor       # (len(indices), 3, 224, 224) float32
+    n_requested: int                 # paths in this batch, including failures
+    paths: List[str]                 # the paths behind ``indices``
+
+
+class BatchLoader:
+    """Iterate over ``paths`` in batches of preprocessed CLIP pixel values.
+
+    A yielded ``pixel_values`` tensor stays valid for the next ``prefetch``
+    batches; copy it if you need to keep it longer.  ``paths`` may be a lazy
+    iterable: it is consumed one batch at a time as slots free up.
+    """
+
+    def __init__(self, paths: Iterable[str], batch_size: int, workers: int, model_id: str,
+                 cache_dir: Optional[str] = None, prefetch: int = 4, pin_memory: bool = False,
+                 fast_preprocess: bool = True):
+        self.paths = paths
+        self.batch_size = batch_size
+        self.workers = workers
+        self.prefetch = max(1, prefetch)
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.model_id = model_id
+        self.cache_dir = cache_dir
+        self.fast_preprocess = fast_preprocess
+
+        # per-stage seconds (decode / preprocess are summed over workers)
+        self.images = 0
+        self.decode_s = 0.0
+        self.preprocess_s = 0.0
+        self.wait_s = 0.0
+        self.wall_s = 0.0
+
+        self._pool = None
+        self._shm: List[shared_memory.SharedMemory] = []
+        self._pinned: List[torch.Tensor] = []
+
+    # ------------------------------------------------------------------
+
+    def __enter__(self):
+        slot_bytes = self.batch_size * 3 * IMAGE_SIZE * IMAGE_SIZE * 4
+        self._shm = [shared_memory.SharedMemory(create=True, size=slot_bytes) for _ in range(self.prefetch)]
+        if self.pin_memory:
+            self._pinned = [torch.empty((self.batch_size, 3, IMAGE_SIZE, IMAGE_SIZE)).pin_memory()
+                            for _ in range(self.prefetch)]
+        ctx = mp.get_context("spawn")
+        self._pool = ctx.Pool(self.workers, initializer=_init_worker, initargs=(self.model_id, self.cache_dir, self.fast_preprocess))
+        return self
+
+    def __exit__(self, *exc):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        for shm in self._shm:
+            shm.close()
+            shm.unlink()
+        self._shm = []
+        self._pinned = []
+
+    def __len__(self):
+        return (len(self.paths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self._pool is None:
+            raise RuntimeError("use BatchLoader as a context manager")
+        source = iter(self.paths)
+        offset = 0
+        in_flight = deque()
+
+        def submit(slot):
+            nonlocal offset
+            paths = list(itertools.islice(source, self.batch_size))
+            if not paths:
+                return
+            task = (self._shm[slot].name, self.batch_size, paths)
+            in_flight.append((slot, offset, paths, self._pool.apply_async(_load_batch, (task,))))
+            offset += len(paths)
+
+        for slot in range(self.prefetch):
+            submit(slot)
+
+        t_start = time.perf_counter()
+        while in_flight:
+            slot, start, paths, res = in_flight.popleft()
+            t0 = time.perf_counter()
+            ok, decode_s, preprocess_s = res.get()
+            self.wait_s += time.perf_counter() - t0
+            self.decode_s += decode_s
+            self.preprocess_s += preprocess_s
+            self.images += len(ok)
+
+            view = np.ndarray((self.batch_size, 3, IMAGE_SIZE, IMAGE_SIZE), dtype=np.float32,
+                              buffer=self._shm[slot].buf)[: len(ok)]
+            if self.pin_memory:
+                pixel_values = self._pinned[slot][: len(ok)]
+                pixel_values.copy_(torch.from_numpy(view))
+            else:
+                pixel_values = torch.from_numpy(view.copy())
+            del view
+
+            # slot is free again – keep the pipeline full before handing the batch out
+            submit(slot)
+            yield LoadedBatch([start + i for i in ok], pixel_values, len(paths), [paths[i] for i in ok])
+        self.wall_s += time.perf_counter() - t_start
+
+    # ------------------------------------------------------------------
+
+    def report(self, stages: Optional[dict] = None):
+        """Print images/sec per stage; ``stages`` adds consumer-side timings (name → seconds)."""
+        def rate(seconds):
+            return f"{self.images / seconds:8.1f} img/s" if seconds > 0 else "       – img/s"
+
+        print(f"\n📊 Loader throughput over {self.images:,} images ({self.workers} workers)")
+        print(f"   decode      : {rate(self.decode_s / self.workers)}  ({self.decode_s:.1f} worker-s)")
+        print(f"   preprocess  : {rate(self.preprocess_s / self.workers)}  ({self.preprocess_s:.1f} worker-s)")
+        for name, seconds in (stages or {}).items():
+            print(f"   {name:<12}: {rate(seconds)}  ({seconds:.1f} s)")
+        print(f"   loader wait : {self.wait_s:.1f} s (model idle waiting for data)")
+        print(f"   end-to-end  : {rate(self.wall_s)}")
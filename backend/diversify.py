@@ -0,0 +1,124 @@
+"""Diversity-aware top-k: over-fetch candidates, then collapse near-duplicates.
+
+DiffusionDB holds many near-identical images of one prompt rendered with
+different seeds, so a plain top-k is often k copies of the same picture.
+With diversification on, the searcher fetches ``k × overfetch`` candidates
+and ``select`` keeps k of them:
+
+  * ``collapse_prompts`` – only the best-scoring image of each prompt;
+  * ``max_similarity``   – drop candidates at least this cosine-similar to
+    an already kept hit;
+  * ``lambda``           – maximal marginal relevance (MMR) trade-off between
+    similarity to the query (1.0 = plain top-k order) and dissimilarity to
+    the hits kept so far.
+
+Redundancy is measured on the candidates' own vectors with one (m, m) Gram
+matrix per query, so each of the k greedy steps is a vector op over the m
+candidates.  Without candidate vectors (no ``image_vectors.npy`` and an
+index that cannot reconstruct) only prompt collapsing applies.  A list can
+come back shorter than k when the over-fetched candidates hold fewer than k
+distinct hits; raise ``overfetch`` for such queries.
+
+Requests pass ``"diversify": true`` for the defaults, or an object
+overriding any of DEFAULTS.
+"""
+import json
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+DEFAULTS = {"lambda": 0.7, "max_similarity": 0.95, "collapse_prompts": True, "overfetch": 4}
+DIVERSIFY_KEYS = tuple(DEFAULTS)
+MAX_CANDIDATES = 1024
+
+
+def parse_options(opts) -> Optional[Dict]:
+    """Validate ``diversify`` request options: bool, dict, or a JSON / "1" string; None when off."""
+    if isinstance(opts, (str, bytes)):
+        opts = opts.strip().lower() if isinstance(opts, str) else opts.decode().strip().lower()
+        if opts in ("", "0", "false", "off"):
+            return None
+        opts = True if opts in ("1", "true", "on") else json.loads(opts)
+    if opts is None or opts is False:
+        return None
+    if opts is True:
+        return dict(DEFAULTS)
+    if not isinstance(opts, dict):
+        raise ValueError("diversify must be true/false or an object")
+    unknown = set(opts) - set(DIVERSIFY_KEYS)
+    if unknown:
+        raise ValueError(f"unknown diversify option(s) {sorted(unknown)}; expected {', '.join(DIVERSIFY_KEYS)}")
+
+    out = {**DEFAULTS, **opts}
+    out["lambda"] = float(out["lambda"])
+    out["max_similarity"] = float(out["max_similarity"])
+    out["collapse_prompts"] = bool(out["collapse_prompts"])
+    out["overfetch"] = int(out["overfetch"])
+    if not 0.0 <= out["lambda"] <= 1.0:
+        raise ValueError("diversify.lambda must be in [0, 1]")
+    if not 0.0 < out["max_similarity"] <= 1.0:
+        raise ValueError("diversify.max_similarity must be in (0, 1]")
+    if out["overfetch"] < 1:
+        raise ValueError("diversify.overfetch must be >= 1")
+    return out
+
+
+def candidates(k: int, opts: Optional[Dict]) -> int:
+    """How many hits to fetch for a diversified top-``k``."""
+    if not opts:
+        return k
+    return max(k, min(k * opts["overfetch"], MAX_CANDIDATES))
+
+
+def select(scores: np.ndarray, vectors: Optional[np.ndarray], groups: Optional[np.ndarray],
+           k: int, opts: Dict) -> np.ndarray:
+    """Positions (into the score-sorted candidates) of the ``k`` hits to keep, in result order.
+
+    ``scores`` are the candidates' similarities to the query, best first;
+    ``vectors`` their (m, d) embeddings and ``groups`` their prompt ids,
+    either of which may be None.
+    """
+    alive = np.ones(len(scores), dtype=bool)
+    if groups is not None and opts["collapse_prompts"]:
+        _, first = np.unique(groups, return_index=True)          # best-scoring row of each prompt
+        alive[:] = False
+        alive[first] = True
+    if vectors is None:
+        return np.flatnonzero(alive)[:k]
+
+    vecs = vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-8)
+    gram = vecs @ vecs.T
+    lam, max_sim = opts["lambda"], opts["max_similarity"]
+    redundancy = np.zeros(len(scores), dtype=np.float32)
+    picked = []
+    while len(picked) < k and alive.any():
+        mmr = np.where(alive, lam * scores - (1.0 - lam) * redundancy, -np.inf)
+        j = int(np.argmax(mmr))
+        picked.append(j)
+        alive[j] = False
+        alive &= gram[j] < max_sim
+        redundancy = np.maximum(redundancy, gram[j]) if len(picked) > 1 else gram[j].copy()
+    return np.asarray(picked, dtype=np.int64)
+
+
+def diversify(dots: np.ndarray, idxs: np.ndarray, k: int, opts: Dict,
+              vectors_of=None, groups_of=None) -> Tuple[np.ndarray, np.ndarray]:
+    """Cut FAISS-style (n, m) candidate results down to diversified (n, k) ones.
+
+    ``vectors_of(ids)`` / ``groups_of(ids)`` return the candidates' vectors /
+    prompt ids, or None. Output is padded with (-inf, -1) like FAISS.
+    """
+    n = len(dots)
+    out_d = np.full((n, k), -np.inf, dtype=np.float32)
+    out_i = np.full((n, k), -1, dtype=np.int64)
+    for q in range(n):
+        valid = idxs[q] >= 0
+        ids, scores = idxs[q][valid], np.asarray(dots[q][valid], dtype=np.float32)
+        if not len(ids):
+            continue
+        vecs = vectors_of(ids) if vectors_of is not None else None
+        groups = groups_of(ids) if groups_of is not None else None
+        keep = select(scores, vecs, groups, k, opts)
+        out_d[q, :len(keep)] = scores[keep]
+        out_i[q, :len(keep)] = ids[keep]
+    return out_d, out_i
@@ -1,12 +1,18 @@
 # Author: Marco Lustri 2022 - https://github.com/TheLustriVA
 # MIT License
 
-from urllib.error import HTTPError
-from urllib.request import urlretrieve
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from alive_progress import alive_bar
+import requests
+from requests.adapters import HTTPAdapter
+import hashlib
+import json
+import re
 import shutil
 import os
 import time
+import threading
+import zipfile
 import argparse
 
 # # First download with clearing
@@ -16,9 +22,34 @@ import argparse
 # python download.py -i 100 -r 121 -z
 # python download.py -i 500 -r 521 -z
 
+# Parts download concurrently (-w) over one pooled session. Each part goes to
+# part-XXXXXX.zip.partial and resumes with an HTTP Range request after an
+# interruption. It is checked against the size and sha256 the server
+# advertises (or --checksums) and handed to an extraction worker pool (-x)
+# while the other parts are still downloading. Finished parts are recorded
+# in manifest.txt and skipped on the next run.
+#
+# Local test against fake parts:
+# python fake_diffusiondb_server.py --parts 20 --port 8765
+# python download.py -i 1 -r 21 -z --base-url http://localhost:8765/
+
 # Constants
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 HARDCODED_OUTPUT_DIR = os.path.join(SCRIPT_DIR, "data", "images")
+BASE_URL = "https://huggingface.co/datasets/poloclub/diffusiondb/resolve/main/"
+MANIFEST = "manifest.txt"
+DOWNLOAD_WORKERS = 4
+EXTRACT_WORKERS = 2
+RETRIES = 5
+CHUNK_BYTES = 1 << 20
+TIMEOUT = (10, 60)                   # connect, read seconds
+
+_SHA256 = re.compile(r"^[0-9a-f]{64}$")
+
+
+class VerificationError(Exception):
+    pass
+
 
 def clear_directory(directory):
     """Clear all files in the specified directory."""
@@ -37,59 +68,129 @@ def clear_directory(directory):
         os.makedirs(directory)
     print("✨ Directory cleared successfully")
 
-def download(index=0, range_index=0, large=False, should_clear=False):
-    """
-    Download zip files from DiffusionDB.
-    """
-    baseurl = "https://huggingface.co/datasets/poloclub/diffusiondb/resolve/main/"
-    files_to_unzip = []
+def part_url(idx, large=False, base_url=BASE_URL):
+    if not large:
+        return f"{base_url}images/part-{idx:06}.zip"
+    if idx <= 10000:
+        return f"{base_url}diffusiondb-large-part-1/part-{idx:06}.zip"
+    return f"{base_url}diffusiondb-large-part-2/part-{idx:06}.zip"
 
-    # Only clear if explicitly requested
-    if should_clear:
-        clear_directory(HARDCODED_OUTPUT_DIR)
-    elif not os.path.exists(HARDCODED_OUTPUT_DIR):
-        os.makedirs(HARDCODED_OUTPUT_DIR)
+def make_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def load_checksums(path):
+    """sha256sum-style file: '<hex>  part-000001.zip' per line."""
+    sums = {}
+    with open(path, encoding="utf-8") as fp:
+        for line in fp:
+            parts = line.split()
+            if len(parts) == 2:
+                sums[os.path.basename(parts[1].lstrip("*"))] = parts[0].lower()
+    return sums
+
+# ------------------------------------------------------------
+#  Download (resumable)
+# ------------------------------------------------------------
 
-    if range_index == 0:
-        # Single file
-        url = f"{baseurl}images/part-{index:06}.zip" if not large else (
-            f"{baseurl}diffusiondb-large-part-1/part-{index:06}.zip"
-            if index <= 10000 else f"{baseurl}diffusiondb-large-part-2/part-{index:06}.zip"
-        )
-        file_path = os.path.join(HARDCODED_OUTPUT_DIR, f"part-{index:06}.zip")
-        print("📥 Downloading:", url)
+def _advertised(resp):
+    """(total size, sha256) from a 200/206 response and its redirects; either may be None."""
+    total = None
+    if resp.status_code == 206:
+        m = re.search(r"/(\d+)$", resp.headers.get("Content-Range", ""))
+        total = int(m.group(1)) if m else None
+    elif resp.headers.get("Content-Length"):
+        total = int(resp.headers["Content-Length"])
+
+    sha = None
+    for r in [*resp.history, resp]:
+        # Hugging Face puts the LFS object's sha256 in X-Linked-ETag
+        for name in ("X-Linked-ETag", "ETag"):
+            tag = r.headers.get(name, "").strip().removeprefix("W/").strip('"').lower()
+            if _SHA256.match(tag):
+                sha = tag
+        if total is None and r.headers.get("X-Linked-Size"):
+            total = int(r.headers["X-Linked-Size"])
+    return total, sha
+
+def fetch_part(session, url, dest, expected_sha=None, retries=RETRIES):
+    """Download ``url`` to ``dest`` via ``dest.partial``, resuming with Range after failures."""
+    partial = dest + ".partial"
+    state_path = partial + ".json"          # validator of the partial bytes, for If-Range
+
+    for attempt in range(retries + 1):
         try:
-            urlretrieve(url, file_path)
-            files_to_unzip.append(file_path)
-        except HTTPError as e:
-            print(f"❌ HTTPError downloading {url}: {e}")
-    else:
-        # Range of files
-        with alive_bar(range_index - index, title="📥 Downloading files") as bar:
-            for idx in range(index, range_index):
-                url = f"{baseurl}images/part-{idx:06}.zip" if not large else (
-                    f"{baseurl}diffusiondb-large-part-1/part-{idx:06}.zip"
-                    if idx <= 10000 else f"{baseurl}diffusiondb-large-part-2/part-{idx:06}.zip"
-                )
-                file_path = os.path.join(HARDCODED_OUTPUT_DIR, f"part-{idx:06}.zip")
-                try:
-                    urlretrieve(url, file_path)
-                    files_to_unzip.append(file_path)
-                    manifest_path = os.path.join(HARDCODED_OUTPUT_DIR, "manifest.txt")
-                    with open(manifest_path, "a") as f:
-                        f.write(url + "\n")
-                except HTTPError as e:
-                    print(f"❌ HTTPError downloading {url}: {e}")
-                time.sleep(0.1)
-                bar()
-
-    return files_to_unzip
+            have = os.path.getsize(partial) if os.path.exists(partial) else 0
+            state = {}
+            if have and os.path.exists(state_path):
+                with open(state_path, encoding="utf-8") as fp:
+                    state = json.load(fp)
+            headers = {}
+            if have and state.get("validator"):
+                # If-Range: the server sends the whole file instead if it changed meanwhile
+                headers = {"Range": f"bytes={have}-", "If-Range": state["validator"]}
+
+            with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as resp:
+                if resp.status_code == 416:          # range past the end: start over
+                    os.remove(partial)
+                    error = VerificationError("partial file longer than the remote part")
+                    continue
+                resp.raise_for_status()
+                if resp.status_code != 206:          # server ignored / refused the range
+                    have = 0
+                total, sha = _advertised(resp)
+                expected_sha = expected_sha or sha
+                validator = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+                with open(state_path, "w", encoding="utf-8") as fp:
+                    json.dump({"validator": validator, "total": total}, fp)
+
+                digest = hashlib.sha256()
+                if have:
+                    with open(partial, "rb") as fp:
+                        for block in iter(lambda: fp.read(CHUNK_BYTES), b""):
+                            digest.update(block)
+                with open(partial, "ab" if have else "wb") as fp:
+                    for chunk in resp.iter_content(CHUNK_BYTES):
+                        fp.write(chunk)
+                        digest.update(chunk)
+
+            size = os.path.getsize(partial)
+            if total is not None and size != total:
+                raise VerificationError(f"size {size} != advertised {total}")
+            if expected_sha and digest.hexdigest() != expected_sha:
+                os.remove(partial)                   # corrupt, resuming would keep the bad bytes
+                raise VerificationError(f"sha256 {digest.hexdigest()} != {expected_sha}")
+            os.replace(partial, dest)
+            os.remove(state_path)
+            return dest
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code < 500:
+                raise                                # 404 etc.: retrying will not help
+            error = e
+        except (requests.RequestException, VerificationError, OSError) as e:
+            error = e
+        if attempt < retries:
+            time.sleep(min(30, 2 ** attempt))
+    raise error
+
+# ------------------------------------------------------------
+#  Extraction (separate worker processes)
+# ------------------------------------------------------------
+
+def extract_part(zip_path, out_dir):
+    """Unpack one part and delete the zip; runs in an extraction worker."""
+    with zipfile.ZipFile(zip_path) as zf:
+        names = zf.namelist()
+        zf.extractall(out_dir)
+    os.remove(zip_path)
+    return zip_path, len(names)
 
 def unzip_file(file_path):
     try:
-        shutil.unpack_archive(file_path, extract_dir=HARDCODED_OUTPUT_DIR)
-        # Clean up zip file after successful extraction
-        os.remove(file_path)
+        extract_part(file_path, HARDCODED_OUTPUT_DIR)
         return f"✅ Unzipped and cleaned up: {file_path}"
     except Exception as e:
         return f"❌ Failed to unzip {file_path}: {e}"
@@ -98,22 +199,98 @@ def unzip_all(file_paths):
     with alive_bar(len(file_paths), title="📦 Unzipping files") as bar:
         for file in file_paths:
             print(unzip_file(file))
-            time.sleep(0.1)
             bar()
 
-def main(index=None, range_max=None, unzip=False, large=False, clear=False):
+# ------------------------------------------------------------
+#  Pipeline
+# ------------------------------------------------------------
+
+def download(index=0, range_index=0, large=False, should_clear=False, unzip=False,
+             workers=DOWNLOAD_WORKERS, extract_workers=EXTRACT_WORKERS, base_url=BASE_URL,
+             checksums=None, retries=RETRIES):
+    """
+    Download (and with ``unzip`` extract) DiffusionDB parts [index, range_index).
+
+    Returns the zip paths left on disk (all of them when not unzipping).
+    """
+    # Only clear if explicitly requested
+    if should_clear:
+        clear_directory(HARDCODED_OUTPUT_DIR)
+    elif not os.path.exists(HARDCODED_OUTPUT_DIR):
+        os.makedirs(HARDCODED_OUTPUT_DIR)
+
+    indices = [index] if not range_index else list(range(index, range_index))
+    manifest_path = os.path.join(HARDCODED_OUTPUT_DIR, MANIFEST)
+    done = set()
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as fp:
+            done = {line.strip() for line in fp}
+    todo = [(idx, part_url(idx, large, base_url)) for idx in indices]
+    skipped = sum(url in done for _, url in todo)
+    todo = [(idx, url) for idx, url in todo if url not in done]
+    if skipped:
+        print(f"⏭️  {skipped} part(s) already in {MANIFEST}")
+
+    manifest_lock = threading.Lock()
+    def record(url):
+        with manifest_lock, open(manifest_path, "a", encoding="utf-8") as fp:
+            fp.write(url + "\n")
+
+    session = make_session(workers)
+    kept, failed = [], []
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(workers) as dl_pool, \
+            ProcessPoolExecutor(extract_workers) as ex_pool, \
+            alive_bar(len(todo), title="📥 Downloading files") as bar:
+
+        def fetch(idx, url):
+            dest = os.path.join(HARDCODED_OUTPUT_DIR, f"part-{idx:06}.zip")
+            if os.path.exists(dest) and zipfile.is_zipfile(dest):
+                return dest                          # finished earlier, extraction interrupted
+            return fetch_part(session, url, dest, (checksums or {}).get(os.path.basename(dest)), retries)
+
+        downloads = {dl_pool.submit(fetch, idx, url): url for idx, url in todo}
+        extractions = {}
+        for fut in as_completed(downloads):
+            url = downloads[fut]
+            try:
+                path = fut.result()
+            except Exception as e:
+                print(f"❌ Error downloading {url}: {e}")
+                failed.append(url)
+            else:
+                if unzip:
+                    # extract now, overlapping with the downloads still running
+                    extractions[ex_pool.submit(extract_part, path, HARDCODED_OUTPUT_DIR)] = url
+                else:
+                    record(url)
+                    kept.append(path)
+            bar()
+
+        for fut in as_completed(extractions):
+            url = extractions[fut]
+            try:
+                path, n = fut.result()
+                record(url)
+                print(f"✅ Unzipped and cleaned up: {os.path.basename(path)} ({n} files)")
+            except Exception as e:
+                print(f"❌ Failed to unzip {url}: {e}")
+                failed.append(url)
+
+    print(f"⏱️ {len(todo) - len(failed)}/{len(todo)} part(s) in {time.perf_counter() - t0:.1f} s")
+    if failed:
+        print(f"❌ {len(failed)} part(s) failed – re-run the same command to resume them")
+    return kept
+
+def main(index=None, range_max=None, unzip=False, large=False, clear=False, **opts):
     if index is not None and range_max is not None:
         if range_max - index >= 1999:
             confirmation = input("⚠️ This may require 1.7TB+ space. Continue? (y/n): ")
             if confirmation.lower() != "y":
                 return
-        files = download(index=index, range_index=range_max, large=large, should_clear=clear)
-        if unzip and files:
-            unzip_all(files)
+        download(index=index, range_index=range_max, large=large, should_clear=clear, unzip=unzip, **opts)
     elif index is not None:
-        files = download(index=index, large=large, should_clear=clear)
-        if unzip and files:
-            unzip_all(files)
+        download(index=index, large=large, should_clear=clear, unzip=unzip, **opts)
     else:
         print("❌ No index provided. Use -i to specify the starting index.")
 
@@ -130,7 +307,7 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "-z", "--unzip", action="store_true",
-        help="Unzip the files after downloading"
+        help="Unzip each file as soon as it is downloaded"
     )
     parser.add_argument(
         "-l", "--large", action="store_true",
@@ -140,6 +317,26 @@ if __name__ == "__main__":
         "-c", "--clear", action="store_true",
         help="Clear the output directory before downloading"
     )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=DOWNLOAD_WORKERS,
+        help="Concurrent downloads (and pooled connections)"
+    )
+    parser.add_argument(
+        "-x", "--extract-workers", type=int, default=EXTRACT_WORKERS,
+        help="Extraction worker processes"
+    )
+    parser.add_argument(
+        "--base-url", default=BASE_URL,
+        help="Dataset root URL (e.g. a local fake_diffusiondb_server.py)"
+    )
+    parser.add_argument(
+        "--checksums", default=None,
+        help="sha256sum-style file to verify parts against (default: server-advertised sha256)"
+    )
+    parser.add_argument(
+        "--retries", type=int, default=RETRIES,
+        help="Retries per part; each retry resumes from the bytes already on disk"
+    )
 
     args = parser.parse_args()
 
@@ -148,5 +345,10 @@ if __name__ == "__main__":
         range_max=args.range,
         unzip=args.unzip,
         large=args.large,
-        clear=args.clear
+        clear=args.clear,
+        workers=args.workers,
+        extract_workers=args.extract_workers,
+        base_url=args.base_url if args.base_url.endswith("/") else args.base_url + "/",
+        checksums=load_checksums(args.checksums) if args.checksums else None,
+        retries=args.retries,
     )
@@ -0,0 +1,179 @@
+"""Append-only on-disk embedding store used by build_faiss_index.py.
+
+Layout of ``root``::
+
+    manifest.json                 {"arrays": {name: dim}, "shards": [shard ids]}
+    shard-000000.keys.json        [[key, fingerprint], ...]   one per row
+    shard-000000.<name>.npy       (rows, dim) float32, one file per array
+
+Each ``append`` writes one complete shard and then atomically rewrites the
+manifest, so a crash loses at most the shard being written.  A key that
+appears in several shards resolves to the newest one.  Shards are read back
+with ``np.load(mmap_mode="r")`` so assembling indexes never needs CLIP, and
+``rows`` hands the build a lazy (n, d) view that reads only the rows it is
+indexed with, so memory stays bounded by the chunk / sample being used.
+"""
+import json
+import os
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+MANIFEST = "manifest.json"
+
+
+def _atomic_write_json(path: str, obj):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as fp:
+        json.dump(obj, fp)
+    os.replace(tmp, path)
+
+
+def _atomic_save_npy(path: str, arr: np.ndarray):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as fp:
+        np.save(fp, arr)
+    os.replace(tmp, path)
+
+
+class EmbeddingStore:
+    """Keyed, append-only store of fixed-width float32 embedding arrays."""
+
+    def __init__(self, root: str, arrays: Dict[str, int]):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.manifest_path = os.path.join(root, MANIFEST)
+
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as fp:
+                manifest = json.load(fp)
+            if manifest["arrays"] != arrays:
+                raise ValueError(f"Store at {root} holds {manifest['arrays']}, expected {arrays}")
+            self.shards: List[str] = manifest["shards"]
+        else:
+            self.shards = []
+        self.arrays = dict(arrays)
+
+        # key -> (shard position, row, fingerprint); newest shard wins
+        self._entries: Dict[str, Tuple[int, int, Optional[str]]] = {}
+        for pos, shard in enumerate(self.shards):
+            for row, (key, fingerprint) in enumerate(self._read_keys(shard)):
+                self._entries[key] = (pos, row, fingerprint)
+
+    # ------------------------------------------------------------------
+    #  Paths
+    # ------------------------------------------------------------------
+
+    def _keys_path(self, shard: str) -> str:
+        return os.path.join(self.root, f"{shard}.keys.json")
+
+    def _array_path(self, shard: str, name: str) -> str:
+        return os.path.join(self.root, f"{shard}.{name}.npy")
+
+    def _read_keys(self, shard: str):
+        with open(self._keys_path(shard), "r", encoding="utf-8") as fp:
+            return json.load(fp)
+
+    # ------------------------------------------------------------------
+    #  Lookup
+    # ------------------------------------------------------------------
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def is_current(self, key: str, fingerprint: Optional[str]) -> bool:
+        """True if ``key`` is stored with exactly this fingerprint."""
+        entry = self._entries.get(key)
+        return entry is not None and entry[2] == fingerprint
+
+    def keys(self) -> List[str]:
+        return list(self._entries)
+
+    # ------------------------------------------------------------------
+    #  Write
+    # ------------------------------------------------------------------
+
+    def append(self, keys: Sequence[str], fingerprints: Sequence[Optional[str]],
+               arrays: Dict[str, np.ndarray]):
+        """Write one shard holding ``keys`` and their rows of every array."""
+        if not keys:
+            return
+        if set(arrays) != set(self.arrays):
+            raise ValueError(f"expected arrays {sorted(self.arrays)}, got {sorted(arrays)}")
+        for name, arr in arrays.items():
+            if arr.shape != (len(keys), self.arrays[name]):
+                raise ValueError(f"{name}: expected {(len(keys), self.arrays[name])}, got {arr.shape}")
+
+        shard = f"shard-{len(self.shards):06d}"
+        for name, arr in arrays.items():
+            _atomic_save_npy(self._array_path(shard, name), np.ascontiguousarray(arr, dtype=np.float32))
+        _atomic_write_json(self._keys_path(shard), [[k, f] for k, f in zip(keys, fingerprints)])
+
+        # the manifest is the commit point
+        self.shards.append(shard)
+        _atomic_write_json(self.manifest_path, {"arrays": self.arrays, "shards": self.shards})
+
+        pos = len(self.shards) - 1
+        for row, (key, fingerprint) in enumerate(zip(keys, fingerprints)):
+            self._entries[key] = (pos, row, fingerprint)
+
+    # ------------------------------------------------------------------
+    #  Read
+    # ------------------------------------------------------------------
+
+    def gather(self, name: str, keys: Iterable[str]) -> np.ndarray:
+        """Return the ``name`` rows for ``keys`` (in order) as one float32 matrix."""
+        keys = list(keys)
+        out = np.empty((len(keys), self.arrays[name]), dtype=np.float32)
+
+        by_shard: Dict[int, Tuple[List[int], List[int]]] = {}
+        for i, key in enumerate(keys):
+            pos, row, _ = self._entries[key]
+            dst, src = by_shard.setdefault(pos, ([], []))
+            dst.append(i)
+            src.append(row)
+
+        for pos, (dst, src) in by_shard.items():
+            mm = np.load(self._array_path(self.shards[pos], name), mmap_mode="r")
+            out[dst] = mm[np.asarray(src)]
+            del mm
+        return out
+
+    def rows(self, name: str, keys: Sequence[str]) -> "StoredRows":
+        """Lazy (len(keys), dim) view of the ``name`` rows for ``keys``."""
+        return StoredRows(self, name, list(keys))
+
+
+class StoredRows:
+    """Array-like (n, dim) view over one store array; rows are read from disk when indexed.
+
+    ``view[a:b]`` is another view, ``view[ids]`` / ``np.asarray(view)`` gather
+    float32 rows, and ``chunks`` streams the rows in order.
+    """
+
+    def __init__(self, store: EmbeddingStore, name: str, keys: List[str]):
+        self.store, self.name, self.keys = store, name, keys
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self.keys), self.store.arrays[self.name]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return StoredRows(self.store, self.name, self.keys[idx])
+        return self.store.gather(self.name, [self.keys[i] for i in np.asarray(idx).ravel()])
+
+    def __array__(self, dtype=None, copy=None):
+        out = self.store.gather(self.name, self.keys)
+        return out if dtype is None else out.astype(dtype, copy=False)
+
+    def chunks(self, size: int):
+        """(start, float32 rows) pairs of at most ``size`` rows, in order."""
+        for start in range(0, len(self.keys), size):
+            yield start, self.store.gather(self.name, self.keys[start:start + size])
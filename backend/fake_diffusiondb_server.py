@@ -0,0 +1,129 @@
+"""Local HTTP server serving fake DiffusionDB parts, for testing download.py.
+
+    python fake_diffusiondb_server.py --parts 20 --port 8765 --drop-rate 0.3
+    python download.py -i 1 -r 21 -z --base-url http://localhost:8765/
+
+Serves ``images/part-XXXXXX.zip`` for parts 1..N, each holding a few random
+"images" and a ``part-XXXXXX.json`` metadata file in DiffusionDB's format.
+Supports HEAD, single ``Range`` requests and ``If-Range``. The ETag is the
+part's sha256, as the ``X-Linked-ETag`` from Hugging Face is. ``--drop-rate``
+cuts that fraction of responses off halfway, to exercise resume.
+``--throttle`` limits bytes/s per response, so downloads overlap with
+extraction.
+"""
+import argparse
+import hashlib
+import io
+import json
+import random
+import re
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SAMPLERS = ["k_euler_a", "k_euler", "k_lms", "ddim", "plms", "k_dpm_2_a"]
+_PART = re.compile(r"^/(?:images|diffusiondb-large-part-[12])/part-(\d{6})\.zip$")
+
+
+def make_part(idx: int, images: int, image_bytes: int) -> bytes:
+    rng = random.Random(idx)
+    buf = io.BytesIO()
+    meta = {}
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:
+        for i in range(images):
+            name = f"{idx:06}-{i:04}.png"
+            zf.writestr(name, rng.randbytes(image_bytes))
+            meta[name] = {"p": f"fake prompt {rng.randrange(images // 2 + 1)}", "se": rng.randrange(2**32),
+                          "c": rng.choice([5.0, 7.0, 7.5, 9.0]), "st": rng.choice([20, 30, 50]),
+                          "sa": rng.choice(SAMPLERS)}
+        zf.writestr(f"part-{idx:06}.json", json.dumps(meta))
+    return buf.getvalue()
+
+
+class PartHandler(BaseHTTPRequestHandler):
+    parts = {}                       # idx → (bytes, sha256)
+    drop_rate = 0.0
+    throttle = 0
+
+    def _part(self):
+        m = _PART.match(self.path.split("?")[0])
+        return self.parts.get(int(m.group(1))) if m else None
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        part = self._part()
+        if part is None:
+            self.send_error(404)
+            return
+        data, sha = part
+        etag = f'"{sha}"'
+        start, end, status = 0, len(data) - 1, 200
+
+        rng_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if rng_header and (if_range is None or if_range == etag):
+            m = re.match(r"bytes=(\d+)-(\d*)$", rng_header)
+            if m:
+                start = int(m.group(1))
+                end = min(int(m.group(2)), len(data) - 1) if m.group(2) else len(data) - 1
+                if start >= len(data):
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{len(data)}")
+                    self.end_headers()
+                    return
+                status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", etag)
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        self.end_headers()
+        if not body:
+            return
+
+        payload = data[start:end + 1]
+        if random.random() < self.drop_rate:
+            payload = payload[: len(payload) // 2]          # then hang up mid-transfer
+            self.close_connection = True
+        step = 64 * 1024
+        for off in range(0, len(payload), step):
+            self.wfile.write(payload[off:off + step])
+            if self.throttle:
+                time.sleep(step / self.throttle)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--parts", type=int, default=20)
+    parser.add_argument("--images", type=int, default=50, help="Images per part")
+    parser.add_argument("--image-bytes", type=int, default=64 * 1024)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--throttle", type=int, default=0, help="Bytes/s per response (0 = unlimited)")
+    parser.add_argument("--write-checksums", help="Also write a sha256sum-style file for --checksums")
+    args = parser.parse_args()
+
+    for idx in range(1, args.parts + 1):
+        data = make_part(idx, args.images, args.image_bytes)
+        PartHandler.parts[idx] = (data, hashlib.sha256(data).hexdigest())
+    PartHandler.drop_rate = args.drop_rate
+    PartHandler.throttle = args.throttle
+    if args.write_checksums:
+        with open(args.write_checksums, "w", encoding="utf-8") as fp:
+            for idx, (_, sha) in sorted(PartHandler.parts.items()):
+                fp.write(f"{sha}  part-{idx:06}.zip\n")
+
+    print(f"🧪 Serving {args.parts} fake parts on http://localhost:{args.port}/")
+    ThreadingHTTPServer(("", args.port), PartHandler).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
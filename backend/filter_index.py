@@ -0,0 +1,145 @@
+"""Metadata filters (sampler / cfg / steps / seed) applied inside the FAISS search.
+
+At build time ``write_filter_index`` derives, from the metadata store:
+
+    filters/sampler.ids.npy       row ids grouped by sampler code (CSR postings)
+    filters/sampler.offsets.npy   (n_codes+1,) offsets into sampler.ids
+    filters/<col>.order.npy       row ids sorted by <col>   (cfg, steps, seed)
+    filters/<col>.sorted.npy      <col> values in that order, for searchsorted
+
+At query time ``FilterIndex.mask`` turns a filter dict such as
+``{"sampler": "k_euler_a", "cfg_min": 7}`` into a boolean row mask using only
+slices of those arrays, and ``search_params`` wraps it in an
+``IDSelectorBitmap`` so filtering happens inside ``index.search`` and a full
+top-k comes back whenever at least k rows match.
+"""
+import math
+import os
+from typing import Dict, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from index_factory import index_kind
+
+FILTER_DIR = "filters"
+RANGE_COLUMNS = ("cfg", "steps", "seed")
+FILTER_KEYS = ("sampler", "seed", "cfg_min", "cfg_max", "steps_min", "steps_max")
+MAX_EF_SEARCH = 4096
+
+
+# ------------------------------------------------------------------
+#  Build
+# ------------------------------------------------------------------
+
+def write_filter_index(meta_dir: str):
+    """Precompute sampler postings and sorted numeric columns next to the metadata store."""
+    out = os.path.join(meta_dir, FILTER_DIR)
+    os.makedirs(out, exist_ok=True)
+
+    codes = np.load(os.path.join(meta_dir, "sampler.codes.npy"))
+    ids = np.argsort(codes, kind="stable").astype(np.int64)
+    offsets = np.zeros(int(codes.max(initial=-1)) + 2, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=len(offsets) - 1), out=offsets[1:])
+    np.save(os.path.join(out, "sampler.ids.npy"), ids)
+    np.save(os.path.join(out, "sampler.offsets.npy"), offsets)
+
+    for col in RANGE_COLUMNS:
+        values = np.load(os.path.join(meta_dir, f"{col}.npy"))
+        order = np.argsort(values, kind="stable").astype(np.int64)
+        np.save(os.path.join(out, f"{col}.order.npy"), order)
+        np.save(os.path.join(out, f"{col}.sorted.npy"), values[order])
+
+
+# ------------------------------------------------------------------
+#  Query
+# ------------------------------------------------------------------
+
+class FilterIndex:
+    """Memory-mapped filter structures for one metadata store."""
+
+    def __init__(self, meta_dir: str, sampler_values):
+        root = os.path.join(meta_dir, FILTER_DIR)
+        self.sampler_ids = np.load(os.path.join(root, "sampler.ids.npy"), mmap_mode="r")
+        self.sampler_offsets = np.load(os.path.join(root, "sampler.offsets.npy"), mmap_mode="r")
+        self.sampler_codes = {sampler_values[c]: c for c in range(len(sampler_values))}
+        self.order = {c: np.load(os.path.join(root, f"{c}.order.npy"), mmap_mode="r") for c in RANGE_COLUMNS}
+        self.sorted = {c: np.load(os.path.join(root, f"{c}.sorted.npy"), mmap_mode="r") for c in RANGE_COLUMNS}
+        self.rows = len(self.sampler_ids)
+
+    @staticmethod
+    def exists(meta_dir: str) -> bool:
+        return os.path.exists(os.path.join(meta_dir, FILTER_DIR, "sampler.offsets.npy"))
+
+    def _range_ids(self, col: str, lo=None, hi=None) -> np.ndarray:
+        sorted_vals = self.sorted[col]
+        start = 0 if lo is None else int(np.searchsorted(sorted_vals, lo, side="left"))
+        end = len(sorted_vals) if hi is None else int(np.searchsorted(sorted_vals, hi, side="right"))
+        return self.order[col][start:end]
+
+    def _sampler_ids(self, samplers) -> np.ndarray:
+        if isinstance(samplers, str):
+            samplers = [samplers]
+        parts = []
+        for name in samplers:
+            code = self.sampler_codes.get(name)
+            if code is not None:
+                parts.append(self.sampler_ids[self.sampler_offsets[code]:self.sampler_offsets[code + 1]])
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def mask(self, filters: Optional[Dict]) -> Optional[np.ndarray]:
+        """Boolean (rows,) mask of rows matching every filter, or None when unfiltered."""
+        if not filters:
+            return None
+        unknown = set(filters) - set(FILTER_KEYS)
+        if unknown:
+            raise ValueError(f"unknown filter(s) {sorted(unknown)}; expected {', '.join(FILTER_KEYS)}")
+
+        id_sets = []
+        if filters.get("sampler") is not None:
+            id_sets.append(self._sampler_ids(filters["sampler"]))
+        if filters.get("seed") is not None:
+            seed = int(filters["seed"])
+            id_sets.append(self._range_ids("seed", seed, seed))
+        for col in ("cfg", "steps"):
+            lo, hi = filters.get(f"{col}_min"), filters.get(f"{col}_max")
+            if lo is not None or hi is not None:
+                id_sets.append(self._range_ids(col, None if lo is None else float(lo), None if hi is None else float(hi)))
+        if not id_sets:
+            return None
+
+        # start from the most selective constraint
+        id_sets.sort(key=len)
+        mask = np.zeros(self.rows, dtype=bool)
+        mask[id_sets[0]] = True
+        for ids in id_sets[1:]:
+            keep = np.zeros(self.rows, dtype=bool)
+            keep[ids] = True
+            mask &= keep
+        return mask
+
+
+def search_params(index: faiss.Index, mask: np.ndarray) -> Tuple[faiss.SearchParameters, tuple]:
+    """SearchParameters restricting ``index`` to ``mask``.
+
+    The index's own nprobe / efSearch are carried over and widened by the
+    inverse of the filter's selectivity, so selective filters still fill k.
+    The second value holds the bitmap and selector; keep it referenced until
+    the search returns.
+    """
+    bits = np.packbits(mask, bitorder="little")
+    sel = faiss.IDSelectorBitmap(len(bits), faiss.swig_ptr(bits))
+    selectivity = max(mask.mean(), 1e-9) if len(mask) else 1.0
+
+    kind = index_kind(index)
+    if kind == "ivf":
+        ivf = faiss.extract_index_ivf(index)
+        nprobe = min(ivf.nlist, int(math.ceil(ivf.nprobe / selectivity)))
+        params = faiss.SearchParametersIVF(sel=sel, nprobe=nprobe)
+    elif kind == "hnsw":
+        base = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexPreTransform) else index
+        ef = min(MAX_EF_SEARCH, int(math.ceil(base.hnsw.efSearch / selectivity)))
+        params = faiss.SearchParametersHNSW(sel=sel, efSearch=ef)
+    else:
+        params = faiss.SearchParameters(sel=sel)
+    return params, (bits, sel)
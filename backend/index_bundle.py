@@ -0,0 +1,259 @@
+"""Versioned index directories and the immutable bundle the searcher swaps atomically.
+
+Layout under data/embedded_subset/:
+
+    versions/<YYYYmmdd-HHMMSS>/   one complete build (indexes, metadata/, params)
+    CURRENT                       name of the version the server should serve
+
+``build_faiss_index.py`` writes a new version directory and publishes it by
+rewriting CURRENT (write + rename, so readers never see a partial file).
+A directory without CURRENT is served as-is, as before.
+
+``IndexBundle`` is everything loaded from one version: FAISS indexes,
+metadata, filters and prompt groups, checked for consistent sizes.
+``ImageSearcher.reload`` loads a new bundle next to the live one and swaps
+a single reference; in-flight queries keep using the bundle they started
+with, and its memory is released once the last one returns.  Sharded
+builds (``shards.json``) get their own pool of shard worker processes,
+stopped when the bundle is released.
+
+    python index_bundle.py list
+    python index_bundle.py publish 20240101-120000      # roll forward / back
+"""
+import argparse
+import os
+import pickle
+import shutil
+import threading
+import weakref
+from datetime import datetime
+from typing import Callable, List, Optional
+
+from index_factory import apply_search_params, index_kind, load_params, read_index
+from metadata_store import MetadataStore, LegacyMetadata, PromptGroups
+from filter_index import FilterIndex
+import rerank
+import shards
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+INDEX_ROOT = os.path.join(SCRIPT_DIR, "data", "embedded_subset")
+VERSIONS_DIR = "versions"
+CURRENT_FILE = "CURRENT"
+
+
+class IndexMismatch(ValueError):
+    """Indexes and metadata of one version disagree on their sizes."""
+
+
+# ------------------------------------------------------------------
+#  Versions
+# ------------------------------------------------------------------
+
+def current_version(root: str = INDEX_ROOT) -> Optional[str]:
+    try:
+        with open(os.path.join(root, CURRENT_FILE), encoding="utf-8") as fp:
+            return fp.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def resolve_index_dir(root: str = INDEX_ROOT) -> str:
+    """Directory of the published version, or ``root`` itself for the unversioned layout."""
+    version = current_version(root)
+    return os.path.join(root, VERSIONS_DIR, version) if version else root
+
+
+def list_versions(root: str = INDEX_ROOT) -> List[str]:
+    base = os.path.join(root, VERSIONS_DIR)
+    return sorted(os.listdir(base)) if os.path.isdir(base) else []
+
+
+def new_version_dir(root: str = INDEX_ROOT) -> str:
+    path = os.path.join(root, VERSIONS_DIR, datetime.now().strftime("%Y%m%d-%H%M%S"))
+    os.makedirs(path)
+    return path
+
+
+def publish(root: str, version: str):
+    """Point CURRENT at ``version`` atomically."""
+    if not os.path.isdir(os.path.join(root, VERSIONS_DIR, version)):
+        raise FileNotFoundError(f"no version {version!r} under {root}")
+    tmp = os.path.join(root, CURRENT_FILE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as fp:
+        fp.write(version + "\n")
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp, os.path.join(root, CURRENT_FILE))
+
+
+def prune_versions(root: str, keep: int):
+    """Delete all but the newest ``keep`` versions, never the current one.
+
+    Servers still holding a deleted version keep their open / mapped files
+    until they reload.
+    """
+    current = current_version(root)
+    for version in list_versions(root)[:-keep] if keep > 0 else []:
+        if version != current:
+            shutil.rmtree(os.path.join(root, VERSIONS_DIR, version), ignore_errors=True)
+
+
+# ------------------------------------------------------------------
+#  Bundle
+# ------------------------------------------------------------------
+
+def _describe(index) -> str:
+    return index.kind if isinstance(index, shards.ShardedIndex) else index_kind(index)
+
+
+class IndexBundle:
+    """Indexes + metadata of one version; never mutated after construction except search knobs."""
+
+    def __init__(self, index_dir: str, mmap: bool = True, nprobe: Optional[int] = None,
+                 ef_search: Optional[int] = None, shard_workers: Optional[int] = None,
+                 shard_addresses: Optional[List[str]] = None):
+        self.index_dir = index_dir
+        self.version = os.path.basename(os.path.normpath(index_dir))
+        img_index_path = os.path.join(index_dir, "image_index.faiss")
+        txt_index_path = os.path.join(index_dir, "prompt_index.faiss")
+        meta_path = os.path.join(index_dir, "prompt_metadata.pkl")
+        meta_store_dir = os.path.join(index_dir, "metadata")
+        self.index_paths = [img_index_path, txt_index_path]
+
+        print(f"Loading FAISS indexes from {index_dir}{' (mmap)' if mmap else ''} …")
+        self.shard_pool = None
+        self.coarse_index = self.image_vectors = None
+        if shards.exists(index_dir):
+            # every index split into row ranges, served by worker processes
+            self.shard_pool = shards.ShardPool(index_dir, workers=shard_workers, mmap=mmap,
+                                              addresses=shard_addresses)
+            weakref.finalize(self, self.shard_pool.close)
+            self.index_paths = [os.path.join(index_dir, shards.MANIFEST_FILE)]
+            self.image_index = shards.ShardedIndex(self.shard_pool, "image_index")
+            self.prompt_index = shards.ShardedIndex(self.shard_pool, "prompt_index")
+            if "image_coarse_index" in self.shard_pool.manifest and os.path.exists(
+                    os.path.join(index_dir, rerank.VECTORS_FILE)):
+                self.coarse_index = shards.ShardedIndex(self.shard_pool, "image_coarse_index")
+                self.image_vectors = rerank.load_vectors(index_dir, mmap=mmap)
+        else:
+            self.image_index = read_index(img_index_path, mmap=mmap)
+            self.prompt_index = read_index(txt_index_path, mmap=mmap)
+            # optional two-stage image search: coarse 768-d index + exact 1536-d rescoring
+            if rerank.exists(index_dir):
+                self.coarse_index = read_index(os.path.join(index_dir, rerank.COARSE_INDEX_FILE), mmap=mmap)
+                self.image_vectors = rerank.load_vectors(index_dir, mmap=mmap)
+                self.index_paths.append(os.path.join(index_dir, rerank.COARSE_INDEX_FILE))
+        print(f"   image_index  : {self.image_index.ntotal:,} × {self.image_index.d} ({_describe(self.image_index)})")
+        print(f"   prompt_index : {self.prompt_index.ntotal:,} × {self.prompt_index.d} ({_describe(self.prompt_index)})")
+        if self.coarse_index is not None:
+            print(f"   coarse_index : {self.coarse_index.ntotal:,} × {self.coarse_index.d} ({_describe(self.coarse_index)})")
+
+        # search-time knobs: persisted build values, overridden by the caller
+        self.index_params = load_params(index_dir)
+        self.set_search_params(nprobe, ef_search)
+
+        # memory-mapped column store; pickle only for index dirs built before it
+        if MetadataStore.exists(meta_store_dir):
+            self.metadata = MetadataStore(meta_store_dir)
+            self.index_paths.append(os.path.join(meta_store_dir, "meta.json"))
+        else:
+            with open(meta_path, "rb") as fp:
+                self.metadata = LegacyMetadata(pickle.load(fp))
+            self.index_paths.append(meta_path)
+
+        # precomputed sampler / cfg / steps / seed filters (built with the store)
+        self.filters = None
+        if MetadataStore.exists(meta_store_dir) and FilterIndex.exists(meta_store_dir):
+            self.filters = FilterIndex(meta_store_dir, self.metadata.columns["sampler"].values)
+        print(f"Loaded {len(self.metadata):,} metadata rows")
+
+        # prompt_index rows are distinct prompts; older builds have one row per image
+        self.prompt_groups = PromptGroups(meta_store_dir) if PromptGroups.exists(meta_store_dir) else None
+        if self.prompt_groups is not None:
+            print(f"Loaded {len(self.prompt_groups):,} distinct prompts")
+        self._check_sizes()
+
+    def _check_sizes(self):
+        n = len(self.metadata)
+        n_prompts = len(self.prompt_groups) if self.prompt_groups is not None else n
+        if self.image_index.ntotal != n:
+            raise IndexMismatch(f"image_index has {self.image_index.ntotal:,} rows, metadata {n:,}")
+        if self.prompt_index.ntotal != n_prompts:
+            raise IndexMismatch(f"prompt_index has {self.prompt_index.ntotal:,} rows, expected {n_prompts:,}")
+        if self.coarse_index is not None and not self.coarse_index.ntotal == len(self.image_vectors) == n:
+            raise IndexMismatch(f"coarse index / image vectors have {self.coarse_index.ntotal:,} / "
+                                f"{len(self.image_vectors):,} rows, metadata {n:,}")
+        if self.filters is not None and self.filters.rows != n:
+            raise IndexMismatch(f"filters cover {self.filters.rows:,} rows, metadata {n:,}")
+
+    _PARAM_KEYS = {"image_index": "image_index", "prompt_index": "prompt_index", "coarse_index": "image_coarse_index"}
+
+    def set_search_params(self, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+        """Apply nprobe / efSearch to every index; None keeps the persisted build value."""
+        for attr, key in self._PARAM_KEYS.items():
+            index = getattr(self, attr)
+            if index is None:
+                continue
+            saved = self.index_params.get(key, {})
+            nprobe_ = nprobe if nprobe is not None else saved.get("nprobe")
+            ef_search_ = ef_search if ef_search is not None else saved.get("efSearch")
+            if isinstance(index, shards.ShardedIndex):
+                applied = index.set_search_params(nprobe_, ef_search_)
+            else:
+                applied = apply_search_params(index, nprobe=nprobe_, ef_search=ef_search_)
+            if applied:
+                print(f"   {attr} search params: {applied}")
+
+
+# ------------------------------------------------------------------
+#  Watcher
+# ------------------------------------------------------------------
+
+class CurrentWatcher:
+    """Poll CURRENT every ``interval`` seconds and call ``on_change(version)`` when it moves."""
+
+    def __init__(self, root: str, on_change: Callable[[str], None], interval: float = 5.0):
+        self.root = root
+        self.on_change = on_change
+        self.interval = interval
+        self._seen = current_version(root)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="index-watcher", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            version = current_version(self.root)
+            if version and version != self._seen:
+                self._seen = version
+                try:
+                    self.on_change(version)
+                except Exception as e:
+                    # keep serving the old version until CURRENT moves again
+                    print(f"❌ Reload of {version} failed: {e}")
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List or publish index versions")
+    parser.add_argument("--root", default=INDEX_ROOT)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("list")
+    pub = sub.add_parser("publish")
+    pub.add_argument("version")
+    args = parser.parse_args()
+
+    if args.cmd == "list":
+        current = current_version(args.root)
+        for version in list_versions(args.root):
+            print(f"{'*' if version == current else ' '} {version}")
+    else:
+        publish(args.root, args.version)
+        print(f"✅ CURRENT → {args.version}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""FAISS index factory shared by build_faiss_index.py and search.py.
+
+Supported index types (all inner-product, vectors are L2-normalised):
+
+    flat        exact brute-force scan (the original behaviour)
+    ivf_flat    inverted file, uncompressed vectors
+    ivf_pq      inverted file, product-quantised vectors
+    hnsw        HNSW graph over uncompressed vectors
+    opq_ivf_pq  OPQ rotation + IVF-PQ
+
+Search-time knobs (nprobe / efSearch) are persisted next to the indexes in
+``index_params.json`` so the server picks up whatever the build chose.
+"""
+import json
+import math
+import os
+from typing import Dict, Optional
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw", "opq_ivf_pq")
+PARAMS_FILENAME = "index_params.json"
+
+DEFAULT_NPROBE = 16
+DEFAULT_EF_SEARCH = 64
+DEFAULT_HNSW_M = 32
+MIN_POINTS_PER_CENTROID = 39        # below this FAISS k-means complains
+PQ_CENTROIDS = 256                  # 8-bit PQ codes
+
+
+# ------------------------------------------------------------------
+#  Construction
+# ------------------------------------------------------------------
+
+def _default_nlist(n: int) -> int:
+    """~4·√n lists, capped so every list still gets enough training points."""
+    nlist = int(4 * math.sqrt(max(n, 1)))
+    return max(1, min(nlist, n // MIN_POINTS_PER_CENTROID))
+
+
+def _default_pq_m(d: int) -> int:
+    """16 dims per sub-quantiser, rounded down to a divisor of ``d``."""
+    m = max(1, d // 16)
+    while d % m:
+        m -= 1
+    return m
+
+
+def factory_string(index_type: str, d: int, n: int, nlist: Optional[int] = None,
+                   pq_m: Optional[int] = None, hnsw_m: int = DEFAULT_HNSW_M) -> str:
+    """Return the ``faiss.index_factory`` description for ``index_type``."""
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r} (expected one of {', '.join(INDEX_TYPES)})")
+
+    nlist = nlist or _default_nlist(n)
+    pq_m = pq_m or _default_pq_m(d)
+    if d % pq_m:
+        raise ValueError(f"pq_m={pq_m} must divide the vector dimension {d}")
+
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "ivf_flat":
+        return f"IVF{nlist},Flat"
+    if index_type == "ivf_pq":
+        return f"IVF{nlist},PQ{pq_m}"
+    if index_type == "hnsw":
+        return f"HNSW{hnsw_m},Flat"
+    return f"OPQ{pq_m},IVF{nlist},PQ{pq_m}"
+
+
+def min_train_size(index_type: str, n: int, nlist: Optional[int] = None) -> int:
+    """Smallest number of training vectors that gives sane k-means."""
+    if index_type in ("flat", "hnsw"):
+        return 0
+    need = (nlist or _default_nlist(n)) * MIN_POINTS_PER_CENTROID
+    if index_type in ("ivf_pq", "opq_ivf_pq"):
+        need = max(need, PQ_CENTROIDS * MIN_POINTS_PER_CENTROID)
+    return need
+
+
+def make_index(index_type: str, d: int, n: int, **opts) -> faiss.Index:
+    """Create an *untrained* inner-product index for ``n`` vectors of dim ``d``.
+
+    Falls back to ``flat`` when the corpus is too small to train ``index_type``.
+    """
+    if n < min_train_size(index_type, n, opts.get("nlist")):
+        print(f"⚠️  {n:,} vectors is too few to train {index_type}; using flat")
+        index_type = "flat"
+    desc = factory_string(index_type, d, n, **opts)
+    print(f"   index factory  : {desc} (d={d})")
+    return faiss.index_factory(d, desc, faiss.METRIC_INNER_PRODUCT)
+
+
+def train_index(index: faiss.Index, vectors: np.ndarray, train_size: int, seed: int = 1234):
+    """Train ``index`` on a random sample of at most ``train_size`` rows."""
+    if index.is_trained:
+        return
+    rng = np.random.default_rng(seed)
+    n = vectors.shape[0]
+    if n > train_size:
+        sample = vectors[np.sort(rng.choice(n, train_size, replace=False))]
+    else:
+        sample = vectors
+    print(f"   training on {len(sample):,} / {n:,} vectors …")
+    index.train(np.ascontiguousarray(sample, dtype=np.float32))
+
+
+def read_index(path: str, mmap: bool = False) -> faiss.Index:
+    """Load an index, optionally memory-mapped and read-only.
+
+    With ``mmap`` IVF inverted lists are mapped straight from the file, and
+    flat codes too on FAISS builds that support ``IO_FLAG_MMAP_IFC``, so
+    server processes on one host share page-cache pages instead of each
+    holding a private copy.
+    """
+    if not mmap:
+        return faiss.read_index(path, 0)
+    flags = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_READ_ONLY", 0)
+    ifc = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    if ifc:
+        try:
+            return faiss.read_index(path, flags | ifc)
+        except RuntimeError:
+            pass                # IVF: MMAP_IFC's reader cannot map inverted lists; MMAP alone can
+    return faiss.read_index(path, flags)
+
+
+# ------------------------------------------------------------------
+#  Search-time parameters
+# ------------------------------------------------------------------
+
+def index_kind(index: faiss.Index) -> str:
+    """Best-effort description of an index loaded from disk."""
+    base = index
+    if isinstance(base, faiss.IndexPreTransform):
+        base = faiss.downcast_index(base.index)
+    if faiss.try_extract_index_ivf(base) is not None:
+        return "ivf"
+    if isinstance(base, faiss.IndexHNSW):
+        return "hnsw"
+    return "flat"
+
+
+def apply_search_params(index: faiss.Index, nprobe: Optional[int] = None,
+                        ef_search: Optional[int] = None) -> Dict[str, int]:
+    """Set nprobe / efSearch on ``index`` where they apply; returns what was set."""
+    index = faiss.downcast_index(index)
+    kind = index_kind(index)
+    ps = faiss.ParameterSpace()
+    applied = {}
+    if kind == "ivf" and nprobe is not None:
+        ps.set_index_parameter(index, "nprobe", int(nprobe))
+        applied["nprobe"] = int(nprobe)
+    if kind == "hnsw" and ef_search is not None:
+        ps.set_index_parameter(index, "efSearch", int(ef_search))
+        applied["efSearch"] = int(ef_search)
+    return applied
+
+
+def save_params(save_dir: str, params: Dict[str, Dict]):
+    with open(os.path.join(save_dir, PARAMS_FILENAME), "w", encoding="utf-8") as fp:
+        json.dump(params, fp, indent=2)
+
+
+def load_params(save_dir: str) -> Dict[str, Dict]:
+    path = os.path.join(save_dir, PARAMS_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as fp:
+        return json.load(fp)
+
+
+# ------------------------------------------------------------------
+#  Recall
+# ------------------------------------------------------------------
+
+def exact_knn(xb: np.ndarray, xq: np.ndarray, k: int, chunk: int = 262_144):
+    """Exact inner-product top-k of ``xq`` against ``xb``, scanning ``xb`` in chunks."""
+    best_d = np.full((len(xq), 0), -np.inf, dtype=np.float32)
+    best_i = np.empty((len(xq), 0), dtype=np.int64)
+    for start in range(0, xb.shape[0], chunk):
+        block = np.ascontiguousarray(xb[start:start + chunk], dtype=np.float32)
+        flat = faiss.IndexFlatIP(block.shape[1])
+        flat.add(block)
+        d, i = flat.search(xq, min(k, len(block)))
+        best_d = np.hstack([best_d, d])
+        best_i = np.hstack([best_i, i + start])
+        if best_d.shape[1] > k:
+            top = np.argsort(-best_d, axis=1)[:, :k]
+            best_d = np.take_along_axis(best_d, top, axis=1)
+            best_i = np.take_along_axis(best_i, top, axis=1)
+    return best_d, best_i
+
+
+def recall_at_k(index: faiss.Index, xb: np.ndarray, k: int = 10, n_queries: int = 1000,
+                seed: int = 4321) -> float:
+    """Recall k@k of ``index`` against an exact scan, using corpus rows as queries."""
+    n = xb.shape[0]
+    if n == 0:
+        return 1.0
+    k = min(k, n)
+    rng = np.random.default_rng(seed)
+    q_ids = np.sort(rng.choice(n, min(n_queries, n), replace=False))
+    xq = np.ascontiguousarray(xb[q_ids], dtype=np.float32)
+
+    _, gt = exact_knn(xb, xq, k)
+    _, approx = index.search(xq, k)
+    hits = sum(len(np.intersect1d(g, a)) for g, a in zip(gt, approx))
+    return hits / float(gt.size)
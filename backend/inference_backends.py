@@ -0,0 +1,92 @@
+"""Selectable inference backends for the CLIP vision tower + projection.
+
+Every backend maps preprocessed ``pixel_values`` to the L2-normalised
+(stacked1536, final768) numpy pair used by the indexes:
+
+    fp32   the reference PyTorch model
+    bf16   PyTorch in bfloat16 (fast on CPUs with AVX512-BF16 / AMX, and on GPU)
+    int8   dynamic int8 quantisation of every nn.Linear (CPU only)
+    onnx   exported vision+projection graph run by ONNX Runtime
+
+Use check_backend_parity.py to measure cosine drift and top-k overlap
+against fp32 before switching a deployment.
+"""
+import copy
+import os
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+import torch
+from torch import nn
+
+from clip_features import StackedVisionEncoder
+
+BACKENDS = ("fp32", "bf16", "int8", "onnx")
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+ONNX_PATH = os.path.join(SCRIPT_DIR, "data", "onnx", "clip_vision_stacked.onnx")
+ONNX_OPSET = 14
+
+EmbedFn = Callable[[torch.Tensor], Tuple[np.ndarray, np.ndarray]]
+
+
+# ------------------------------------------------------------------
+#  Backends
+# ------------------------------------------------------------------
+
+def _torch_backend(encoder: nn.Module, device: torch.device, dtype: torch.dtype) -> EmbedFn:
+    def embed(pixel_values: torch.Tensor):
+        with torch.no_grad():
+            stacked, final = encoder(pixel_values.to(device=device, dtype=dtype))
+        return stacked.float().cpu().numpy(), final.float().cpu().numpy()
+    return embed
+
+
+def export_onnx(encoder: nn.Module, path: str = ONNX_PATH):
+    """Export the fp32 vision+projection graph with a dynamic batch axis."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    encoder = copy.deepcopy(encoder).float().cpu().eval()
+    dummy = torch.zeros(1, 3, 224, 224)
+    print(f"Exporting ONNX graph → {path} …")
+    with torch.no_grad():
+        torch.onnx.export(
+            encoder, (dummy,), path,
+            input_names=["pixel_values"],
+            output_names=["stacked", "final"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "stacked": {0: "batch"}, "final": {0: "batch"}},
+            opset_version=ONNX_OPSET,
+        )
+
+
+def _onnx_backend(encoder: nn.Module, path: str) -> EmbedFn:
+    try:
+        import onnxruntime as ort
+    except ImportError as e:
+        raise ImportError("the onnx backend needs `pip install onnx onnxruntime`") from e
+
+    if not os.path.exists(path):
+        export_onnx(encoder, path)
+    providers = [p for p in ("CUDAExecutionProvider", "CPUExecutionProvider") if p in ort.get_available_providers()]
+    session = ort.InferenceSession(path, providers=providers)
+
+    def embed(pixel_values: torch.Tensor):
+        stacked, final = session.run(None, {"pixel_values": pixel_values.cpu().numpy().astype(np.float32)})
+        return stacked, final
+    return embed
+
+
+def load_backend(model: nn.Module, backend: str, device: torch.device, onnx_path: Optional[str] = None) -> EmbedFn:
+    """Build the ``backend`` embed function from a loaded fp32 CLIP model."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r} (expected one of {', '.join(BACKENDS)})")
+    encoder = StackedVisionEncoder(model.vision_model, model.visual_projection).eval()
+
+    if backend == "fp32":
+        return _torch_backend(encoder, device, torch.float32)
+    if backend == "bf16":
+        return _torch_backend(copy.deepcopy(encoder).to(device=device, dtype=torch.bfloat16), device, torch.bfloat16)
+    if backend == "int8":
+        cpu = torch.device("cpu")
+        quantised = torch.quantization.quantize_dynamic(copy.deepcopy(encoder).to(cpu), {nn.Linear}, dtype=torch.qint8)
+        return _torch_backend(quantised, cpu, torch.float32)
+    return _onnx_backend(encoder, onnx_path or ONNX_PATH)
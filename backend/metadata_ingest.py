@@ -0,0 +1,230 @@
+"""Streaming DiffusionDB metadata ingestion into an on-disk keyed table (SQLite).
+
+``build_faiss_index.py`` used to ``json.load`` every part's metadata into
+one dict before embedding started.  Instead, ingestion streams sources into
+``data/metadata.sqlite``:
+
+  * ``part-XXXXXX.json`` files next to the images, one part at a time; each
+    file is ingested once and re-ingested only when its mtime / size change;
+  * or the official ``metadata.parquet`` (``--metadata-parquet``), read in
+    record batches with pyarrow.
+
+The build then walks the image files in part order and fetches metadata
+rows in part-sized chunks by primary key, so memory stays bounded by one
+part rather than the dataset.
+
+    python metadata_ingest.py [--parquet metadata.parquet]   # ingest only
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+from typing import Dict, Iterable, Iterator, List, Optional
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGES_DIR = os.path.join(SCRIPT_DIR, "data", "images")
+DB_PATH = os.path.join(SCRIPT_DIR, "data", "metadata.sqlite")
+IMAGE_EXTS = (".png", ".jpg", ".jpeg")
+PART_ROWS = 1000                     # images per DiffusionDB part; lookup chunk size
+PARQUET_BATCH_ROWS = 65_536
+SQL_MAX_VARS = 900                   # stay under SQLITE_MAX_VARIABLE_NUMBER
+
+# defaults for images without (complete) metadata, as the build always used
+DEFAULTS = {"prompt": "", "seed": None, "cfg": 7.5, "steps": 30, "sampler": "unknown"}
+
+# metadata.parquet stores samplers as ints; map them to the part-JSON names
+PARQUET_SAMPLERS = {1: "ddim", 2: "plms", 3: "k_euler", 4: "k_euler_a", 5: "k_heun",
+                    6: "k_dpm_2", 7: "k_dpm_2_a", 8: "k_lms", 9: "others"}
+
+_PART_JSON = re.compile(r"^part-(\d+)\.json$")
+_COLS = ("image_name", "prompt", "seed", "cfg", "steps", "sampler")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    image_name TEXT PRIMARY KEY,
+    part       INTEGER NOT NULL,
+    prompt     TEXT,
+    seed       INTEGER,
+    cfg        REAL,
+    steps      INTEGER,
+    sampler    TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS images_part ON images(part);
+CREATE TABLE IF NOT EXISTS sources (name TEXT PRIMARY KEY, fingerprint TEXT);
+CREATE TABLE IF NOT EXISTS files (image_name TEXT PRIMARY KEY) WITHOUT ROWID;
+"""
+
+
+def json_row(fn: str, md: dict) -> Dict:
+    """A metadata row from one entry of a part-XXXXXX.json file."""
+    return {
+        "image_name": fn,
+        "prompt": md.get("p", DEFAULTS["prompt"]),
+        "seed": md.get("se"),
+        "cfg": md.get("c", DEFAULTS["cfg"]),
+        "steps": md.get("st", DEFAULTS["steps"]),
+        "sampler": md.get("sa", DEFAULTS["sampler"]),
+    }
+
+
+class MetadataTable:
+    """image_name → metadata row, plus the set of image files currently on disk."""
+
+    def __init__(self, path: str = DB_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    # ------------------------------------------------------------------
+    #  Ingestion
+    # ------------------------------------------------------------------
+
+    def _insert(self, part: int, rows: Iterable[Dict]):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((r["image_name"], part, r["prompt"], r["seed"], r["cfg"], r["steps"], r["sampler"]) for r in rows))
+
+    def ingest_json_parts(self, images_dir: str = IMAGES_DIR) -> int:
+        """Ingest new or changed part-XXXXXX.json files, one transaction per part."""
+        seen = dict(self.db.execute("SELECT name, fingerprint FROM sources"))
+        n_parts = 0
+        for entry in sorted(os.scandir(images_dir), key=lambda e: e.name):
+            m = _PART_JSON.match(entry.name)
+            if not m:
+                continue
+            st = entry.stat()
+            fp = f"{st.st_mtime_ns}:{st.st_size}"
+            if seen.get(entry.name) == fp:
+                continue
+            with open(entry.path, "r", encoding="utf-8") as f:
+                part_meta = json.load(f)             # one part (~1000 rows) at a time
+            with self.db:
+                self._insert(int(m.group(1)), (json_row(fn, md) for fn, md in part_meta.items()))
+                self.db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?)", (entry.name, fp))
+            n_parts += 1
+        return n_parts
+
+    def ingest_parquet(self, path: str, batch_rows: int = PARQUET_BATCH_ROWS) -> int:
+        """Stream DiffusionDB's metadata.parquet in record batches."""
+        import pyarrow.parquet as pq
+
+        st = os.stat(path)
+        fp = f"{st.st_mtime_ns}:{st.st_size}"
+        name = os.path.basename(path)
+        if self.db.execute("SELECT fingerprint FROM sources WHERE name = ?", (name,)).fetchone() == (fp,):
+            return 0
+
+        pf = pq.ParquetFile(path)
+        cols = ["image_name", "part_id", "prompt", "seed", "cfg", "step", "sampler"]
+        n = 0
+        for batch in pf.iter_batches(batch_size=batch_rows, columns=cols):
+            b = batch.to_pydict()
+            rows = [(b["image_name"][i], int(b["part_id"][i]), b["prompt"][i] or "", b["seed"][i],
+                     b["cfg"][i], b["step"][i],
+                     PARQUET_SAMPLERS.get(b["sampler"][i], str(b["sampler"][i]))
+                     if not isinstance(b["sampler"][i], str) else b["sampler"][i])
+                    for i in range(batch.num_rows)]
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            n += batch.num_rows
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?)", (name, fp))
+        return n
+
+    def scan_files(self, images_dir: str = IMAGES_DIR, batch: int = 10_000) -> int:
+        """Record which image files exist on disk (replacing the previous scan)."""
+        with self.db:
+            self.db.execute("DELETE FROM files")
+            pending = []
+            for entry in os.scandir(images_dir):
+                if entry.name.lower().endswith(IMAGE_EXTS):
+                    pending.append((entry.name,))
+                    if len(pending) >= batch:
+                        self.db.executemany("INSERT INTO files VALUES (?)", pending)
+                        pending.clear()
+            self.db.executemany("INSERT INTO files VALUES (?)", pending)
+        return self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    # ------------------------------------------------------------------
+    #  Lookup
+    # ------------------------------------------------------------------
+
+    def iter_files(self) -> Iterator[str]:
+        """Image files on disk in part order; files without metadata come last."""
+        cur = self.db.execute(
+            "SELECT f.image_name FROM files f LEFT JOIN images i USING (image_name) "
+            "ORDER BY i.part IS NULL, i.part, f.image_name")
+        for (name,) in cur:
+            yield name
+
+    def get(self, names: List[str]) -> Dict[str, Dict]:
+        """Rows for ``names`` (missing names are simply absent)."""
+        out = {}
+        for start in range(0, len(names), SQL_MAX_VARS):
+            chunk = names[start:start + SQL_MAX_VARS]
+            cur = self.db.execute(
+                f"SELECT {', '.join(_COLS)} FROM images WHERE image_name IN ({', '.join('?' * len(chunk))})", chunk)
+            for rec in cur:
+                out[rec[0]] = dict(zip(_COLS, rec))
+        return out
+
+    def rows(self, names: List[str], chunk: int = PART_ROWS) -> "RowsView":
+        return RowsView(self, names, chunk)
+
+
+class RowsView:
+    """Re-iterable rows for ``names`` in order, fetched ``chunk`` keys at a time; defaults fill gaps."""
+
+    def __init__(self, table: MetadataTable, names: List[str], chunk: int = PART_ROWS):
+        self.table, self.names, self.chunk = table, names, chunk
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self) -> Iterator[Dict]:
+        for start in range(0, len(self.names), self.chunk):
+            names = self.names[start:start + self.chunk]
+            found = self.table.get(names)
+            for name in names:
+                row = found.get(name)
+                if row is None:
+                    row = {"image_name": name, **DEFAULTS}
+                else:
+                    row = {k: (DEFAULTS[k] if v is None and k != "seed" else v) for k, v in row.items()}
+                yield row
+
+
+def ingest(table: MetadataTable, images_dir: str = IMAGES_DIR, parquet: Optional[str] = None):
+    """Bring the table up to date with the parquet file (if given) and any part JSON files."""
+    if parquet:
+        n = table.ingest_parquet(parquet)
+        print(f"Ingested {n:,} rows from {os.path.basename(parquet)}" if n else "Parquet metadata up to date")
+    n_parts = table.ingest_json_parts(images_dir)
+    print(f"Ingested {n_parts:,} new/changed part JSON files → {len(table):,} metadata rows")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest DiffusionDB metadata into the build's SQLite table")
+    parser.add_argument("--images-dir", default=IMAGES_DIR)
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--parquet", default=None, help="DiffusionDB metadata.parquet")
+    args = parser.parse_args()
+
+    table = MetadataTable(args.db)
+    ingest(table, args.images_dir, args.parquet)
+    print(f"{table.scan_files(args.images_dir):,} image files on disk")
+    table.close()
+
+
+if __name__ == "__main__":
+    main()
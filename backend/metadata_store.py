@@ -0,0 +1,246 @@
+"""Columnar, memory-mappable metadata store (replaces prompt_metadata.pkl).
+
+Layout of the store directory::
+
+    meta.json                 {"rows": N, "columns": {name: kind}}
+    <num>.npy                 one fixed-width array per numeric column
+    <str>.offsets.npy         int64 (N+1,) byte offsets into <str>.bytes
+    <str>.bytes               UTF-8 blob of all values concatenated
+    <dict>.codes.npy          int32 (N,) codes into the <dict>.dict string table
+    <dict>.dict.offsets.npy   dictionary entries, stored like a "str" column
+    <dict>.dict.bytes
+
+Prompts and samplers repeat a lot in DiffusionDB, so they are dictionary
+encoded.  ``prompt_groups/`` maps each image to its distinct normalised
+prompt (the rows of prompt_index) and each prompt to its images.
+Everything is opened with ``mmap``: loading is O(1) in corpus
+size, several server processes on one host share the same page-cache pages,
+and ``rows()`` only touches the rows it is asked for.
+"""
+import json
+import os
+from typing import Dict, Iterable, List, Sequence
+
+import numpy as np
+
+META_FILE = "meta.json"
+GROUPS_DIR = "prompt_groups"
+
+# column -> (kind, dtype); seeds use -1 for "unknown"; cfg is float64 so
+# 7.3 reads back as 7.3 and range filters on it compare exactly
+COLUMNS = {
+    "image_name": ("str", None),
+    "prompt": ("dict", None),
+    "seed": ("num", np.int64),
+    "cfg": ("num", np.float64),
+    "steps": ("num", np.int32),
+    "sampler": ("dict", None),
+}
+MISSING_SEED = -1
+
+
+def _map_bytes(path: str) -> np.ndarray:
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode="r")
+
+
+class _StringColumn:
+    """Read-only view of a UTF-8 blob + offsets pair."""
+
+    def __init__(self, base: str):
+        self.offsets = np.load(base + ".offsets.npy", mmap_mode="r")
+        self.blob = _map_bytes(base + ".bytes")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.blob[start:end].tobytes().decode("utf-8")
+
+    def take(self, idxs: np.ndarray) -> List[str]:
+        return [self[i] for i in idxs]
+
+
+class _DictColumn:
+    """Dictionary-encoded strings: per-row codes into a small string table."""
+
+    def __init__(self, base: str):
+        self.codes = np.load(base + ".codes.npy", mmap_mode="r")
+        self.values = _StringColumn(base + ".dict")
+
+    def __getitem__(self, i: int) -> str:
+        return self.values[int(self.codes[i])]
+
+    def take(self, idxs: np.ndarray) -> List[str]:
+        codes = self.codes[idxs]
+        uniq, inverse = np.unique(codes, return_inverse=True)
+        decoded = [self.values[int(c)] for c in uniq]
+        return [decoded[j] for j in inverse]
+
+
+class MetadataStore:
+    """Row-addressable metadata backed by memory-mapped column files."""
+
+    def __init__(self, root: str):
+        self.root = root
+        with open(os.path.join(root, META_FILE), "r", encoding="utf-8") as fp:
+            meta = json.load(fp)
+        self.rows_total = meta["rows"]
+        self.columns = {}
+        for name, kind in meta["columns"].items():
+            base = os.path.join(root, name)
+            if kind == "str":
+                self.columns[name] = _StringColumn(base)
+            elif kind == "dict":
+                self.columns[name] = _DictColumn(base)
+            else:
+                self.columns[name] = np.load(base + ".npy", mmap_mode="r")
+
+    def __len__(self):
+        return self.rows_total
+
+    def __getitem__(self, idx: int) -> Dict:
+        idx = int(idx)
+        if idx < 0 or idx >= self.rows_total:
+            raise IndexError(idx)
+        return self.rows([idx])[0]
+
+    def rows(self, idxs: Sequence[int]) -> List[Dict]:
+        """Gather full rows for FAISS ids ``idxs`` (in order), touching only those rows."""
+        idxs = np.asarray(idxs, dtype=np.int64)
+        if len(idxs) == 0:
+            return []
+        cols = {}
+        for name, col in self.columns.items():
+            if not isinstance(col, np.ndarray):
+                cols[name] = col.take(idxs)
+            elif col.dtype == np.float32:
+                # stores written before cfg was float64: shortest repr, 7.3 not 7.300000190734863
+                cols[name] = [float(v) for v in col[idxs].astype(str)]
+            else:
+                cols[name] = col[idxs].tolist()
+        out = []
+        for j in range(len(idxs)):
+            row = {name: cols[name][j] for name in COLUMNS}
+            if row["seed"] == MISSING_SEED:
+                row["seed"] = None
+            out.append(row)
+        return out
+
+    @staticmethod
+    def exists(root: str) -> bool:
+        return os.path.exists(os.path.join(root, META_FILE))
+
+
+def normalise_prompt(prompt: str) -> str:
+    """Key for prompt dedup; CLIP's tokenizer lower-cases and collapses whitespace too."""
+    return " ".join((prompt or "").split()).lower()
+
+
+class PromptGroups:
+    """image → prompt id, and prompt id → image ids (CSR posting lists)."""
+
+    def __init__(self, root: str):
+        base = os.path.join(root, GROUPS_DIR)
+        self.prompt_of_image = np.load(os.path.join(base, "prompt_id.npy"), mmap_mode="r")
+        self.image_ids = np.load(os.path.join(base, "images.ids.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(base, "images.offsets.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def images(self, prompt_id: int) -> np.ndarray:
+        return self.image_ids[self.offsets[prompt_id]:self.offsets[prompt_id + 1]]
+
+    def prompt_mask(self, image_mask: np.ndarray) -> np.ndarray:
+        """Prompts with at least one image in ``image_mask``."""
+        mask = np.zeros(len(self), dtype=bool)
+        mask[self.prompt_of_image[image_mask]] = True
+        return mask
+
+    @staticmethod
+    def exists(root: str) -> bool:
+        return os.path.exists(os.path.join(root, GROUPS_DIR, "images.offsets.npy"))
+
+
+class LegacyMetadata(list):
+    """Pickled list-of-dicts metadata with the same ``rows()`` API as MetadataStore."""
+
+    def rows(self, idxs: Sequence[int]) -> List[Dict]:
+        return [self[int(i)] for i in idxs]
+
+
+# ------------------------------------------------------------------
+#  Writer
+# ------------------------------------------------------------------
+
+def _write_strings(base: str, values: Iterable[str]) -> int:
+    lengths = []
+    with open(base + ".bytes", "wb") as fp:
+        for v in values:
+            b = (v or "").encode("utf-8")
+            fp.write(b)
+            lengths.append(len(b))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    np.save(base + ".offsets.npy", offsets)
+    return len(lengths)
+
+
+def _write_dict(base: str, values: Iterable[str]) -> int:
+    table: Dict[str, int] = {}
+    codes = np.fromiter((table.setdefault(v or "", len(table)) for v in values), dtype=np.int32)
+    np.save(base + ".codes.npy", codes)
+    _write_strings(base + ".dict", table)
+    return len(codes)
+
+
+def write_metadata_store(root: str, rows: Iterable[Dict]):
+    """Write ``rows`` (dicts with the COLUMNS keys) as a memory-mappable store.
+
+    ``rows`` is iterated once per column, so it may be any re-iterable
+    (e.g. ``metadata_ingest.RowsView``) rather than a list in memory.
+    """
+    os.makedirs(root, exist_ok=True)
+    meta_path = os.path.join(root, META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    n_rows = None
+    for name, (kind, dtype) in COLUMNS.items():
+        base = os.path.join(root, name)
+        if kind == "str":
+            n = _write_strings(base, (r[name] for r in rows))
+        elif kind == "dict":
+            n = _write_dict(base, (r[name] for r in rows))
+        else:
+            if name == "seed":
+                values = (MISSING_SEED if r[name] is None else int(r[name]) for r in rows)
+            else:
+                values = (r[name] for r in rows)
+            arr = np.fromiter(values, dtype=dtype)
+            np.save(base + ".npy", arr)
+            n = len(arr)
+        if n_rows is not None and n != n_rows:
+            raise ValueError(f"column {name} has {n} rows, expected {n_rows}")
+        n_rows = n
+
+    # written last: a store without meta.json is incomplete
+    with open(meta_path, "w", encoding="utf-8") as fp:
+        json.dump({"rows": n_rows or 0, "columns": {n: k for n, (k, _) in COLUMNS.items()}}, fp)
+
+
+def write_prompt_groups(root: str, prompt_of_image: np.ndarray):
+    """Write the image → prompt id map and its inverted posting lists."""
+    base = os.path.join(root, GROUPS_DIR)
+    os.makedirs(base, exist_ok=True)
+    prompt_of_image = np.asarray(prompt_of_image, dtype=np.int64)
+    n_prompts = int(prompt_of_image.max(initial=-1)) + 1
+    offsets = np.zeros(n_prompts + 1, dtype=np.int64)
+    np.cumsum(np.bincount(prompt_of_image, minlength=n_prompts), out=offsets[1:])
+    np.save(os.path.join(base, "prompt_id.npy"), prompt_of_image)
+    np.save(os.path.join(base, "images.ids.npy"), np.argsort(prompt_of_image, kind="stable").astype(np.int64))
+    # written last: readers check for the offsets file
+    np.save(os.path.join(base, "images.offsets.npy"), offsets)
@@ -0,0 +1,295 @@
+"""Prometheus-style metrics and an opt-in sampling profiler for the search server.
+
+No client library: histograms and counters are a few lists behind a lock,
+rendered in the text exposition format by ``render()`` for ``GET /metrics``.
+
+    with metrics.stage("embed"):             # search_stage_seconds{stage="embed"}
+        ...
+
+While disabled (``SEARCH_METRICS=0``), ``stage()`` hands back one shared
+no-op context manager and the servers register no request hooks, so the
+instrumented code costs one attribute check per stage.  Values that
+already live elsewhere – cache hit counters, queue depths, index sizes,
+memory – are read by collectors at scrape time rather than on the hot
+path.
+
+``SamplingProfiler`` snapshots every thread's stack ``hz`` times a second
+and aggregates them as collapsed stacks (``frame;frame;frame count``, the
+input format of flamegraph.pl / speedscope).
+"""
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# seconds; covers ~1 ms FAISS searches up to multi-second cold CLIP passes
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+enabled = False
+
+
+def _fmt_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(value) -> str:
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# ------------------------------------------------------------------
+#  Metric types
+# ------------------------------------------------------------------
+
+class Histogram:
+    """Cumulative-bucket histogram per label combination."""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple, List] = {}        # labels → [bucket counts…, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        for labels, s in sorted(series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, s):
+                cumulative += n
+                le = 'le="%g"' % bound
+                yield f"{self.name}_bucket{_fmt_labels(self.labelnames, labels, le)} {cumulative}"
+            le = 'le="+Inf"'
+            yield f"{self.name}_bucket{_fmt_labels(self.labelnames, labels, le)} {s[-1]}"
+            yield f"{self.name}_sum{_fmt_labels(self.labelnames, labels)} {_num(s[-2])}"
+            yield f"{self.name}_count{_fmt_labels(self.labelnames, labels)} {s[-1]}"
+
+
+class Counter:
+    """Monotonic counter per label combination."""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = dict(self._values)
+        for labels, v in sorted(values.items()):
+            yield f"{self.name}{_fmt_labels(self.labelnames, labels)} {_num(v)}"
+
+
+class Collector:
+    """Samples computed at scrape time by ``fn() -> [(labels dict, value), …]``."""
+
+    def __init__(self, name: str, help: str, kind: str, fn: Callable[[], List[Tuple[Dict[str, str], float]]]):
+        self.name, self.help, self.kind, self.fn = name, help, kind, fn
+
+    def render(self) -> Iterable[str]:
+        try:
+            samples = self.fn()
+        except Exception:
+            return                          # a broken collector must not break /metrics
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for labels, value in samples:
+            yield f"{self.name}{_fmt_labels(list(labels), list(labels.values()))} {_num(value)}"
+
+
+# ------------------------------------------------------------------
+#  Registry
+# ------------------------------------------------------------------
+
+STAGE_SECONDS = Histogram("search_stage_seconds", "Time spent per search stage (per call; batched calls count once)",
+                          ("stage",))
+REQUEST_SECONDS = Histogram("http_request_seconds", "Request latency by route", ("route", "method"))
+REQUESTS = Counter("http_requests_total", "Requests by route and status code", ("route", "method", "status"))
+ERRORS = Counter("search_errors_total", "Failed searches by stage / reason", ("kind",))
+BATCH_SIZE = Histogram("batch_size", "Items per micro-batch", ("batcher",), buckets=BATCH_BUCKETS)
+
+_registry: List = [STAGE_SECONDS, REQUEST_SECONDS, REQUESTS, ERRORS, BATCH_SIZE]
+
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def collector(name: str, help: str, kind: str = "gauge"):
+    """Decorator registering a scrape-time collector function."""
+    def wrap(fn):
+        register(Collector(name, help, kind, fn))
+        return fn
+    return wrap
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def rss_bytes() -> Optional[int]:
+    """Current resident set size (Linux /proc), else the peak from getrusage."""
+    try:
+        with open("/proc/self/statm", "r") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+    except ImportError:
+        return None
+
+
+@collector("process_resident_memory_bytes", "Resident memory of the server process")
+def _rss():
+    rss = rss_bytes()
+    return [({}, rss)] if rss is not None else []
+
+
+# ------------------------------------------------------------------
+#  Hooks
+# ------------------------------------------------------------------
+
+class _StageTimer:
+    __slots__ = ("stage", "t0")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        STAGE_SECONDS.observe(time.perf_counter() - self.t0, self.stage)
+        if exc_type is not None:
+            ERRORS.inc(self.stage)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _NullTimer()
+
+
+def stage(name: str):
+    """Context manager timing one search stage; a shared no-op while disabled."""
+    return _StageTimer(name) if enabled else _NULL
+
+
+def observe_request(route: str, method: str, status: int, seconds: float):
+    REQUEST_SECONDS.observe(seconds, route, method)
+    REQUESTS.inc(route, method, str(status))
+
+
+def observe_batch(batcher: str, size: int):
+    if enabled:
+        BATCH_SIZE.observe(size, batcher)
+
+
+# ------------------------------------------------------------------
+#  Sampling profiler
+# ------------------------------------------------------------------
+
+class SamplingProfiler:
+    """Sample all thread stacks ``hz`` times a second into collapsed-stack counts."""
+
+    def __init__(self, hz: float = 100.0, max_depth: int = 64):
+        self.interval = 1.0 / hz
+        self.max_depth = max_depth
+        self.samples = 0
+        self._stacks: "_Tally[str]" = _Tally()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if len(names) != threading.active_count():
+                names = {t.ident: t.name for t in threading.enumerate()}
+            batch = []
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread"))
+                batch.append(";".join(reversed(stack)))
+            with self._lock:
+                self._stacks.update(batch)
+                self.samples += 1
+
+    def collapsed(self, top: Optional[int] = None, reset: bool = False) -> str:
+        """``frame;frame;… count`` lines, most frequent first."""
+        with self._lock:
+            items = self._stacks.most_common(top)
+            if reset:
+                self._stacks.clear()
+                self.samples = 0
+        return "".join(f"{stack} {n}\n" for stack, n in items)
@@ -0,0 +1,126 @@
+"""Fast CLIP image preprocessing: early-downscaled decode straight to ``pixel_values``.
+
+``CLIPProcessor`` wants a fully decoded RGB image, so a 2048px upload is
+decoded, converted and resized at full resolution.  Here:
+
+  * JPEGs are decoded with ``Image.draft`` – libjpeg's DCT scaling skips
+    up to 7/8 of the work – down to no less than DRAFT_MARGIN × the CLIP
+    input size on the short side (DCT scaling is a box filter, so closer
+    to 224 px it visibly departs from the processor's bicubic resize);
+  * any other format is shrunk with ``reducing_gap`` (a cheap integer
+    box reduce before the bicubic pass);
+  * the shortest-edge bicubic resize, centre crop, rescale and
+    normalisation of ``CLIPImageProcessor`` are done in numpy directly.
+
+Output matches the processor to within a small tolerance (only the
+pre-shrink differs); ``python preprocess.py [images…]`` reports the gap on
+the given images plus synthetic JPEGs of PARITY_SIZES.
+"""
+import argparse
+import io
+import os
+import sys
+import time
+from typing import List, Union
+
+import numpy as np
+from PIL import Image
+
+IMAGE_SIZE = 224                                  # CLIP ViT-L/14 input resolution
+CLIP_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32)
+CLIP_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32)
+DRAFT_MARGIN = 4                                  # keep ≥ 4×224 px before the final resize
+REDUCING_GAP = 3.0                                # Pillow: ≥3 is ~indistinguishable from a full resample
+MEAN_ABS_TOLERANCE = 0.02                         # in normalised pixel units, vs. CLIPImageProcessor
+# synthetic parity cases: just above each draft step, odd aspect, large photo
+PARITY_SIZES = ((1000, 999), (1800, 1800), (2048, 1536), (4000, 3000), (640, 480))
+
+ImageSource = Union[str, bytes, Image.Image]
+
+
+def _resize_size(w: int, h: int, size: int = IMAGE_SIZE):
+    """Shortest edge → ``size``, long edge truncated, as CLIPImageProcessor does."""
+    if w <= h:
+        return size, int(size * h / w)
+    return int(size * w / h), size
+
+
+def open_image(src: ImageSource, size: int = IMAGE_SIZE) -> Image.Image:
+    """Decode ``src`` (path, bytes or PIL image) to RGB, decoding JPEGs at reduced scale."""
+    img = src if isinstance(src, Image.Image) else Image.open(io.BytesIO(src) if isinstance(src, bytes) else src)
+    w, h = img.size
+    floor = size * DRAFT_MARGIN
+    if min(w, h) > floor and img.format == "JPEG":
+        scale = floor / min(w, h)
+        img.draft("RGB", (int(np.ceil(w * scale)), int(np.ceil(h * scale))))
+    return img.convert("RGB")
+
+
+def to_pixel_values(imgs: List[Image.Image], size: int = IMAGE_SIZE) -> np.ndarray:
+    """(N, 3, size, size) float32 CLIP pixel values for RGB ``imgs``."""
+    out = np.empty((len(imgs), 3, size, size), dtype=np.float32)
+    for i, img in enumerate(imgs):
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        new_w, new_h = _resize_size(*img.size, size=size)
+        img = img.resize((new_w, new_h), Image.BICUBIC, reducing_gap=REDUCING_GAP)
+        left, top = (new_w - size) // 2, (new_h - size) // 2
+        arr = np.asarray(img.crop((left, top, left + size, top + size)), dtype=np.float32)
+        out[i] = ((arr * (1.0 / 255.0) - CLIP_MEAN) / CLIP_STD).transpose(2, 0, 1)
+    return out
+
+
+def load_pixels(srcs: List[ImageSource], size: int = IMAGE_SIZE) -> np.ndarray:
+    """``open_image`` + ``to_pixel_values`` for a list of sources."""
+    return to_pixel_values([open_image(s, size) for s in srcs], size)
+
+
+# ------------------------------------------------------------------
+#  Parity check vs. CLIPImageProcessor
+# ------------------------------------------------------------------
+
+def synthetic_jpeg(w: int, h: int, seed: int = 0, quality: int = 90) -> bytes:
+    """A photo-like JPEG (smooth colour field + sensor-style noise) for parity checks."""
+    rng = np.random.default_rng(seed)
+    field = Image.fromarray((rng.random((h // 8 + 1, w // 8 + 1, 3)) * 255).astype(np.uint8))
+    arr = np.asarray(field.resize((w, h), Image.BICUBIC), dtype=np.float32) + rng.normal(0, 20, (h, w, 3))
+    buf = io.BytesIO()
+    Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8)).save(buf, "JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare fast preprocessing against CLIPImageProcessor")
+    parser.add_argument("images", nargs="*", help="Image files (default: data/test_imgs)")
+    parser.add_argument("--model-id", default="openai/clip-vit-large-patch14")
+    args = parser.parse_args()
+
+    from transformers import CLIPImageProcessor
+    paths = args.images
+    if not paths:
+        test_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "test_imgs")
+        paths = [os.path.join(test_dir, f) for f in sorted(os.listdir(test_dir))
+                 if f.lower().endswith((".png", ".jpg", ".jpeg"))]
+    processor = CLIPImageProcessor.from_pretrained(args.model_id)
+
+    cases = [(os.path.basename(p), p) for p in paths]
+    cases += [(f"synthetic {w}x{h}.jpg", synthetic_jpeg(w, h)) for w, h in PARITY_SIZES]
+    worst = 0.0
+    for name, src in cases:
+        t0 = time.perf_counter()
+        img = Image.open(io.BytesIO(src) if isinstance(src, bytes) else src).convert("RGB")
+        ref = processor(images=[img], return_tensors="np")["pixel_values"][0]
+        t1 = time.perf_counter()
+        fast = load_pixels([src])[0]
+        t2 = time.perf_counter()
+        diff = np.abs(ref - fast)
+        worst = max(worst, float(diff.mean()))
+        print(f"{name:<32} mean |Δ| {diff.mean():.4f}  max |Δ| {diff.max():.3f}   "
+              f"processor {1000 * (t1 - t0):6.1f} ms   fast {1000 * (t2 - t1):6.1f} ms")
+    ok = worst <= MEAN_ABS_TOLERANCE
+    print(f"{'✅' if ok else '❌'} worst mean |Δ| {worst:.4f} (tolerance {MEAN_ABS_TOLERANCE})")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
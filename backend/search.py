@@ -1,99 +1,556 @@
 import os
-import pickle
-from typing import List, Dict
+import threading
+import time
+from typing import Callable, List, Dict, Optional
 
-import faiss
 import numpy as np
-import torch
 from PIL import Image
-from transformers import CLIPModel, CLIPProcessor
+
+from index_bundle import INDEX_ROOT, IndexBundle, resolve_index_dir
+from metadata_store import normalise_prompt
+from filter_index import search_params
+from preprocess import to_pixel_values
+from shards import ShardedIndex
+import diversify as diversify_mod
+import metrics
+import rerank
+
+MAX_PROMPT_SETTINGS = 10     # images listed per distinct-prompt match
+MAX_PROMPT_TOKENS = 77       # CLIP text encoder limit; longer prompts are truncated as in the build
+WARMUP_BATCH_SIZES = (1, 8)  # forward-pass shapes run once by the optional warmup
+
+
+class NotReady(RuntimeError):
+    """The indexes or the CLIP model needed for a call are still loading."""
+
+# ------------------------------------------------------------------
+#  Query vector helpers
+# ------------------------------------------------------------------
+
+def _l2_normalise(x: np.ndarray) -> np.ndarray:
+    return x / (np.linalg.norm(x, axis=1, keepdims=True) + 1e-8)
+
+
+def _as_queries(vecs: np.ndarray, dim: int) -> np.ndarray:
+    """Validate / reshape to a contiguous, L2-normalised (N, dim) float32 matrix."""
+    arr = np.asarray(vecs, dtype=np.float32)
+    if arr.ndim == 1:
+        arr = arr.reshape(1, -1)
+    if arr.ndim != 2 or arr.shape[1] != dim:
+        raise ValueError(f"expected {dim}-d embedding(s), got shape {np.shape(vecs)}")
+    return np.ascontiguousarray(_l2_normalise(arr))
+
+
+def _reconstruct(index, ids: np.ndarray) -> Optional[np.ndarray]:
+    """Stored vectors of ``ids``, or None when the index cannot reconstruct (e.g. IVF without a direct map)."""
+    try:
+        return index.reconstruct_batch(ids)
+    except RuntimeError:
+        return None
+
+
+def _torch_device():
+    import torch
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def final_from_stacked(emb_stack: np.ndarray) -> np.ndarray:
+    """Recover the normalised final-layer 768-d vector from a stacked (final ‖ mid) one."""
+    arr = np.asarray(emb_stack, dtype=np.float32)
+    arr = arr.reshape(-1, arr.shape[-1])
+    return np.ascontiguousarray(_l2_normalise(arr[:, : arr.shape[1] // 2]))
 
 # ------------------------------------------------------------------
 #  SEARCHER
 # ------------------------------------------------------------------
 
 class ImageSearcher:
-    """Search both *image→image* and *image→prompt* FAISS indexes."""
+    """Search both *image→image* and *image→prompt* FAISS indexes, from an image or a text prompt.
+
+    Only the CLIP vision tower is loaded; the text tower is loaded on the
+    first text query, so image-only deployments never pay for it.
 
-    def __init__(self, top_k: int = 5):
+    Loading is staged: the indexes and the vision model load in two
+    threads at once. With ``lazy`` the constructor returns at once and
+    loading starts on ``start()`` or the first call that needs it; calls
+    whose part is not loaded yet raise NotReady, so embedding searches are
+    served as soon as the indexes are in, before the model is.
+    """
+
+    def __init__(self, top_k: int = 5, nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                 mmap: bool = True, backend: str = "fp32", rerank_candidates: Optional[int] = None,
+                 index_root: Optional[str] = None, fast_preprocess: bool = True,
+                 shard_workers: Optional[int] = None, shard_addresses: Optional[List[str]] = None,
+                 lazy: bool = False, warmup: bool = False,
+                 on_indexes_loaded: Optional[Callable[[], None]] = None):
         self.top_k = top_k
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.device = None
 
-        # ---- load CLIP ----
+        # ---- CLIP (vision tower + projection only), see _load_model ----
         self.model_id = "openai/clip-vit-large-patch14"
-        print(f"Loading CLIP backbone {self.model_id} …")
-        self.model: CLIPModel = CLIPModel.from_pretrained(self.model_id).eval().to(self.device)
-        self.processor = CLIPProcessor.from_pretrained(self.model_id)
+        self.model = self.processor = self._encode = None
+        self.text_model = self.tokenizer = None       # loaded lazily by _load_text_tower
+        self._text_lock = threading.Lock()
+        self.backend = backend
+        self.fast_preprocess = fast_preprocess        # preprocess.py instead of CLIPProcessor
+
+        # ---- FAISS indexes + metadata (swappable, see reload), see _load_indexes ----
+        self.index_root = index_root or INDEX_ROOT
+        self.mmap = mmap
+        self._nprobe, self._ef_search = nprobe, ef_search
+        self.shard_workers = shard_workers            # worker processes for sharded builds (None = one per shard)
+        self.shard_addresses = shard_addresses        # or running shard workers (host:port) to use instead
+        self._reload_lock = threading.Lock()
+        self._bundle: Optional[IndexBundle] = None
+        self.rerank_candidates = 0
+        self._rerank_request = rerank_candidates
+        self.on_indexes_loaded = on_indexes_loaded
+
+        # ---- staged start-up ----
+        self.warmup_on_load = warmup
+        self.indexes_ready, self.model_ready = threading.Event(), threading.Event()
+        self.index_error: Optional[BaseException] = None
+        self.model_error: Optional[BaseException] = None
+        self._start_lock = threading.Lock()
+        self._loaders: List[threading.Thread] = []
+        if not lazy:
+            self.start()
+            self.wait_ready()
+
+    # ------------------------------------------------------------------
+    #  Staged loading
+    # ------------------------------------------------------------------
+
+    def start(self):
+        """Begin loading the indexes and the model in parallel (no-op once started)."""
+        with self._start_lock:
+            if self._loaders:
+                return
+            self._loaders = [threading.Thread(target=fn, name=name, daemon=True)
+                             for fn, name in ((self._load_indexes, "load-indexes"), (self._load_model, "load-model"))]
+            for t in self._loaders:
+                t.start()
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Block until both parts have loaded; re-raises the first load error."""
+        self.start()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for event in (self.indexes_ready, self.model_ready):
+            if not event.wait(None if deadline is None else max(0.0, deadline - time.monotonic())):
+                return False
+        for err in (self.index_error, self.model_error):
+            if err is not None:
+                raise err
+        return True
+
+    def state(self) -> Dict:
+        """Per-part load state: ``loading`` / ``ready`` / ``failed`` (with the error)."""
+        def part(event, err):
+            if not self._loaders:
+                return {"state": "not started"}
+            if not event.is_set():
+                return {"state": "loading"}
+            return {"state": "failed", "error": str(err)} if err is not None else {"state": "ready"}
+        return {"indexes": part(self.indexes_ready, self.index_error),
+                "model": part(self.model_ready, self.model_error)}
+
+    @property
+    def ready(self) -> bool:
+        return all(p["state"] == "ready" for p in self.state().values())
+
+    def _load_indexes(self):
+        t0 = time.perf_counter()
+        try:
+            self._bundle = IndexBundle(resolve_index_dir(self.index_root), mmap=self.mmap, nprobe=self._nprobe,
+                                       ef_search=self._ef_search, shard_workers=self.shard_workers,
+                                       shard_addresses=self.shard_addresses)
+            self.set_rerank_candidates(self._rerank_request)
+            if self.warmup_on_load:
+                self._warmup_indexes()
+            if self.on_indexes_loaded is not None:
+                self.on_indexes_loaded()
+            print(f"✅ Indexes ready ({time.perf_counter() - t0:.1f} s)")
+        except Exception as e:
+            self.index_error = e
+            print(f"❌ Index load failed: {e}")
+        finally:
+            self.indexes_ready.set()
+
+    def _load_model(self):
+        t0 = time.perf_counter()
+        try:
+            from transformers import CLIPImageProcessor, CLIPVisionModelWithProjection
+            from inference_backends import load_backend
+
+            self.device = self.device or _torch_device()
+            print(f"Loading CLIP vision backbone {self.model_id} …")
+            self.model = CLIPVisionModelWithProjection.from_pretrained(self.model_id).eval().to(self.device)
+            self.processor = CLIPImageProcessor.from_pretrained(self.model_id)
+            self._encode = load_backend(self.model, self.backend, self.device)
+            print(f"   inference backend: {self.backend}")
+            if self.warmup_on_load:
+                self._warmup_model()
+            print(f"✅ Model ready ({time.perf_counter() - t0:.1f} s)")
+        except Exception as e:
+            self.model_error = e
+            print(f"❌ Model load failed: {e}")
+        finally:
+            self.model_ready.set()
+
+    def _warmup_model(self):
+        """One forward pass per WARMUP_BATCH_SIZES shape, so the first query skips allocation / JIT costs."""
+        import torch
+
+        t0 = time.perf_counter()
+        blank = Image.new("RGB", (224, 224), (127, 127, 127))
+        for n in WARMUP_BATCH_SIZES:
+            self._encode(torch.from_numpy(to_pixel_values([blank] * n)))
+        print(f"   model warm-up: {time.perf_counter() - t0:.1f} s")
+
+    def _warmup_indexes(self):
+        """One search per index (pages in the coarse structures of mmap-ed indexes)."""
+        b = self._bundle
+        for index in (b.image_index, b.prompt_index, b.coarse_index):
+            if index is not None:
+                q = np.zeros((1, index.d), dtype=np.float32)
+                q[0, 0] = 1.0
+                index.search(q, self.top_k)
+
+    def _ensure(self, event: threading.Event, error: Optional[BaseException], what: str):
+        if not event.is_set():
+            self.start()                                # lazy: the first call that needs it starts loading
+            raise NotReady(f"{what} still loading")
+        if error is not None:
+            raise RuntimeError(f"{what} failed to load: {error}")
+
+    @property
+    def bundle(self) -> IndexBundle:
+        if self._bundle is None:
+            self._ensure(self.indexes_ready, self.index_error, "indexes")
+        return self._bundle
+
+    @bundle.setter
+    def bundle(self, bundle: IndexBundle):
+        self._bundle = bundle
+
+    def _encoder(self):
+        if self._encode is None:
+            self._ensure(self.model_ready, self.model_error, "CLIP model")
+        return self._encode
+
+    # ------------------------------------------------------------------
+    #  Index versions
+    # ------------------------------------------------------------------
+
+    # the live bundle's parts, for callers that predate versioned reloads
+    image_index = property(lambda self: self.bundle.image_index)
+    prompt_index = property(lambda self: self.bundle.prompt_index)
+    coarse_index = property(lambda self: self.bundle.coarse_index)
+    metadata = property(lambda self: self.bundle.metadata)
+    filters = property(lambda self: self.bundle.filters)
+    index_dir = property(lambda self: self.bundle.index_dir)
+    index_paths = property(lambda self: self.bundle.index_paths)
+    version = property(lambda self: self.bundle.version)
 
-        # ---- load FAISS indexes ----
-        base_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "embedded_subset")
-        img_index_path = os.path.join(base_dir, "image_index.faiss")
-        txt_index_path = os.path.join(base_dir, "prompt_index.faiss")
-        meta_path = os.path.join(base_dir, "prompt_metadata.pkl")
+    def reload(self, index_dir: Optional[str] = None) -> Dict:
+        """Load ``index_dir`` (default: the published version) and swap it in.
 
-        print("Loading FAISS indexes …")
-        self.image_index = faiss.read_index(img_index_path)
-        self.prompt_index = faiss.read_index(txt_index_path)
-        print(f"   image_index  : {self.image_index.ntotal:,} × {self.image_index.d}")
-        print(f"   prompt_index : {self.prompt_index.ntotal:,} × {self.prompt_index.d}")
+        The new bundle is fully loaded and size-checked while queries keep
+        running on the old one; a failed load raises and leaves it serving.
+        CLIP is not touched.
+        """
+        with self._reload_lock:
+            t0 = time.perf_counter()
+            self.bundle                                   # NotReady until the first load finishes
+            index_dir = index_dir or resolve_index_dir(self.index_root)
+            bundle = IndexBundle(index_dir, mmap=self.mmap, nprobe=self._nprobe, ef_search=self._ef_search,
+                                 shard_workers=self.shard_workers, shard_addresses=self.shard_addresses)
+            old, self.bundle = self.bundle, bundle          # single reference swap
+            if self.rerank_candidates and bundle.coarse_index is None:
+                print("⚠️  new index has no coarse sidecars; two-stage search off until it does")
+            print(f"♻️  Index {old.version} → {bundle.version} ({time.perf_counter() - t0:.1f} s)")
+            return {"previous": old.version, "version": bundle.version, "images": len(bundle.metadata),
+                    "prompts": bundle.prompt_index.ntotal, "load_s": round(time.perf_counter() - t0, 2)}
+
+    # ------------------------------------------------------------------
+    #  Search-time knobs
+    # ------------------------------------------------------------------
 
-        with open(meta_path, "rb") as fp:
-            self.metadata = pickle.load(fp)
-        print(f"Loaded {len(self.metadata):,} metadata rows")
+    def set_search_params(self, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+        """Change nprobe (IVF) / efSearch (HNSW) on every index; ignored for flat. Kept across reloads."""
+        self._nprobe = nprobe if nprobe is not None else self._nprobe
+        self._ef_search = ef_search if ef_search is not None else self._ef_search
+        if self._bundle is not None:                     # otherwise applied when the indexes load
+            self._bundle.set_search_params(self._nprobe, self._ef_search)
 
-        assert self.image_index.ntotal == len(self.metadata) == self.prompt_index.ntotal, "Index / metadata mismatch!"
+    def set_rerank_candidates(self, candidates: Optional[int]):
+        """Candidates kept by the coarse stage of image→image search (0 / None = single-stage)."""
+        candidates = int(candidates or 0)
+        if candidates and self.bundle.coarse_index is None:
+            print("⚠️  two-stage search requested but the index has no coarse sidecars; "
+                  "rebuild without --coarse-index-type none")
+            candidates = 0
+        self.rerank_candidates = candidates
+        if candidates:
+            print(f"   two-stage image search: {candidates} candidates")
 
     # ------------------------------------------------------------------
     #  Embeddings helpers
     # ------------------------------------------------------------------
 
+    def _embed_images(self, pil_imgs: List[Image.Image]):
+        """Return (stacked1536, final768) numpy arrays, one row per image, from one forward pass."""
+        import torch
+
+        encode = self._encoder()
+        with metrics.stage("preprocess"):
+            if self.fast_preprocess:
+                pixel_values = torch.from_numpy(to_pixel_values(pil_imgs))
+            else:
+                pixel_values = self.processor(images=pil_imgs, return_tensors="pt")["pixel_values"]
+        with metrics.stage("embed"):
+            return encode(pixel_values)
+
     def _embed_image(self, pil_img: Image.Image):
-        """Return (stacked1536, final768) numpy arrays."""
-        inputs = self.processor(images=pil_img, return_tensors="pt").to(self.device)
-        with torch.no_grad():
-            # vision encoder with hidden states
-            vis_out = self.model.vision_model(pixel_values=inputs["pixel_values"], output_hidden_states=True, return_dict=True)
-            cls_final = vis_out.last_hidden_state[:, 0, :]
-            hidden_states = vis_out.hidden_states
-            cls_mid = hidden_states[len(hidden_states)//2][:, 0, :]
-            cls_final = self.model.vision_model.post_layernorm(cls_final)
-            cls_mid = self.model.vision_model.post_layernorm(cls_mid)
-            proj_final = self.model.visual_projection(cls_final)
-            proj_mid = self.model.visual_projection(cls_mid)
-            final_768 = proj_final / proj_final.norm(dim=-1, keepdim=True)
-            stacked_1536 = torch.cat([proj_final, proj_mid], dim=-1)
-            stacked_1536 = stacked_1536 / stacked_1536.norm(dim=-1, keepdim=True)
-        return stacked_1536.cpu().numpy(), final_768.cpu().numpy()
+        """Return (stacked1536, final768) numpy arrays of shape (1, d)."""
+        return self._embed_images([pil_img])
+
+    def _load_text_tower(self):
+        with self._text_lock:
+            if self.text_model is None:
+                t0 = time.perf_counter()
+                from transformers import CLIPTextModelWithProjection, CLIPTokenizerFast
+
+                print(f"Loading CLIP text tower {self.model_id} …")
+                self.device = self.device or _torch_device()
+                self.tokenizer = CLIPTokenizerFast.from_pretrained(self.model_id)
+                self.text_model = CLIPTextModelWithProjection.from_pretrained(self.model_id).eval().to(self.device)
+                print(f"   text tower ready ({time.perf_counter() - t0:.1f} s)")
+        return self.tokenizer, self.text_model
+
+    def embed_texts(self, prompts: List[str]) -> np.ndarray:
+        """(N, 768) L2-normalised CLIP text embeddings of ``prompts``, normalised as in the build."""
+        if not prompts:
+            return np.empty((0, self.bundle.prompt_index.d), dtype=np.float32)
+        import torch
+
+        tokenizer, text_model = self._load_text_tower()
+        with metrics.stage("text_embed"):
+            inputs = tokenizer([normalise_prompt(p) for p in prompts], return_tensors="pt",
+                               padding=True, truncation=True, max_length=MAX_PROMPT_TOKENS).to(self.device)
+            with torch.no_grad():
+                txt = text_model(**inputs).text_embeds
+        return _l2_normalise(txt.float().cpu().numpy())
 
     # ------------------------------------------------------------------
     #  Public API
     # ------------------------------------------------------------------
 
-    def search(self, img: Image.Image) -> Dict[str, List[Dict]]:
-        """Return dict with keys 'image_matches' and 'prompt_matches'."""
-        emb_stack, emb_final = self._embed_image(img)
+    def search(self, img: Image.Image, return_embeddings: bool = False, filters: Optional[Dict] = None,
+               top_k: Optional[int] = None, diversify: Optional[Dict] = None):
+        """Return dict with keys 'image_matches' and 'prompt_matches'.
+
+        With ``return_embeddings`` the result is ``(results, stacked1536, final768)``
+        where both vectors come from the same forward pass used for the search.
+        ``filters`` restricts matches by metadata, e.g.
+        ``{"sampler": "k_euler_a", "cfg_min": 7}`` (see filter_index.FILTER_KEYS).
+        ``top_k`` overrides the searcher's default for this call, and
+        ``diversify`` (see diversify.parse_options) collapses near-duplicate
+        image matches.
+        """
+        return self.search_batch([img], return_embeddings=return_embeddings, filters=filters,
+                                 top_k=top_k, diversify=diversify)[0]
+
+    def search_batch(self, imgs: Optional[List[Image.Image]] = None, embeddings: Optional[np.ndarray] = None,
+                     return_embeddings: bool = False, filters: Optional[Dict] = None,
+                     top_k: Optional[int] = None, diversify: Optional[Dict] = None) -> List:
+        """Search many queries with one forward pass and one search per index.
+
+        Pass either ``imgs`` (N PIL images) or ``embeddings``, an (N,1536)
+        stacked or (N,768) final-layer matrix. Returns one result dict per
+        query, or ``(results, stacked1536, final768)`` tuples for images when
+        ``return_embeddings`` is set. ``filters``, ``top_k`` and ``diversify``
+        apply to every query.
+        """
+        opts = {"filters": filters, "top_k": top_k, "diversify": diversify}
+        if embeddings is not None:
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+            if embeddings.ndim != 2:
+                raise ValueError(f"embeddings must be a 2-d matrix, got shape {embeddings.shape}")
+            if embeddings.shape[1] == self.bundle.image_index.d:
+                return self.search_vectors(emb_stack=embeddings, **opts)
+            return self.search_vectors(emb_final=embeddings, **opts)
+
+        if not imgs:
+            return []
+        emb_stack, emb_final = self._embed_images(imgs)
+        results = self.search_vectors(emb_stack, emb_final, **opts)
+        if return_embeddings:
+            return list(zip(results, emb_stack, emb_final))
+        return results
+
+    def search_text(self, query: str, filters: Optional[Dict] = None, top_k: Optional[int] = None,
+                    diversify: Optional[Dict] = None) -> Dict[str, List[Dict]]:
+        """Text prompt → images (final-layer image space) and similar prompts; see ``search_text_vectors``."""
+        return self.search_texts([query], filters=filters, top_k=top_k, diversify=diversify)[0]
+
+    def search_texts(self, queries: List[str], filters: Optional[Dict] = None, top_k: Optional[int] = None,
+                     diversify: Optional[Dict] = None) -> List[Dict[str, List[Dict]]]:
+        """Embed ``queries`` in one text-tower pass and search them together."""
+        if not queries:
+            return []
+        return self.search_text_vectors(self.embed_texts(queries), filters=filters, top_k=top_k, diversify=diversify)
+
+    def search_text_vectors(self, emb_text: np.ndarray, filters: Optional[Dict] = None, top_k: Optional[int] = None,
+                            diversify: Optional[Dict] = None) -> List[Dict[str, List[Dict]]]:
+        """Search (N,768) or (768,) CLIP text embeddings, one result dict per row.
+
+        ``prompt_matches`` come from ``prompt_index`` (prompt→prompt).
+        ``image_matches`` search the 768-d final-layer image vectors of the
+        coarse two-stage index, the space CLIP aligns text with; indexes
+        built without it (``--coarse-index-type none``) return none.
+        """
+        b = self.bundle
+        k = self._top_k(top_k)
+        emb_text = _as_queries(emb_text, b.prompt_index.d)
+        n = len(emb_text)
+        mask = self.filter_mask(filters, b)
+        if mask is not None and not mask.any():
+            return [{"image_matches": [], "prompt_matches": []} for _ in range(n)]
+
+        img_matches = [[] for _ in range(n)]
+        if b.coarse_index is not None:
+            d_img, i_img = self._index_search(b.coarse_index, emb_text, diversify_mod.candidates(k, diversify), mask)
+            if diversify:
+                d_img, i_img = self._diversify_images(b, d_img, i_img, k, diversify)
+            with metrics.stage("format"):
+                img_matches = [self._format_results(b, d_img[q], i_img[q]) for q in range(n)]
+        prompt_matches = self._prompt_matches(b, emb_text, mask, k)
+        return [
+            {"image_matches": img_matches[q], "prompt_matches": prompt_matches[q]}
+            for q in range(n)
+        ]
+
+    def search_vectors(self, emb_stack: Optional[np.ndarray] = None,
+                       emb_final: Optional[np.ndarray] = None,
+                       filters: Optional[Dict] = None, top_k: Optional[int] = None,
+                       diversify: Optional[Dict] = None) -> List[Dict[str, List[Dict]]]:
+        """Search precomputed query embeddings, one result dict per row.
+
+        ``emb_stack`` is (N,1536) or (1536,), ``emb_final`` (N,768) or (768,).
+        The 768-d vector is derived from the stacked one when omitted; with
+        only a 768-d vector there is no image→image search. ``filters``
+        restricts both searches to matching metadata rows. With ``diversify``
+        image matches are picked from an over-fetched candidate list.
+        """
+        if emb_stack is None and emb_final is None:
+            raise ValueError("need a stacked (1536-d) and/or final (768-d) embedding")
+        b = self.bundle                  # one version for the whole call, even across a reload
+        k = self._top_k(top_k)
+        if emb_stack is not None:
+            emb_stack = _as_queries(emb_stack, b.image_index.d)
+            if emb_final is None:
+                emb_final = final_from_stacked(emb_stack)
+        emb_final = _as_queries(emb_final, b.prompt_index.d)
+        n = len(emb_final)
+        mask = self.filter_mask(filters, b)
+        if mask is not None and not mask.any():
+            return [{"image_matches": [], "prompt_matches": []} for _ in range(n)]
 
         # ---- image→image ----
-        d_img, i_img = self.image_index.search(emb_stack, self.top_k)
-        img_matches = self._format_results(d_img[0], i_img[0])
+        img_matches = [[] for _ in range(n)]
+        if emb_stack is not None:
+            fetch = diversify_mod.candidates(k, diversify)
+            if self.rerank_candidates and b.coarse_index is not None:
+                # coarse 768-d candidates, then exact 1536-d rescoring of just those rows
+                _, cand = self._index_search(b.coarse_index, emb_final,
+                                             max(self.rerank_candidates, fetch), mask)
+                with metrics.stage("rerank"):
+                    d_img, i_img = rerank.rescore(b.image_vectors, emb_stack, cand, fetch)
+            else:
+                d_img, i_img = self._index_search(b.image_index, emb_stack, fetch, mask)
+            if diversify:
+                d_img, i_img = self._diversify_images(b, d_img, i_img, k, diversify)
+            with metrics.stage("format"):
+                img_matches = [self._format_results(b, d_img[q], i_img[q]) for q in range(n)]
 
         # ---- image→prompt ----
-        d_txt, i_txt = self.prompt_index.search(emb_final, self.top_k)
-        prompt_matches = self._format_results(d_txt[0], i_txt[0])
+        prompt_matches = self._prompt_matches(b, emb_final, mask, k)
 
-        return {"image_matches": img_matches, "prompt_matches": prompt_matches}
+        return [
+            {"image_matches": img_matches[q], "prompt_matches": prompt_matches[q]}
+            for q in range(n)
+        ]
 
     # ------------------------------------------------------------------
 
-    def _format_results(self, dots: np.ndarray, idxs: np.ndarray) -> List[Dict]:
-        """Convert FAISS outputs into friendly dicts."""
+    def filter_mask(self, filters: Optional[Dict], bundle: Optional[IndexBundle] = None) -> Optional[np.ndarray]:
+        """Row mask for ``filters`` (None when unfiltered); raises ValueError on bad filters."""
+        if not filters:
+            return None
+        bundle = bundle or self.bundle
+        if bundle.filters is None:
+            raise ValueError("this index was built without metadata filters; rebuild it to filter")
+        with metrics.stage("filter"):
+            return bundle.filters.mask(filters)
+
+    def _top_k(self, top_k: Optional[int]) -> int:
+        k = self.top_k if top_k is None else int(top_k)
+        if k < 1:
+            raise ValueError("top_k must be >= 1")
+        return k
+
+    def _diversify_images(self, b: IndexBundle, dots: np.ndarray, idxs: np.ndarray, k: int, opts: Dict):
+        """Diversified top-``k`` of over-fetched image hits, using the stored vectors and prompt groups."""
+        if b.image_vectors is not None:
+            vectors_of = lambda ids: np.asarray(b.image_vectors[ids], dtype=np.float32)
+        elif not isinstance(b.image_index, ShardedIndex):
+            vectors_of = lambda ids: _reconstruct(b.image_index, ids)
+        else:
+            vectors_of = None                           # prompt collapsing only
+        if b.prompt_groups is not None:
+            groups_of = lambda ids: np.asarray(b.prompt_groups.prompt_of_image[ids])
+        else:
+            groups_of = lambda ids: np.array([normalise_prompt(r["prompt"]) for r in b.metadata.rows(ids.tolist())],
+                                             dtype=object)
+        with metrics.stage("diversify"):
+            return diversify_mod.diversify(dots, idxs, k, opts, vectors_of, groups_of)
+
+    def _prompt_matches(self, b: IndexBundle, emb_final: np.ndarray, mask: Optional[np.ndarray],
+                        k: int) -> List[List[Dict]]:
+        """``prompt_index`` hits per query row; distinct-prompt results when the build has prompt groups."""
+        n = len(emb_final)
+        if b.prompt_groups is None:
+            d_txt, i_txt = self._index_search(b.prompt_index, emb_final, k, mask)
+            with metrics.stage("format"):
+                return [self._format_results(b, d_txt[q], i_txt[q]) for q in range(n)]
+        pmask = None if mask is None else b.prompt_groups.prompt_mask(mask)
+        d_txt, i_txt = self._index_search(b.prompt_index, emb_final, k, pmask)
+        with metrics.stage("format"):
+            return [self._format_prompt_results(b, d_txt[q], i_txt[q], mask) for q in range(n)]
+
+    @staticmethod
+    def _index_search(index, queries: np.ndarray, k: int, mask: Optional[np.ndarray]):
+        """``index.search`` restricted to ``mask`` rows via an ID selector when given."""
+        with metrics.stage("search"):
+            if mask is None:
+                return index.search(queries, k)
+            if isinstance(index, ShardedIndex):
+                return index.search(queries, k, mask=mask)      # each worker applies its slice
+            params, keepalive = search_params(index, mask)
+            d, i = index.search(queries, k, params=params)
+            del keepalive
+            return d, i
+
+    @staticmethod
+    def _format_results(b: IndexBundle, dots: np.ndarray, idxs: np.ndarray) -> List[Dict]:
+        """Convert FAISS outputs into friendly dicts, gathering only the hit rows."""
+        keep = [(float(score), int(idx)) for score, idx in zip(dots, idxs) if 0 <= idx < len(b.metadata)]
+        rows = b.metadata.rows([idx for _, idx in keep])
         results = []
-        for score, idx in zip(dots, idxs):
-            if idx < 0 or idx >= len(self.metadata):
-                continue
-            entry = self.metadata[idx]
+        for (score, _), entry in zip(keep, rows):
             results.append({
-                "similarity": float(score),  # cosine in [-1,1]
+                "similarity": score,  # cosine in [-1,1]
                 "image_name": entry["image_name"],
                 "prompt": entry["prompt"],
                 "seed": entry["seed"],
@@ -103,6 +560,39 @@ class ImageSearcher:
             })
         return results
 
+    @staticmethod
+    def _format_prompt_results(b: IndexBundle, dots: np.ndarray, idxs: np.ndarray,
+                               mask: Optional[np.ndarray] = None) -> List[Dict]:
+        """Distinct-prompt hits: the first image's fields plus every image using the prompt.
+
+        ``settings`` lists up to MAX_PROMPT_SETTINGS of the prompt's images
+        (only those passing ``mask`` when filtering); ``image_count`` is the
+        full count.
+        """
+        results = []
+        for score, pid in zip(dots, idxs):
+            if not 0 <= pid < len(b.prompt_groups):
+                continue
+            image_ids = np.asarray(b.prompt_groups.images(int(pid)))
+            if mask is not None:
+                image_ids = image_ids[mask[image_ids]]
+            if not len(image_ids):
+                continue
+            rows = b.metadata.rows(image_ids[:MAX_PROMPT_SETTINGS].tolist())
+            settings = [
+                {"image_name": r["image_name"], "seed": r["seed"], "cfg": r["cfg"],
+                 "steps": r["steps"], "sampler": r["sampler"]}
+                for r in rows
+            ]
+            results.append({
+                "similarity": float(score),
+                "prompt": rows[0]["prompt"],
+                **settings[0],
+                "image_count": int(len(image_ids)),
+                "settings": settings,
+            })
+        return results
+
 # ------------------------------------------------------------------
 #  DEMO
 # ------------------------------------------------------------------
@@ -1,12 +1,20 @@
 # server.py
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
-import os, io, json
+import os, io, json, time, hmac
+from functools import partial
 from datetime import datetime
 
 import numpy as np
 from PIL import Image
-from search import ImageSearcher            
+import metrics
+from search import ImageSearcher, NotReady
+from batching import MicroBatcher
+from cache import LRUCache, QueryCache, bytes_key, pixel_key
+from index_bundle import INDEX_ROOT, VERSIONS_DIR, CurrentWatcher
+from preprocess import open_image
+from metadata_store import normalise_prompt
+from diversify import parse_options as parse_diversify
 
 ###############################################################################
 #  Flask setup
@@ -20,30 +28,359 @@ ALLOWED_EXT   = {"png", "jpg", "jpeg"}
 # Folder creation no longer needed since we're not saving files
 # os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# memory-map indexes + metadata so several server workers share one copy
+USE_MMAP        = os.environ.get("SEARCH_MMAP", "1") != "0"
+
+# CLIP vision inference backend: fp32 | bf16 | int8 | onnx
+INFER_BACKEND   = os.environ.get("SEARCH_BACKEND", "fp32")
+
+# sharded builds (shards.json): local shard worker processes (0 = one per shard),
+# or comma-separated host:port of running `shards.py worker`s (needs SHARD_AUTHKEY)
+SHARD_WORKERS   = int(os.environ.get("SEARCH_SHARD_WORKERS", 0))
+SHARD_ADDRESSES = [a for a in os.environ.get("SEARCH_SHARD_ADDRESSES", "").split(",") if a]
+
+# matches per list when a request gives no top_k, and the most it may ask for
+DEFAULT_TOP_K   = int(os.environ.get("SEARCH_TOP_K", 5))
+MAX_TOP_K       = int(os.environ.get("SEARCH_MAX_TOP_K", 100))
+
+# two-stage image→image search: coarse candidates rescored exactly (0 = off)
+RERANK_CANDIDATES = int(os.environ.get("SEARCH_RERANK_CANDIDATES", 0))
+
+# decode JPEGs at reduced scale + numpy preprocessing instead of CLIPProcessor
+FAST_PREPROCESS = os.environ.get("SEARCH_FAST_PREPROCESS", "1") != "0"
+
+# dynamic micro-batching of concurrent image queries (max batch 1 = off)
+MAX_BATCH_SIZE  = int(os.environ.get("SEARCH_MAX_BATCH", 16))
+MAX_BATCH_WAIT  = float(os.environ.get("SEARCH_MAX_WAIT_MS", 5))
+
+# content-addressed result cache (size 0 = off, TTL 0 = no expiry)
+CACHE_SIZE      = int(os.environ.get("SEARCH_CACHE_SIZE", 1024))
+CACHE_TTL       = float(os.environ.get("SEARCH_CACHE_TTL", 0))
+
+# text queries: CLIP text embeddings cached by normalised prompt (size 0 = off);
+# the text tower itself only loads on the first text query
+TEXT_CACHE_SIZE = int(os.environ.get("SEARCH_TEXT_CACHE_SIZE", 4096))
+MAX_TEXT_CHARS  = int(os.environ.get("SEARCH_MAX_TEXT_CHARS", 2000))
+
+# /api/search/batch: queries per forward pass, max queries per call, and the
+# size above which results always stream back as NDJSON
+BATCH_CHUNK         = int(os.environ.get("SEARCH_BATCH_CHUNK", 64))
+MAX_BATCH_QUERIES   = int(os.environ.get("SEARCH_MAX_BATCH_QUERIES", 10000))
+STREAM_THRESHOLD    = int(os.environ.get("SEARCH_STREAM_THRESHOLD", 256))
+EMBEDDING_DIMS      = (1536, 768)
+
+# hot index reload: POST /api/admin/reload and/or polling
+# data/embedded_subset/CURRENT every N s (0 = off). Admin routes answer 403
+# unless SEARCH_ADMIN_TOKEN is set; SEARCH_ADMIN_TRUST_LOCALHOST=1 also lets
+# loopback callers in without it (never behind a reverse proxy on the same host)
+ADMIN_TOKEN     = os.environ.get("SEARCH_ADMIN_TOKEN", "")
+ADMIN_TRUST_LOCALHOST = os.environ.get("SEARCH_ADMIN_TRUST_LOCALHOST", "0") == "1"
+RELOAD_POLL     = float(os.environ.get("SEARCH_RELOAD_POLL", 0))
+
+# per-stage latency histograms + GET /metrics (0 = off), and an always-on
+# sampling profiler behind GET /api/admin/profile (samples/s, 0 = off)
+METRICS_ENABLED = os.environ.get("SEARCH_METRICS", "1") != "0"
+PROFILE_HZ      = float(os.environ.get("SEARCH_PROFILE_HZ", 0))
+metrics.enabled = METRICS_ENABLED
+
+# start-up: indexes and the CLIP vision model load in two background threads
+# as soon as this module is imported (0 = only when the first request needs
+# them); GET /api/ready reports progress. Embedding searches are served once
+# the indexes are in. SEARCH_WARMUP=1 runs one forward pass per batch shape
+# and one search per index before reporting ready.
+PRELOAD         = os.environ.get("SEARCH_PRELOAD", "1") != "0"
+WARMUP          = os.environ.get("SEARCH_WARMUP", "0") == "1"
+RETRY_AFTER     = "5"
+
 ###############################################################################
 #  Searcher initialisation
 ###############################################################################
+def _indexes_loaded():
+    if query_cache is not None:
+        query_cache.watch(image_searcher.index_paths)
+
 try:
-    image_searcher = ImageSearcher(top_k=5)
-    print("✅ ImageSearcher initialised")
+    # cheap: nothing is loaded until start() below or the first request
+    image_searcher = ImageSearcher(top_k=DEFAULT_TOP_K, mmap=USE_MMAP, backend=INFER_BACKEND,
+                                   rerank_candidates=RERANK_CANDIDATES,
+                                   fast_preprocess=FAST_PREPROCESS,
+                                   shard_workers=SHARD_WORKERS or None,
+                                   shard_addresses=SHARD_ADDRESSES or None,
+                                   lazy=True, warmup=WARMUP, on_indexes_loaded=_indexes_loaded)
+    print("✅ ImageSearcher created")
 except Exception as e:
     image_searcher = None
     print(f"❌ ImageSearcher failed to init: {e}")
 
+search_batcher = None
+if image_searcher is not None and MAX_BATCH_SIZE > 1:
+    search_batcher = MicroBatcher(partial(image_searcher.search_batch, return_embeddings=True),
+                                  max_batch_size=MAX_BATCH_SIZE,
+                                  max_wait_ms=MAX_BATCH_WAIT,
+                                  name="image-search-batcher")
+    print(f"✅ Micro-batching on (max {MAX_BATCH_SIZE} / {MAX_BATCH_WAIT} ms)")
+
+text_batcher = None
+if image_searcher is not None and MAX_BATCH_SIZE > 1:
+    text_batcher = MicroBatcher(lambda prompts: list(image_searcher.embed_texts(prompts)),
+                                max_batch_size=MAX_BATCH_SIZE,
+                                max_wait_ms=MAX_BATCH_WAIT,
+                                name="text-embed-batcher")
+
+query_cache = None
+if image_searcher is not None and CACHE_SIZE > 0:
+    # index files are watched once they are loaded, see _indexes_loaded
+    query_cache = QueryCache(max_entries=CACHE_SIZE, ttl=CACHE_TTL)
+    print(f"✅ Query cache on ({CACHE_SIZE} entries, TTL {CACHE_TTL or '∞'} s)")
+
+text_cache = None
+if image_searcher is not None and TEXT_CACHE_SIZE > 0:
+    # embeddings do not depend on the index version, so reloads keep this one
+    text_cache = LRUCache(max_entries=TEXT_CACHE_SIZE)
+    print(f"✅ Text embedding cache on ({TEXT_CACHE_SIZE} prompts)")
+
+def reload_index(version: str = None):
+    """Load the published (or given) index version next to the live one and swap it in."""
+    index_dir = os.path.join(INDEX_ROOT, VERSIONS_DIR, version) if version else None
+    info = image_searcher.reload(index_dir)
+    if query_cache is not None:
+        query_cache.watch(image_searcher.index_paths)
+    return info
+
+index_watcher = None
+if image_searcher is not None and RELOAD_POLL > 0:
+    index_watcher = CurrentWatcher(INDEX_ROOT, reload_index, interval=RELOAD_POLL)
+    print(f"✅ Watching {INDEX_ROOT}/CURRENT every {RELOAD_POLL} s")
+
+if image_searcher is not None and PRELOAD:
+    image_searcher.start()
+    print("⏳ Loading indexes + CLIP vision model in the background")
+
+profiler = None
+if PROFILE_HZ > 0:
+    profiler = metrics.SamplingProfiler(hz=PROFILE_HZ)
+    profiler.start()
+    print(f"✅ Sampling profiler on ({PROFILE_HZ:g} Hz)")
+
+###############################################################################
+#  Metrics collectors (read at scrape time, nothing on the request path)
+###############################################################################
+@metrics.collector("batcher_queue_depth", "Queries waiting for a micro-batch")
+def _batcher_queue_depth():
+    return [({"batcher": b.name}, b.queue_depth()) for b in (search_batcher, text_batcher) if b is not None]
+
+@metrics.collector("batcher_mean_batch_size", "Mean items per micro-batch since start")
+def _batcher_mean_batch_size():
+    return [({"batcher": b.name}, b.mean_batch_size()) for b in (search_batcher, text_batcher) if b is not None]
+
+@metrics.collector("cache_events_total", "Query / text cache lookups by outcome", kind="counter")
+def _cache_events():
+    out = []
+    for name, cache in (("query", query_cache), ("text", text_cache)):
+        if cache is not None:
+            st = cache.stats()
+            out += [({"cache": name, "event": ev}, st[ev]) for ev in ("hits", "misses", "evictions")]
+    return out
+
+@metrics.collector("cache_entries", "Entries held by the query / text caches")
+def _cache_entries():
+    return [({"cache": name}, len(c)) for name, c in (("query", query_cache), ("text", text_cache)) if c is not None]
+
+@metrics.collector("index_vectors", "Vectors in each loaded index")
+def _index_vectors():
+    if image_searcher is None:
+        return []
+    b = image_searcher.bundle
+    return [({"index": name}, idx.ntotal)
+            for name, idx in (("image", b.image_index), ("prompt", b.prompt_index), ("coarse", b.coarse_index))
+            if idx is not None]
+
+@metrics.collector("searcher_ready", "1 once a part (indexes / model) has loaded, else 0")
+def _searcher_ready():
+    if image_searcher is None:
+        return []
+    return [({"part": part}, st["state"] == "ready") for part, st in image_searcher.state().items()]
+
+@metrics.collector("index_version_info", "Index version being served (value is always 1)")
+def _index_version_info():
+    return [({"version": image_searcher.version}, 1)] if image_searcher is not None else []
+
 ###############################################################################
 #  Small helpers
 ###############################################################################
 def allowed(fname):
     return "." in fname and fname.rsplit(".", 1)[1].lower() in ALLOWED_EXT
 
-def embed_image(img: Image.Image) -> np.ndarray:
-    """Public wrapper around searcher's private helper so we can return vectors."""
-    stack, _ = image_searcher._embed_image(img)   # stacked 1536-d
-    return stack[0]                               # (1,1536) → (1536,)
+def parse_filters(filters):
+    """Validate a filters object, or a JSON string of one; None when unfiltered."""
+    if isinstance(filters, (str, bytes)):
+        filters = json.loads(filters) if filters else None
+    if filters is not None and not isinstance(filters, dict):
+        raise ValueError("filters must be an object")
+    return filters or None
+
+def request_filters(body: dict):
+    """Metadata filters from the JSON body, or a JSON ``filters`` form / query field."""
+    filters = body.get("filters")
+    if filters is None:
+        filters = request.form.get("filters") or request.args.get("filters")
+    return parse_filters(filters)
+
+def parse_top_k(top_k):
+    """Validate a per-request ``top_k`` (int or numeric string); None for the default."""
+    if top_k is None or top_k == "":
+        return None
+    if isinstance(top_k, bool) or isinstance(top_k, float) and not top_k.is_integer():
+        raise ValueError("top_k must be an integer")
+    top_k = int(top_k)
+    if not 1 <= top_k <= MAX_TOP_K:
+        raise ValueError(f"top_k must be between 1 and {MAX_TOP_K}")
+    return top_k
+
+def request_options(body: dict):
+    """``{"top_k": …, "diversify": …}`` from the JSON body, or form / query fields of the same name."""
+    opts = {}
+    for key, parse in (("top_k", parse_top_k), ("diversify", parse_diversify)):
+        value = body.get(key)
+        if value is None:
+            value = request.form.get(key) or request.args.get(key)
+        opts[key] = parse(value)
+    return opts
+
+def options_key(filters=None, top_k=None, diversify=None) -> str:
+    """Cache-key suffix for everything besides the query that shapes a result."""
+    opts = {k: v for k, v in (("filters", filters), ("top_k", top_k), ("diversify", diversify)) if v}
+    return "|" + json.dumps(opts, sort_keys=True) if opts else ""
+
+def search_image(img: Image.Image, filters=None, top_k=None, diversify=None):
+    """Run one image query, through the micro-batcher when it is enabled.
+
+    Queries with filters or their own top_k / diversify options skip the
+    batcher, since a batch shares one set of search options.
+    Returns ``(results, stacked1536, final768)`` from a single forward pass.
+    """
+    if search_batcher is not None and not (filters or top_k or diversify):
+        return search_batcher(img)
+    return image_searcher.search(img, return_embeddings=True, filters=filters, top_k=top_k, diversify=diversify)
+
+def decode_image(img_bytes: bytes) -> Image.Image:
+    """Bytes → RGB image; early-downscaled when fast preprocessing is on."""
+    with metrics.stage("decode"):
+        if FAST_PREPROCESS:
+            return open_image(img_bytes)
+        return Image.open(io.BytesIO(img_bytes)).convert("RGB")
+
+def readiness():
+    """``(status, body)`` for GET /api/ready: 200 once both parts are loaded, else 503.
+
+    ``initialized`` / ``error`` match the desktop wrapper's PythonStatus.
+    """
+    if image_searcher is None:
+        return 503, {"ready": False, "initialized": False, "error": "ImageSearcher failed to init"}
+    state = image_searcher.state()
+    errors = [f"{part}: {st['error']}" for part, st in state.items() if st["state"] == "failed"]
+    ready = image_searcher.ready
+    return (200 if ready else 503), {
+        "ready": ready, "initialized": ready, "error": "; ".join(errors) or None,
+        "embedding_search": state["indexes"]["state"] == "ready",
+        "image_search": ready, **state,
+    }
+
+def not_ready(e: NotReady):
+    return jsonify(error=f"Search not ready yet: {e}"), 503, {"Retry-After": RETRY_AFTER}
+
+def admin_allowed(token: str, remote_addr: str) -> bool:
+    """Token check for /api/admin/*; without a token only opted-in loopback callers pass."""
+    if ADMIN_TOKEN:
+        return hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+    return ADMIN_TRUST_LOCALHOST and remote_addr in ("127.0.0.1", "::1")
+
+class ImageDecodeError(ValueError):
+    pass
+
+def decode_image_bytes(img_bytes: bytes, filters=None, top_k=None, diversify=None):
+    """Cache lookup + decode, the CPU-light half of ``search_image_bytes``.
+
+    Lookups go by the hash of the bytes, then by the hash of the decoded
+    pixels (catches re-encoded copies). Returns ``(hit, None, keys)`` on a
+    cache hit, else ``(None, img, keys)``. Raises ImageDecodeError on bad input.
+    """
+    # index version in the key: results finished on an old version never answer for the new one
+    suffix = "@" + image_searcher.version + options_key(filters, top_k, diversify)
+    byte_key = bytes_key(img_bytes) + suffix
+    if query_cache is not None:
+        hit = query_cache.get(byte_key)
+        if hit is not None:
+            return hit, None, (byte_key,)
+
+    try:
+        img = decode_image(img_bytes)
+    except Exception as e:
+        raise ImageDecodeError(str(e)) from e
+
+    if query_cache is not None:
+        pix_key = pixel_key(img) + suffix
+        hit = query_cache.get(pix_key)
+        if hit is not None:
+            query_cache.put(byte_key, hit)
+            return hit, None, (byte_key, pix_key)
+        return None, img, (byte_key, pix_key)
+    return None, img, ()
+
+def search_decoded(img: Image.Image, filters=None, keys=(), top_k=None, diversify=None):
+    """Search a decoded image and cache the result under ``keys``."""
+    res = search_image(img, filters, top_k, diversify)
+    if query_cache is not None:
+        for key in keys:
+            query_cache.put(key, res)
+    return res
+
+def search_image_bytes(img_bytes: bytes, filters=None, top_k=None, diversify=None):
+    """Decode + search raw image bytes, consulting the query cache first."""
+    hit, img, keys = decode_image_bytes(img_bytes, filters, top_k, diversify)
+    return hit if hit is not None else search_decoded(img, filters, keys, top_k, diversify)
+
+def parse_text_query(body: dict) -> str:
+    """The ``query`` of a text search request; ValueError when missing or too long."""
+    text = body.get("query", body.get("text"))
+    if not isinstance(text, str) or not text.strip():
+        raise ValueError("query must be a non-empty string")
+    if len(text) > MAX_TEXT_CHARS:
+        raise ValueError(f"query longer than {MAX_TEXT_CHARS} characters")
+    return text
+
+def embed_text(text: str) -> np.ndarray:
+    """768-d CLIP text embedding, from the cache or the text micro-batcher."""
+    key = normalise_prompt(text)
+    vec = text_cache.get(key) if text_cache is not None else None
+    if vec is None:
+        vec = text_batcher(key) if text_batcher is not None else image_searcher.embed_texts([key])[0]
+        if text_cache is not None:
+            text_cache.put(key, vec)
+    return vec
+
+def search_text(text: str, filters=None, top_k=None, diversify=None):
+    """Text prompt → image and prompt matches."""
+    return image_searcher.search_text_vectors(embed_text(text), filters=filters, top_k=top_k,
+                                              diversify=diversify)[0]
 
 ###############################################################################
 #  Routes
 ###############################################################################
+if METRICS_ENABLED:
+    @app.before_request
+    def _start_timer():
+        request.environ["search.t0"] = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        t0 = request.environ.get("search.t0")
+        if t0 is not None:
+            # the route template, not the raw path, keeps label cardinality bounded
+            route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            metrics.observe_request(route, request.method, response.status_code, time.perf_counter() - t0)
+        return response
+
 @app.route("/api/upload", methods=["POST"])
 def upload():
     if "image" not in request.files:
@@ -53,10 +390,18 @@ def upload():
     if f.filename == "" or not allowed(f.filename):
         return jsonify(error="Invalid or missing filename"), 400
 
+    if image_searcher is None:
+        return jsonify(error="Search not available"), 503
+
     try:
-        img_bytes = f.read()
-        img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-    except Exception as e:
+        opts = request_options({})
+    except ValueError as e:
+        return jsonify(error=f"Bad options: {e}"), 400
+
+    # run search; the stacked query vector comes from the same forward pass
+    try:
+        search_res, emb_stack, _ = search_image_bytes(f.read(), **opts)
+    except ImageDecodeError as e:
         return jsonify(error=f"Cannot read image: {e}"), 400
 
     # Generate a filename for reference purposes only (not saving to disk)
@@ -80,13 +425,10 @@ def upload():
     # with open(f"{path}.json", "w", encoding="utf-8") as fp:
     #     json.dump(meta, fp)
 
-    # run search
-    search_res = image_searcher.search(img) if image_searcher else {}
-
     return jsonify(
         success=True,
         filename=fname,
-        embedding=embed_image(img).tolist(),
+        embedding=emb_stack.tolist(),
         results=search_res
     )
 
@@ -98,32 +440,38 @@ def query():
     if image_searcher is None:
         return jsonify(error="Search not available"), 503
 
-    # ---------- case 1: embedding provided ----------------------------------
-    if request.json and "embedding" in request.json:
+    body = request.get_json(silent=True) or {}
+    try:
+        filters = request_filters(body)
+    except ValueError as e:
+        return jsonify(error=f"Bad filters: {e}"), 400
+    try:
+        opts = request_options(body)
+    except ValueError as e:
+        return jsonify(error=f"Bad options: {e}"), 400
+
+    # ---------- case 1: embedding provided (1536-d stacked or 768-d final) --
+    if "embedding" in body:
         try:
-            vec = np.asarray(request.json["embedding"], dtype=np.float32)
-            if vec.shape != (1536,):
-                raise ValueError("embedding must be length-1536 stacked vector")
-            vec /= np.linalg.norm(vec) + 1e-8                     # normalise
-            dists, idxs = image_searcher.image_index.search(vec.reshape(1, -1), 5)
-
-            results = []
-            for score, idx in zip(dists[0], idxs[0]):
-                entry = image_searcher.metadata[idx]
-                results.append({
-                    "similarity": float(score),      # cosine ∈ [-1,1]
-                    **entry
-                })
-            return jsonify(success=True, results=results)
+            vec = np.asarray(body["embedding"], dtype=np.float32)
+            if vec.shape == (1536,):
+                res = image_searcher.search_vectors(emb_stack=vec, filters=filters, **opts)[0]
+            elif vec.shape == (768,):
+                res = image_searcher.search_vectors(emb_final=vec, filters=filters, **opts)[0]
+            else:
+                raise ValueError("embedding must be a length-1536 stacked or length-768 final vector")
+            return jsonify(success=True, results=res)
+        except NotReady as e:
+            return not_ready(e)
         except Exception as e:
             return jsonify(error=f"Bad embedding: {e}"), 400
 
     # ---------- case 2: image URL -------------------------------------------
-    if request.json and "image_url" in request.json:
+    if "image_url" in body:
         try:
             import requests
-            resp = requests.get(request.json["image_url"])
-            img = Image.open(io.BytesIO(resp.content)).convert("RGB")
+            resp = requests.get(body["image_url"], timeout=10)
+            img_bytes = resp.content
         except Exception as e:
             return jsonify(error=f"URL fetch failed: {e}"), 400
 
@@ -132,20 +480,256 @@ def query():
         f = request.files["image"]
         if f.filename == "" or not allowed(f.filename):
             return jsonify(error="Invalid or missing filename"), 400
-        try:
-            img = Image.open(io.BytesIO(f.read())).convert("RGB")
-        except Exception as e:
-            return jsonify(error=f"Cannot decode image: {e}"), 400
+        img_bytes = f.read()
     else:
         return jsonify(error="No query supplied"), 400
 
     # shared image search branch
     try:
-        res = image_searcher.search(img)
+        res, _, _ = search_image_bytes(img_bytes, filters, **opts)
         return jsonify(success=True, results=res)
+    except ImageDecodeError as e:
+        return jsonify(error=f"Cannot decode image: {e}"), 400
+    except ValueError as e:
+        return jsonify(error=f"Bad filters: {e}"), 400
+    except NotReady as e:
+        return not_ready(e)
+    except Exception as e:
+        return jsonify(error=f"Search failed: {e}"), 500
+
+# --------------------------------------------------------------------------- #
+#  /api/search/text — text prompt → images + similar prompts
+# --------------------------------------------------------------------------- #
+@app.route("/api/search/text", methods=["POST"])
+def query_text():
+    """Body: ``{"query": "a castle at dusk", "filters": {...}, "top_k": 10, "diversify": true}``.
+
+    ``image_matches`` rank images by final-layer CLIP similarity to the
+    prompt, ``prompt_matches`` are the closest indexed prompts.
+    """
+    if image_searcher is None:
+        return jsonify(error="Search not available"), 503
+
+    body = request.get_json(silent=True) or {}
+    try:
+        text = parse_text_query(body)
+    except ValueError as e:
+        return jsonify(error=f"Bad query: {e}"), 400
+    try:
+        opts = request_options(body)
+    except ValueError as e:
+        return jsonify(error=f"Bad options: {e}"), 400
+    try:
+        filters = request_filters(body)
+        return jsonify(success=True, results=search_text(text, filters, **opts))
+    except ValueError as e:
+        return jsonify(error=f"Bad filters: {e}"), 400
+    except NotReady as e:
+        return not_ready(e)
     except Exception as e:
         return jsonify(error=f"Search failed: {e}"), 500
 
+# --------------------------------------------------------------------------- #
+#  /api/search/batch — many images or an embedding matrix in one call
+# --------------------------------------------------------------------------- #
+def raw_embeddings(raw: bytes, dim) -> np.ndarray:
+    """(N, dim) matrix from a raw little-endian float32 body."""
+    dim = int(dim or 1536)
+    if dim not in EMBEDDING_DIMS:
+        raise ValueError(f"X-Embedding-Dim must be one of {EMBEDDING_DIMS}")
+    if len(raw) % (4 * dim):
+        raise ValueError(f"body is not a whole number of float32 × {dim} rows")
+    return np.frombuffer(raw, dtype="<f4").reshape(-1, dim)
+
+def json_embeddings(body: dict):
+    """The ``embeddings`` matrix of a JSON body, or None."""
+    if "embeddings" not in body:
+        return None
+    mat = np.asarray(body["embeddings"], dtype=np.float32)
+    if mat.ndim != 2 or mat.shape[1] not in EMBEDDING_DIMS:
+        raise ValueError(f"embeddings must be an (N, 1536) or (N, 768) matrix, got {mat.shape}")
+    return mat
+
+def _batch_embeddings():
+    """Parse an (N,1536)/(N,768) matrix from a raw float32 or JSON body, or None."""
+    if request.mimetype == "application/octet-stream":
+        return raw_embeddings(request.get_data(), request.headers.get("X-Embedding-Dim"))
+    return json_embeddings(request.get_json(silent=True) or {})
+
+def search_batch_chunk(queries, offset: int, filters=None, opts=None):
+    """Search one chunk of a batch call: an embedding matrix slice, or image bytes / uploaded files.
+
+    Entries are numbered from ``offset``; images that fail to decode get an error entry.
+    """
+    if isinstance(queries, np.ndarray):
+        res = image_searcher.search_batch(embeddings=queries, filters=filters, **(opts or {}))
+        return [{"index": offset + i, **r} for i, r in enumerate(res)]
+    imgs, ok, out = [], [], []
+    for i, f in enumerate(queries):
+        try:
+            imgs.append(decode_image(f if isinstance(f, bytes) else f.read()))
+            ok.append(i)
+        except Exception as e:
+            out.append({"index": offset + i, "error": f"Cannot decode image: {e}"})
+    for i, res in zip(ok, image_searcher.search_batch(imgs, filters=filters, **(opts or {}))):
+        out.append({"index": offset + i, **res})
+    return sorted(out, key=lambda r: r["index"])
+
+def failed_chunk(offset: int, size: int, e: Exception):
+    """Error entries for a chunk that failed after a streamed response had already started."""
+    msg = f"Search not ready yet: {e}" if isinstance(e, NotReady) else f"Search failed: {e}"
+    return [{"index": offset + i, "error": msg} for i in range(size)]
+
+def ndjson_lines(entries) -> str:
+    return "".join(json.dumps(r) + "\n" for r in entries)
+
+def ndjson_status(n: int, errors: int) -> str:
+    """Final line of a streamed batch: tells a complete stream from a cut-off one."""
+    return json.dumps({"done": True, "queries": n, "errors": errors}) + "\n"
+
+@app.route("/api/search/batch", methods=["POST"])
+def query_batch():
+    """Batch search.
+
+    Body: multipart ``images`` files, JSON ``{"embeddings": [[...], ...]}``,
+    or raw little-endian float32 rows (``application/octet-stream`` with an
+    ``X-Embedding-Dim: 1536|768`` header). Optional ``filters`` (JSON body,
+    form field or query string), ``top_k`` and ``diversify`` apply to every query. Every chunk of BATCH_CHUNK queries
+    runs as one forward pass and one search per index. Results stream back as
+    NDJSON (one ``{"index": i, ...}`` line per query) with ``?stream=1``, an
+    ``Accept: application/x-ndjson`` header, or above STREAM_THRESHOLD queries.
+    Once streaming has started a failing chunk can no longer change the
+    status code, so its queries get ``{"index": i, "error": ...}`` lines and
+    the stream always ends with ``{"done": true, "queries": n, "errors": e}``;
+    a stream without that line was cut off.
+    """
+    if image_searcher is None:
+        return jsonify(error="Search not available"), 503
+
+    try:
+        matrix = _batch_embeddings()
+    except ValueError as e:
+        return jsonify(error=f"Bad embeddings: {e}"), 400
+    try:
+        filters = request_filters(request.get_json(silent=True) or {})
+        image_searcher.filter_mask(filters)              # validate before streaming
+    except ValueError as e:
+        return jsonify(error=f"Bad filters: {e}"), 400
+    try:
+        opts = request_options(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify(error=f"Bad options: {e}"), 400
+    files = request.files.getlist("images") if matrix is None else []
+    n = len(matrix) if matrix is not None else len(files)
+    if n == 0:
+        return jsonify(error="No queries supplied"), 400
+    if n > MAX_BATCH_QUERIES:
+        return jsonify(error=f"At most {MAX_BATCH_QUERIES} queries per call"), 413
+
+    queries = matrix if matrix is not None else files
+    starts = range(0, n, BATCH_CHUNK)
+
+    stream = (request.args.get("stream") in ("1", "true")
+              or request.accept_mimetypes.best == "application/x-ndjson"
+              or n > STREAM_THRESHOLD)
+    if stream:
+        def ndjson():
+            errors = 0
+            for start in starts:
+                part = queries[start : start + BATCH_CHUNK]
+                try:
+                    entries = search_batch_chunk(part, start, filters, opts)
+                except Exception as e:
+                    entries = failed_chunk(start, len(part), e)
+                errors += sum("error" in r for r in entries)
+                yield ndjson_lines(entries)
+            yield ndjson_status(n, errors)
+        return Response(stream_with_context(ndjson()), mimetype="application/x-ndjson")
+
+    try:
+        results = [r for start in starts
+                   for r in search_batch_chunk(queries[start : start + BATCH_CHUNK], start, filters, opts)]
+    except NotReady as e:
+        return not_ready(e)
+    except Exception as e:
+        return jsonify(error=f"Search failed: {e}"), 500
+    return jsonify(success=True, results=results)
+
+# --------------------------------------------------------------------------- #
+#  /api/cache/stats — hit / miss counters for sizing the query cache
+# --------------------------------------------------------------------------- #
+@app.route("/api/cache/stats", methods=["GET"])
+def cache_stats():
+    text = text_cache.stats() if text_cache is not None else None
+    if query_cache is None:
+        return jsonify(enabled=False, text=text)
+    return jsonify(enabled=True, **query_cache.stats(), text=text)
+
+# --------------------------------------------------------------------------- #
+#  /api/admin/reload — swap in a new index version without restarting
+# --------------------------------------------------------------------------- #
+@app.route("/api/admin/reload", methods=["POST"])
+def admin_reload():
+    if not admin_allowed(request.headers.get("X-Admin-Token", ""), request.remote_addr):
+        return jsonify(error="Forbidden"), 403
+    if image_searcher is None:
+        return jsonify(error="Search not available"), 503
+    version = (request.get_json(silent=True) or {}).get("version")
+    try:
+        return jsonify(success=True, **reload_index(version))
+    except NotReady as e:
+        return not_ready(e)
+    except Exception as e:
+        return jsonify(error=f"Reload failed, still serving {image_searcher.version}: {e}"), 500
+
+# --------------------------------------------------------------------------- #
+#  /api/health, /api/ready — liveness and load progress (never load anything)
+# --------------------------------------------------------------------------- #
+@app.route("/api/health", methods=["GET"])
+def health():
+    return jsonify(status="ok")
+
+@app.route("/api/ready", methods=["GET"])
+def ready():
+    status, body = readiness()
+    return jsonify(body), status
+
+@app.errorhandler(NotReady)
+def handle_not_ready(e):
+    # routes without their own handling (upload, batch filter validation, streams)
+    return not_ready(e)
+
+# --------------------------------------------------------------------------- #
+#  /metrics — Prometheus text exposition
+# --------------------------------------------------------------------------- #
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    if not METRICS_ENABLED:
+        return jsonify(error="Metrics disabled (SEARCH_METRICS=0)"), 404
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# --------------------------------------------------------------------------- #
+#  /api/admin/profile — collapsed stacks from the sampling profiler
+# --------------------------------------------------------------------------- #
+@app.route("/api/admin/profile", methods=["GET"])
+def admin_profile():
+    """``frame;frame;… count`` lines for flamegraph.pl / speedscope.
+
+    ``?top=N`` keeps the N hottest stacks, ``?reset=1`` starts a fresh window.
+    """
+    if not admin_allowed(request.headers.get("X-Admin-Token", ""), request.remote_addr):
+        return jsonify(error="Forbidden"), 403
+    if profiler is None:
+        return jsonify(error="Profiler off; set SEARCH_PROFILE_HZ"), 404
+    try:
+        top = int(request.args["top"]) if "top" in request.args else None
+    except ValueError:
+        return jsonify(error="top must be an integer"), 400
+    samples = profiler.samples
+    body = profiler.collapsed(top=top, reset=request.args.get("reset") in ("1", "true"))
+    return Response(body, mimetype="text/plain", headers={"X-Profile-Samples": str(samples)})
+
 ###############################################################################
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5001, debug=True)
+    # development server; see server_asgi.py for the production serving mode
+    app.run(host="0.0.0.0", port=5001, debug=os.environ.get("FLASK_DEBUG", "1") == "1")
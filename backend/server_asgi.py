@@ -0,0 +1,448 @@
+# server_asgi.py
+"""ASGI serving mode with the same /api/upload and /api/search contract as server.py.
+
+    uvicorn server_asgi:app --host 0.0.0.0 --port 5001
+
+The event loop only parses requests and awaits I/O:
+  * image URLs are fetched with one pooled ``httpx.AsyncClient`` with
+    connect / read timeouts and a byte limit;
+  * cache lookup + image decoding run on a bounded decode pool, CLIP
+    inference + FAISS search on a bounded inference pool (through the
+    micro-batcher when it is on).
+When a pool is full the request is rejected at once with 429 and a
+Retry-After header; work that waits longer than QUEUE_TIMEOUT gets 503.
+
+Searcher, micro-batchers and caches are the ones built by server.py;
+``/api/search/text`` and ``/api/search/batch`` are the same text and batch
+searches as there (batch chunks run one at a time on the inference pool), and ``/metrics``
+adds the two pools' depth and rejections to server.py's metrics.
+"""
+import asyncio
+import os
+import time
+from datetime import datetime
+
+import httpx
+import numpy as np
+import uvicorn
+from starlette.applications import Starlette
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Match, Route
+
+import metrics
+import server
+from batching import BoundedExecutor, PoolFull
+from search import NotReady
+from server import ImageDecodeError, allowed, image_searcher, parse_diversify, parse_filters, query_cache
+
+###############################################################################
+#  Configuration
+###############################################################################
+DECODE_WORKERS   = int(os.environ.get("ASGI_DECODE_WORKERS", os.cpu_count() or 4))
+DECODE_QUEUE     = int(os.environ.get("ASGI_DECODE_QUEUE", 64))
+# inference threads mostly wait on the micro-batcher, so allow one per batch slot
+INFER_WORKERS    = int(os.environ.get("ASGI_INFER_WORKERS", max(1, server.MAX_BATCH_SIZE)))
+INFER_QUEUE      = int(os.environ.get("ASGI_INFER_QUEUE", 64))
+QUEUE_TIMEOUT    = float(os.environ.get("ASGI_QUEUE_TIMEOUT", 30))
+RETRY_AFTER      = "1"
+
+FETCH_TIMEOUT    = float(os.environ.get("ASGI_FETCH_TIMEOUT", 10))
+FETCH_CONNECT    = float(os.environ.get("ASGI_FETCH_CONNECT_TIMEOUT", 3))
+FETCH_MAX_CONNS  = int(os.environ.get("ASGI_FETCH_MAX_CONNECTIONS", 64))
+MAX_IMAGE_BYTES  = int(os.environ.get("ASGI_MAX_IMAGE_BYTES", 20 * 2**20))
+
+decode_pool = BoundedExecutor(DECODE_WORKERS, DECODE_QUEUE, name="decode")
+infer_pool = BoundedExecutor(INFER_WORKERS, INFER_QUEUE, name="infer")
+http_client: httpx.AsyncClient = None
+
+
+class PayloadTooLarge(ValueError):
+    pass
+
+###############################################################################
+#  Metrics
+###############################################################################
+@metrics.collector("pool_pending", "Calls queued or running on each bounded pool")
+def _pool_pending():
+    return [({"pool": name}, pool.pending()) for name, pool in (("decode", decode_pool), ("infer", infer_pool))]
+
+@metrics.collector("pool_rejected_total", "Calls turned away with 429 because a pool was full", kind="counter")
+def _pool_rejected():
+    return [({"pool": name}, pool.rejected) for name, pool in (("decode", decode_pool), ("infer", infer_pool))]
+
+
+class TimingMiddleware:
+    """Pure ASGI middleware recording latency and status per route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        t0 = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            metrics.observe_request(_route_of(scope), scope["method"], status, time.perf_counter() - t0)
+
+
+def _route_of(scope) -> str:
+    for route in scope["app"].routes if "app" in scope else ():
+        if route.matches(scope)[0] != Match.NONE:
+            return route.path
+    return "unmatched"
+
+###############################################################################
+#  Helpers
+###############################################################################
+def error(msg: str, status: int, **headers) -> JSONResponse:
+    return JSONResponse({"error": msg}, status_code=status, headers=headers or None)
+
+async def run_in(pool: BoundedExecutor, fn, *args):
+    """Run ``fn`` on ``pool``; PoolFull when the pool is saturated, TimeoutError after QUEUE_TIMEOUT."""
+    fut = pool.submit(fn, *args)
+    return await asyncio.wait_for(asyncio.wrap_future(fut), QUEUE_TIMEOUT)
+
+async def fetch_image(url: str) -> bytes:
+    """GET ``url`` with the shared client, refusing bodies over MAX_IMAGE_BYTES."""
+    async with http_client.stream("GET", url) as resp:
+        resp.raise_for_status()
+        if int(resp.headers.get("content-length") or 0) > MAX_IMAGE_BYTES:
+            raise PayloadTooLarge(f"image larger than {MAX_IMAGE_BYTES} bytes")
+        chunks, size = [], 0
+        async for chunk in resp.aiter_bytes():
+            size += len(chunk)
+            if size > MAX_IMAGE_BYTES:
+                raise PayloadTooLarge(f"image larger than {MAX_IMAGE_BYTES} bytes")
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+async def read_upload(upload) -> bytes:
+    data = await upload.read(MAX_IMAGE_BYTES + 1)
+    if len(data) > MAX_IMAGE_BYTES:
+        raise PayloadTooLarge(f"image larger than {MAX_IMAGE_BYTES} bytes")
+    return data
+
+def search_options(body: dict, form=None, query_params=None) -> dict:
+    """``top_k`` / ``diversify`` from the JSON body, form fields or query string; ValueError when invalid."""
+    opts = {}
+    for key, parse in (("top_k", server.parse_top_k), ("diversify", parse_diversify)):
+        value = body.get(key)
+        if value is None:
+            value = (form.get(key) if form is not None else None) or (query_params or {}).get(key)
+        opts[key] = parse(value)
+    return opts
+
+async def search_bytes(img_bytes: bytes, filters=None, top_k=None, diversify=None):
+    """Decode on the decode pool, then search on the inference pool (skipped on a cache hit)."""
+    hit, img, keys = await run_in(decode_pool, server.decode_image_bytes, img_bytes, filters, top_k, diversify)
+    if hit is not None:
+        return hit
+    return await run_in(infer_pool, server.search_decoded, img, filters, keys, top_k, diversify)
+
+async def guarded(coro):
+    """Map pool / timeout / input errors of an image search onto HTTP responses."""
+    try:
+        return await coro, None
+    except PoolFull:
+        return None, error("Server busy, retry later", 429, **{"Retry-After": RETRY_AFTER})
+    except asyncio.TimeoutError:
+        return None, error("Search timed out in queue", 503, **{"Retry-After": RETRY_AFTER})
+    except NotReady as e:
+        return None, error(f"Search not ready yet: {e}", 503, **{"Retry-After": server.RETRY_AFTER})
+    except ImageDecodeError as e:
+        return None, error(f"Cannot decode image: {e}", 400)
+    except ValueError as e:
+        return None, error(f"Bad filters: {e}", 400)
+    except Exception as e:
+        return None, error(f"Search failed: {e}", 500)
+
+async def read_json(request):
+    if request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            return await request.json() or {}
+        except ValueError:
+            return {}
+    return {}
+
+###############################################################################
+#  Routes
+###############################################################################
+async def upload(request):
+    form = await request.form()
+    f = form.get("image")
+    if f is None or not hasattr(f, "read"):
+        return error("No image file provided", 400)
+    if not f.filename or not allowed(f.filename):
+        return error("Invalid or missing filename", 400)
+    if image_searcher is None:
+        return error("Search not available", 503)
+
+    try:
+        opts = search_options({}, form, request.query_params)
+    except ValueError as e:
+        return error(f"Bad options: {e}", 400)
+    try:
+        img_bytes = await read_upload(f)
+    except PayloadTooLarge as e:
+        return error(str(e), 413)
+    res, err = await guarded(search_bytes(img_bytes, **opts))
+    if err is not None:
+        return err
+    search_res, emb_stack, _ = res
+
+    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return JSONResponse({"success": True, "filename": f"upload_{ts}.png",
+                         "embedding": emb_stack.tolist(), "results": search_res})
+
+async def query(request):
+    if image_searcher is None:
+        return error("Search not available", 503)
+
+    body = await read_json(request)
+    form = None if body else await request.form()
+    try:
+        filters = body.get("filters")
+        if filters is None:
+            filters = (form.get("filters") if form is not None else None) or request.query_params.get("filters")
+        filters = parse_filters(filters)
+    except ValueError as e:
+        return error(f"Bad filters: {e}", 400)
+    try:
+        opts = search_options(body, form, request.query_params)
+    except ValueError as e:
+        return error(f"Bad options: {e}", 400)
+
+    # ---------- case 1: embedding provided (1536-d stacked or 768-d final) --
+    if "embedding" in body:
+        try:
+            vec = np.asarray(body["embedding"], dtype=np.float32)
+            if vec.shape == (1536,):
+                kwargs = {"emb_stack": vec, **opts}
+            elif vec.shape == (768,):
+                kwargs = {"emb_final": vec, **opts}
+            else:
+                raise ValueError("embedding must be a length-1536 stacked or length-768 final vector")
+        except Exception as e:
+            return error(f"Bad embedding: {e}", 400)
+        res, err = await guarded(run_in(infer_pool, lambda: image_searcher.search_vectors(filters=filters, **kwargs)[0]))
+        return err or JSONResponse({"success": True, "results": res})
+
+    # ---------- case 2: image URL -------------------------------------------
+    if "image_url" in body:
+        try:
+            img_bytes = await fetch_image(body["image_url"])
+        except PayloadTooLarge as e:
+            return error(str(e), 413)
+        except Exception as e:
+            return error(f"URL fetch failed: {e}", 400)
+
+    # ---------- case 3: posted image file -----------------------------------
+    elif form is not None and hasattr(form.get("image"), "read"):
+        f = form["image"]
+        if not f.filename or not allowed(f.filename):
+            return error("Invalid or missing filename", 400)
+        try:
+            img_bytes = await read_upload(f)
+        except PayloadTooLarge as e:
+            return error(str(e), 413)
+    else:
+        return error("No query supplied", 400)
+
+    res, err = await guarded(search_bytes(img_bytes, filters, **opts))
+    return err or JSONResponse({"success": True, "results": res[0]})
+
+async def query_text(request):
+    if image_searcher is None:
+        return error("Search not available", 503)
+
+    body = await read_json(request)
+    try:
+        text = server.parse_text_query(body)
+    except ValueError as e:
+        return error(f"Bad query: {e}", 400)
+    try:
+        filters = parse_filters(body.get("filters"))
+    except ValueError as e:
+        return error(f"Bad filters: {e}", 400)
+    try:
+        opts = search_options(body)
+    except ValueError as e:
+        return error(f"Bad options: {e}", 400)
+    res, err = await guarded(run_in(infer_pool, server.search_text, text, filters, opts["top_k"], opts["diversify"]))
+    return err or JSONResponse({"success": True, "results": res})
+
+async def query_batch(request):
+    """Same contract as server.py's ``/api/search/batch``, streamed chunks included."""
+    if image_searcher is None:
+        return error("Search not available", 503)
+
+    body, form = {}, None
+    try:
+        if request.headers.get("content-type", "").startswith("application/octet-stream"):
+            matrix = server.raw_embeddings(await request.body(), request.headers.get("x-embedding-dim"))
+        else:
+            body = await read_json(request)
+            matrix = server.json_embeddings(body)
+    except ValueError as e:
+        return error(f"Bad embeddings: {e}", 400)
+    if matrix is None:
+        form = await request.form(max_files=server.MAX_BATCH_QUERIES + 1)
+    try:
+        filters = body.get("filters")
+        if filters is None:
+            filters = (form.get("filters") if form is not None else None) or request.query_params.get("filters")
+        filters = parse_filters(filters)
+        opts = search_options(body, form, request.query_params)
+    except ValueError as e:
+        return error(f"Bad options: {e}", 400)
+    _, err = await guarded(run_in(infer_pool, image_searcher.filter_mask, filters))   # validate before streaming
+    if err is not None:
+        return err
+
+    files = [f for f in form.getlist("images") if hasattr(f, "read")] if form is not None else []
+    n = len(matrix) if matrix is not None else len(files)
+    if n == 0:
+        return error("No queries supplied", 400)
+    if n > server.MAX_BATCH_QUERIES:
+        return error(f"At most {server.MAX_BATCH_QUERIES} queries per call", 413)
+    if any((f.size or 0) > MAX_IMAGE_BYTES for f in files):
+        return error(f"image larger than {MAX_IMAGE_BYTES} bytes", 413)
+
+    async def search_chunk(start):
+        if matrix is not None:
+            part = matrix[start : start + server.BATCH_CHUNK]
+        else:
+            part = [await f.read() for f in files[start : start + server.BATCH_CHUNK]]
+        return await run_in(infer_pool, server.search_batch_chunk, part, start, filters, opts)
+
+    starts = range(0, n, server.BATCH_CHUNK)
+    stream = (request.query_params.get("stream") in ("1", "true")
+              or "application/x-ndjson" in request.headers.get("accept", "")
+              or n > server.STREAM_THRESHOLD)
+    if not stream:
+        async def collect():
+            return [r for start in starts for r in await search_chunk(start)]
+        results, err = await guarded(collect())
+        return err or JSONResponse({"success": True, "results": results})
+
+    async def ndjson():
+        errors = 0
+        for start in starts:
+            try:
+                entries = await search_chunk(start)
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    e = TimeoutError("timed out in queue")
+                entries = server.failed_chunk(start, min(server.BATCH_CHUNK, n - start), e)
+            errors += sum("error" in r for r in entries)
+            yield server.ndjson_lines(entries)
+        yield server.ndjson_status(n, errors)
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+async def cache_stats(request):
+    text = server.text_cache.stats() if server.text_cache is not None else None
+    if query_cache is None:
+        return JSONResponse({"enabled": False, "text": text})
+    return JSONResponse({"enabled": True, **query_cache.stats(), "text": text})
+
+async def admin_reload(request):
+    token = request.headers.get("x-admin-token", "")
+    if not server.admin_allowed(token, request.client.host if request.client else ""):
+        return error("Forbidden", 403)
+    if image_searcher is None:
+        return error("Search not available", 503)
+    version = (await read_json(request)).get("version")
+    try:
+        # plain thread, not the inference pool: a reload must not queue behind queries
+        info = await asyncio.to_thread(server.reload_index, version)
+    except NotReady as e:
+        return error(f"Search not ready yet: {e}", 503, **{"Retry-After": server.RETRY_AFTER})
+    except Exception as e:
+        return error(f"Reload failed, still serving {image_searcher.version}: {e}", 500)
+    return JSONResponse({"success": True, **info})
+
+async def health(request):
+    return JSONResponse({"status": "ok"})
+
+async def ready(request):
+    status, body = server.readiness()
+    return JSONResponse(body, status_code=status)
+
+async def metrics_endpoint(request):
+    if not server.METRICS_ENABLED:
+        return error("Metrics disabled (SEARCH_METRICS=0)", 404)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+async def admin_profile(request):
+    token = request.headers.get("x-admin-token", "")
+    if not server.admin_allowed(token, request.client.host if request.client else ""):
+        return error("Forbidden", 403)
+    if server.profiler is None:
+        return error("Profiler off; set SEARCH_PROFILE_HZ", 404)
+    try:
+        top = int(request.query_params["top"]) if "top" in request.query_params else None
+    except ValueError:
+        return error("top must be an integer", 400)
+    samples = server.profiler.samples
+    body = server.profiler.collapsed(top=top, reset=request.query_params.get("reset") in ("1", "true"))
+    return PlainTextResponse(body, headers={"X-Profile-Samples": str(samples)})
+
+async def pool_stats(request):
+    return JSONResponse({
+        name: {"workers": pool.workers, "capacity": pool.capacity,
+               "pending": pool.pending(), "rejected": pool.rejected}
+        for name, pool in (("decode", decode_pool), ("infer", infer_pool))
+    })
+
+###############################################################################
+#  App
+###############################################################################
+async def startup():
+    global http_client
+    http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(FETCH_TIMEOUT, connect=FETCH_CONNECT),
+        limits=httpx.Limits(max_connections=FETCH_MAX_CONNS, max_keepalive_connections=FETCH_MAX_CONNS // 2),
+        follow_redirects=True,
+    )
+
+async def shutdown():
+    await http_client.aclose()
+    decode_pool.shutdown(wait=False)
+    infer_pool.shutdown(wait=False)
+
+app = Starlette(
+    routes=[
+        Route("/api/upload", upload, methods=["POST"]),
+        Route("/api/search", query, methods=["POST"]),
+        Route("/api/search/text", query_text, methods=["POST"]),
+        Route("/api/search/batch", query_batch, methods=["POST"]),
+        Route("/api/cache/stats", cache_stats, methods=["GET"]),
+        Route("/api/pool/stats", pool_stats, methods=["GET"]),
+        Route("/api/admin/reload", admin_reload, methods=["POST"]),
+        Route("/api/admin/profile", admin_profile, methods=["GET"]),
+        Route("/api/health", health, methods=["GET"]),
+        Route("/api/ready", ready, methods=["GET"]),
+        Route("/metrics", metrics_endpoint, methods=["GET"]),
+    ],
+    on_startup=[startup],
+    on_shutdown=[shutdown],
+)
+# same permissive CORS policy as flask_cors.CORS(app)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+if server.METRICS_ENABLED:
+    app.add_middleware(TimingMiddleware)
+
+###############################################################################
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=5001)
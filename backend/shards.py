@@ -0,0 +1,433 @@
+"""Sharded indexes: N partitions per index, searched in parallel worker processes.
+
+``build_faiss_index.py --shards N`` splits the rows of image_index,
+prompt_index and image_coarse_index into N contiguous ranges and builds
+one index per range:
+
+    shards.json                          layout: per index, each shard's path, global id offset and rows
+    shards/shard-000/image_index.faiss   rows [0, n₀) of image_index, ids local to the shard
+    shards/shard-001/image_index.faiss   rows [n₀, n₀+n₁) …
+
+``ShardPool`` starts worker processes that each load (memory-mapped) the
+shards assigned to them; ``ShardedIndex`` looks like a FAISS index to the
+searcher – ``ntotal``, ``d``, ``search`` – but fans every search out to all
+workers at once and merges the per-shard top-k lists with a heap, adding
+each shard's offset so ids map straight back to metadata rows.
+
+Workers are ``python shards.py worker`` processes speaking (command, args)
+messages over an authenticated ``multiprocessing.connection``.  By default
+the pool starts them locally, one per shard, as stand-ins for shard servers
+on other hosts; ``SEARCH_SHARD_ADDRESSES`` points it at running ones.
+
+    python shards.py check --rows 200000 --shards 4    # sharded vs single index on synthetic data
+    SHARD_AUTHKEY=… python shards.py worker --listen 0.0.0.0:7100
+"""
+import argparse
+import heapq
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import AuthenticationError, Client, Listener
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+MANIFEST_FILE = "shards.json"
+SHARDS_DIR = "shards"
+STARTUP_TIMEOUT = 600                # seconds for a worker to load its shards
+AUTHKEY_ENV = "SHARD_AUTHKEY"         # hex key shared by a pool and remote workers
+
+
+def exists(index_dir: str) -> bool:
+    return os.path.exists(os.path.join(index_dir, MANIFEST_FILE))
+
+
+def load_manifest(index_dir: str) -> Dict:
+    with open(os.path.join(index_dir, MANIFEST_FILE), "r", encoding="utf-8") as fp:
+        return json.load(fp)
+
+
+# ------------------------------------------------------------------
+#  Build side
+# ------------------------------------------------------------------
+
+def shard_bounds(n: int, n_shards: int) -> List[Tuple[int, int]]:
+    """``n_shards`` contiguous [start, end) row ranges of near-equal size."""
+    edges = np.linspace(0, n, n_shards + 1).astype(np.int64)
+    return [(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:])]
+
+
+def save_sharded(out_dir: str, name: str, vectors: np.ndarray, n_shards: int,
+                 build_fn: Callable[[str, np.ndarray], Tuple[object, Dict]]) -> Tuple[Dict, List[Dict]]:
+    """Build ``name`` as ``n_shards`` indexes with ``build_fn`` and write them under shards/.
+
+    ``build_fn`` gets each shard as ``vectors[start:end]`` – a view, not a copy.
+
+    Returns (params of the first shard, manifest entries).
+    """
+    import faiss
+
+    entries, params = [], None
+    for s, (start, end) in enumerate(shard_bounds(len(vectors), n_shards)):
+        rel = os.path.join(SHARDS_DIR, f"shard-{s:03}", f"{name}.faiss")
+        os.makedirs(os.path.dirname(os.path.join(out_dir, rel)), exist_ok=True)
+        index, shard_params = build_fn(f"{name} shard {s}", vectors[start:end])
+        faiss.write_index(index, os.path.join(out_dir, rel))
+        entries.append({"path": rel, "offset": start, "rows": end - start})
+        params = params or shard_params
+        del index
+    return {**params, "shards": n_shards}, entries
+
+
+def write_manifest(out_dir: str, indexes: Dict[str, List[Dict]], dims: Dict[str, int]):
+    manifest = {name: {"d": dims[name], "ntotal": sum(e["rows"] for e in entries), "shards": entries}
+                for name, entries in indexes.items()}
+    with open(os.path.join(out_dir, MANIFEST_FILE), "w", encoding="utf-8") as fp:
+        json.dump(manifest, fp, indent=2)
+
+
+# ------------------------------------------------------------------
+#  Worker process
+# ------------------------------------------------------------------
+
+def _serve_connection(conn):
+    """Load the shards a pool assigns over ``conn``, then answer (command, args) until "stop"."""
+    try:
+        cmd, (index_dir, assigned, mmap, threads) = conn.recv()
+        import faiss
+        from filter_index import search_params
+        from index_factory import apply_search_params, read_index
+
+        if threads:
+            faiss.omp_set_num_threads(threads)
+        shards = {name: [(read_index(os.path.join(index_dir, e["path"]), mmap=mmap), e) for e in entries]
+                  for name, entries in assigned.items()}
+    except EOFError:
+        return
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+        return
+    conn.send(("ok", {name: [int(ix.ntotal) for ix, _ in lst] for name, lst in shards.items()}))
+
+    while True:
+        try:
+            cmd, args = conn.recv()
+        except EOFError:
+            return
+        if cmd == "stop":
+            return
+        try:
+            if cmd == "search":
+                name, queries, k, masks = args
+                out = []
+                for (index, entry), mask in zip(shards[name], masks or itertools.repeat(None)):
+                    kk = min(k, index.ntotal)
+                    if kk == 0 or (mask is not None and not mask.any()):
+                        continue
+                    if mask is None:
+                        d, i = index.search(queries, kk)
+                    else:
+                        params, keepalive = search_params(index, mask)
+                        d, i = index.search(queries, kk, params=params)
+                        del keepalive
+                    out.append((d, np.where(i >= 0, i + entry["offset"], -1)))
+                conn.send(("ok", out))
+            elif cmd == "params":
+                name, nprobe, ef_search = args
+                conn.send(("ok", [apply_search_params(index, nprobe, ef_search) for index, _ in shards[name]]))
+            else:
+                conn.send(("error", f"unknown command {cmd!r}"))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+def serve(host: str, port: int, authkey: bytes, once: bool = False):
+    """Shard worker: accept pool connections, each with its own set of loaded shards.
+
+    The bound port is printed as ``PORT <n>`` on stdout (how a pool finds
+    the local stand-ins it started); everything after goes to stderr.
+    With ``once`` the process exits when its first pool disconnects.
+    """
+    with Listener((host, port), authkey=authkey) as listener:
+        print(f"PORT {listener.address[1]}", flush=True)
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        while True:
+            try:
+                conn = listener.accept()
+            except AuthenticationError:
+                continue
+            if once:
+                with conn:
+                    _serve_connection(conn)
+                return
+            threading.Thread(target=_serve_connection, args=(conn,), daemon=True).start()
+
+
+def _authkey() -> Optional[bytes]:
+    key = os.environ.get(AUTHKEY_ENV)
+    return bytes.fromhex(key) if key else None
+
+
+class ShardWorkerError(RuntimeError):
+    """A shard worker failed to start, to load its shards or to answer."""
+
+
+class _Worker:
+    """Pool-side handle of one worker connection (and its process, for local stand-ins)."""
+
+    def __init__(self, conn, name: str, proc: Optional[subprocess.Popen] = None):
+        self.conn, self.name, self.proc = conn, name, proc
+        self.assigned: Dict[str, List[Dict]] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def start_local(cls, authkey: bytes, name: str) -> "_Worker":
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "worker", "--listen", "127.0.0.1:0", "--once"],
+                                stdout=subprocess.PIPE, text=True, env={**os.environ, AUTHKEY_ENV: authkey.hex()})
+        line = proc.stdout.readline()
+        proc.stdout.close()
+        if not line.startswith("PORT "):
+            proc.kill()
+            raise ShardWorkerError(f"{name} failed to start (exit code {proc.wait()})")
+        return cls(Client(("127.0.0.1", int(line.split()[1])), authkey=authkey), name, proc)
+
+    @classmethod
+    def connect(cls, address: str, authkey: bytes) -> "_Worker":
+        host, port = address.rsplit(":", 1)
+        return cls(Client((host, int(port)), authkey=authkey), f"shard-worker@{address}")
+
+    def _recv(self, timeout: Optional[float] = None):
+        if timeout is not None and not self.conn.poll(timeout):
+            raise ShardWorkerError(f"{self.name} did not answer within {timeout} s")
+        try:
+            status, payload = self.conn.recv()
+        except EOFError:
+            raise ShardWorkerError(f"{self.name} disconnected") from None
+        if status != "ok":
+            raise ShardWorkerError(f"{self.name}: {payload}")
+        return payload
+
+    def load(self, index_dir: str, assigned: Dict[str, List[Dict]], mmap: bool, threads: int):
+        self.assigned = assigned
+        self.conn.send(("load", (os.path.abspath(index_dir), assigned, mmap, threads)))
+
+    def wait_ready(self, timeout: float) -> Dict[str, List[int]]:
+        """Rows of each loaded shard, as reported once loading finishes."""
+        with self.lock:
+            return self._recv(timeout)
+
+    def call(self, cmd: str, args=None):
+        with self.lock:
+            self.conn.send((cmd, args))
+            return self._recv()
+
+    def close(self):
+        with self.lock:
+            try:
+                self.conn.send(("stop", None))
+                self.conn.close()
+            except OSError:
+                pass
+        if self.proc is not None:
+            try:
+                self.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+
+
+# ------------------------------------------------------------------
+#  Pool + index proxy
+# ------------------------------------------------------------------
+
+def merge_topk(parts: List[Tuple[np.ndarray, np.ndarray]], n: int, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Merge per-shard (scores, global ids), each sorted best-first, into the overall top-``k``.
+
+    Padded with (-inf, -1) like ``rerank.rescore`` when fewer than ``k`` rows match.
+    """
+    out_d = np.full((n, k), -np.inf, dtype=np.float32)
+    out_i = np.full((n, k), -1, dtype=np.int64)
+    for q in range(n):
+        streams = [zip(d[q].tolist(), i[q].tolist()) for d, i in parts]
+        merged = heapq.merge(*streams, key=lambda hit: -hit[0])
+        for j, (score, idx) in enumerate(itertools.islice(((s, i) for s, i in merged if i >= 0), k)):
+            out_d[q, j], out_i[q, j] = score, idx
+    return out_d, out_i
+
+
+class ShardPool:
+    """Workers serving every shard of one index version.
+
+    With no ``addresses`` one local worker process per shard (at most
+    ``workers``) is started; otherwise the pool connects to already running
+    ``python shards.py worker --listen host:port`` processes, which must see
+    ``index_dir`` at the same path and share the ``SHARD_AUTHKEY`` (hex)
+    environment variable. Shard ``s`` of every index goes to worker
+    ``s % n_workers``, so one worker holds the same row range of the image,
+    prompt and coarse indexes.
+    """
+
+    def __init__(self, index_dir: str, workers: Optional[int] = None, mmap: bool = True,
+                 addresses: Optional[List[str]] = None):
+        self.index_dir = index_dir
+        self.manifest = load_manifest(index_dir)
+        n_shards = max(len(v["shards"]) for v in self.manifest.values())
+        self.workers: List[_Worker] = []
+        self._closed = False
+        self._fanout = None
+        try:
+            if addresses:
+                authkey = _authkey()
+                if authkey is None:
+                    raise ShardWorkerError(f"set {AUTHKEY_ENV} to connect to remote shard workers")
+                self.workers = [_Worker.connect(a, authkey) for a in addresses[:n_shards]]
+                threads = 0                                   # leave remote hosts' OpenMP alone
+            else:
+                authkey = os.urandom(16)
+                n_workers = min(workers or n_shards, n_shards)
+                self.workers = [_Worker.start_local(authkey, f"shard-worker-{w}") for w in range(n_workers)]
+                threads = max(1, (os.cpu_count() or 1) // n_workers)
+
+            n_workers = len(self.workers)
+            for w, worker in enumerate(self.workers):
+                assigned = {name: [e for s, e in enumerate(v["shards"]) if s % n_workers == w]
+                            for name, v in self.manifest.items()}
+                worker.load(index_dir, assigned, mmap, threads)
+            for worker in self.workers:
+                loaded = worker.wait_ready(STARTUP_TIMEOUT)
+                for name, sizes in loaded.items():
+                    expected = [e["rows"] for e in worker.assigned[name]]
+                    if sizes != expected:
+                        raise ShardWorkerError(f"{name} shards of {worker.name} hold {sizes} rows, "
+                                               f"manifest says {expected}")
+        except Exception:
+            self.close()
+            raise
+        self._fanout = ThreadPoolExecutor(max_workers=len(self.workers), thread_name_prefix="shard-fanout")
+        where = "remote workers" if addresses else f"local worker processes ({threads} threads each)"
+        print(f"   {n_shards} shards on {len(self.workers)} {where}")
+
+    def _all(self, cmd: str, args_for: Callable[[_Worker], object]) -> List:
+        """Send ``cmd`` to every worker at once and collect the replies in worker order."""
+        futs = [self._fanout.submit(w.call, cmd, args_for(w)) for w in self.workers]
+        return [f.result() for f in futs]
+
+    def search(self, name: str, queries: np.ndarray, k: int, mask: Optional[np.ndarray] = None):
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+
+        def args_for(w):
+            masks = None
+            if mask is not None:
+                masks = [mask[e["offset"]:e["offset"] + e["rows"]] for e in w.assigned[name]]
+            return name, queries, k, masks
+
+        parts = [part for res in self._all("search", args_for) for part in res]
+        return merge_topk(parts, len(queries), k)
+
+    def set_search_params(self, name: str, nprobe: Optional[int], ef_search: Optional[int]) -> Dict[str, int]:
+        applied = [a for res in self._all("params", lambda w: (name, nprobe, ef_search)) for a in res]
+        return applied[0] if applied else {}
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for w in self.workers:
+            w.close()
+        if self._fanout is not None:
+            self._fanout.shutdown(wait=False)
+
+
+class ShardedIndex:
+    """The slice of a ``ShardPool`` serving one index, with the FAISS search signature."""
+
+    def __init__(self, pool: ShardPool, name: str):
+        self.pool = pool
+        self.name = name
+        self.d = pool.manifest[name]["d"]
+        self.ntotal = pool.manifest[name]["ntotal"]
+        self.kind = f"{len(pool.manifest[name]['shards'])} shards"
+
+    def search(self, queries: np.ndarray, k: int, mask: Optional[np.ndarray] = None):
+        return self.pool.search(self.name, queries, k, mask)
+
+    def set_search_params(self, nprobe: Optional[int] = None, ef_search: Optional[int] = None) -> Dict[str, int]:
+        return self.pool.set_search_params(self.name, nprobe, ef_search)
+
+
+# ------------------------------------------------------------------
+#  Single-machine check
+# ------------------------------------------------------------------
+
+def check(args):
+    import faiss
+    rng = np.random.default_rng(0)
+    xb = rng.standard_normal((args.rows, args.dim), dtype=np.float32)
+    xb /= np.linalg.norm(xb, axis=1, keepdims=True)
+    xq = np.ascontiguousarray(xb[rng.choice(args.rows, args.queries, replace=False)])
+
+    def build_flat(_, vectors):
+        index = faiss.IndexFlatIP(vectors.shape[1])
+        index.add(vectors)
+        return index, {"type": "flat"}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _, entries = save_sharded(tmp, "image_index", xb, args.shards, build_flat)
+        write_manifest(tmp, {"image_index": entries}, {"image_index": args.dim})
+        single, _ = build_flat(None, xb)
+
+        pool = ShardPool(tmp, workers=args.workers, mmap=True)
+        try:
+            sharded = ShardedIndex(pool, "image_index")
+            t0 = time.perf_counter()
+            d_ref, i_ref = single.search(xq, args.k)
+            t1 = time.perf_counter()
+            d_sh, i_sh = sharded.search(xq, args.k)
+            t2 = time.perf_counter()
+            mask = rng.random(args.rows) < 0.1
+            _, i_masked = sharded.search(xq, args.k, mask=mask)
+        finally:
+            pool.close()
+
+    same = float((i_ref == i_sh).mean())
+    ok = same == 1.0 and bool(mask[i_masked[i_masked >= 0]].all())
+    print(f"single index : {1000 * (t1 - t0):8.1f} ms for {args.queries} queries")
+    print(f"{args.shards} shards     : {1000 * (t2 - t1):8.1f} ms  (ids identical: {same:.2%}, "
+          f"max |Δscore| {np.abs(d_ref - d_sh).max():.2e})")
+    print(f"filtered     : all hits inside mask = {bool(mask[i_masked[i_masked >= 0]].all())}")
+    print("✅ sharded search matches" if ok else "❌ sharded search differs")
+    sys.exit(0 if ok else 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shard workers and a single-machine sharding check")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    wk = sub.add_parser("worker", help="Serve shards to searcher pools")
+    wk.add_argument("--listen", default="127.0.0.1:0", help="host:port (port 0 = any free port)")
+    wk.add_argument("--once", action="store_true", help="Exit when the first pool disconnects")
+    ck = sub.add_parser("check", help="Sharded vs single flat index on synthetic vectors")
+    ck.add_argument("--rows", type=int, default=200_000)
+    ck.add_argument("--dim", type=int, default=768)
+    ck.add_argument("--shards", type=int, default=4)
+    ck.add_argument("--workers", type=int, default=None)
+    ck.add_argument("--queries", type=int, default=256)
+    ck.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.cmd == "check":
+        check(args)
+        return
+    authkey = _authkey()
+    if authkey is None:
+        sys.exit(f"set {AUTHKEY_ENV} (hex) to the key shared with the searcher")
+    host, port = args.listen.rsplit(":", 1)
+    serve(host, int(port), authkey, once=args.once)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the backend is a flat directory of scripts; make them importable as modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
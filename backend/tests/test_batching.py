@@ -0,0 +1,141 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from batching import BoundedExecutor, MicroBatcher, PoolFull
+
+
+class GatedFn:
+    """batch_fn that records its batches and holds the first one until released."""
+
+    def __init__(self, fail_on=None):
+        self.batches = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.fail_on = fail_on
+
+    def __call__(self, items):
+        self.batches.append(list(items))
+        if len(self.batches) == 1:
+            self.started.set()
+            assert self.release.wait(10)
+        if self.fail_on is not None and self.fail_on in items:
+            raise ValueError(f"bad item {self.fail_on}")
+        return [x * 10 for x in items]
+
+
+@pytest.fixture
+def batcher_for():
+    made = []
+
+    def make(fn, **kwargs):
+        b = MicroBatcher(fn, **kwargs)
+        made.append(b)
+        return b
+
+    yield make
+    for b in made:
+        b.close(timeout=5)
+
+
+def test_queued_calls_coalesce_into_batches(batcher_for):
+    fn = GatedFn()
+    batcher = batcher_for(fn, max_batch_size=4, max_wait_ms=0)
+    first = batcher.submit(0)
+    assert fn.started.wait(5)                            # worker is busy with [0]
+    futs = [batcher.submit(i) for i in range(1, 7)]      # these queue up meanwhile
+    fn.release.set()
+
+    assert first.result(5) == 0 and [f.result(5) for f in futs] == [10, 20, 30, 40, 50, 60]
+    assert fn.batches == [[0], [1, 2, 3, 4], [5, 6]]
+    assert batcher.batches == 3 and batcher.mean_batch_size() == pytest.approx(7 / 3)
+
+
+def test_lone_call_flushes_after_max_wait(batcher_for):
+    batcher = batcher_for(lambda items: list(items), max_batch_size=8, max_wait_ms=200)
+    t0 = time.monotonic()
+    assert batcher(1, timeout=5) == 1
+    assert time.monotonic() - t0 >= 0.19                 # waited for company that never came
+
+
+def test_full_batch_does_not_wait(batcher_for):
+    fn = GatedFn()
+    batcher = batcher_for(fn, max_batch_size=2, max_wait_ms=10_000)
+    fn.release.set()
+    t0 = time.monotonic()
+    futs = [batcher.submit(i) for i in (1, 2)]
+    assert [f.result(5) for f in futs] == [10, 20]
+    assert time.monotonic() - t0 < 5
+
+
+def test_error_reaches_every_caller_in_the_batch(batcher_for):
+    fn = GatedFn(fail_on=3)
+    batcher = batcher_for(fn, max_batch_size=8, max_wait_ms=0)
+    first = batcher.submit(0)
+    assert fn.started.wait(5)
+    futs = [batcher.submit(i) for i in (1, 2, 3)]
+    fn.release.set()
+
+    assert first.result(5) == 0
+    for fut in futs:
+        with pytest.raises(ValueError, match="bad item 3"):
+            fut.result(5)
+    assert batcher(4, timeout=5) == 40                   # the worker survives the failure
+
+
+def test_wrong_result_count_is_an_error(batcher_for):
+    batcher = batcher_for(lambda items: items[:-1], max_batch_size=1)
+    with pytest.raises(RuntimeError, match="0 results for 1 items"):
+        batcher(1, timeout=5)
+
+
+def test_closed_batcher_rejects(batcher_for):
+    batcher = batcher_for(lambda items: items)
+    batcher.close(timeout=5)
+    with pytest.raises(RuntimeError):
+        batcher.submit(1)
+
+
+def _wait(cond, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_bounded_executor_rejects_when_full():
+    pool = BoundedExecutor(workers=1, max_queue=1, name="test")
+    gate = threading.Event()
+    try:
+        running = pool.submit(gate.wait, 10)
+        queued = pool.submit(lambda: "queued")
+        assert pool.pending() == 2
+        with pytest.raises(PoolFull):
+            pool.submit(lambda: "rejected")
+        assert pool.rejected == 1
+
+        gate.set()
+        assert running.result(5) is True and queued.result(5) == "queued"
+        _wait(lambda: pool.pending() == 0)
+        failing = pool.submit(lambda: 1 / 0)             # failures free their slot too
+        with pytest.raises(ZeroDivisionError):
+            failing.result(5)
+        _wait(lambda: pool.pending() == 0)
+    finally:
+        gate.set()
+        pool.shutdown()
+
+
+def test_asgi_maps_pool_errors_to_status_codes():
+    for mod in ("flask", "starlette", "httpx", "torch"):
+        pytest.importorskip(mod)
+    import server_asgi
+
+    async def raising(exc):
+        raise exc
+
+    for exc, status in ((PoolFull("full"), 429), (asyncio.TimeoutError(), 503)):
+        res, err = asyncio.run(server_asgi.guarded(raising(exc)))
+        assert res is None and err.status_code == status and "retry-after" in err.headers
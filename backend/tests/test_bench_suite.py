@@ -0,0 +1,55 @@
+import multiprocessing as mp
+import os
+import signal
+import time
+
+import pytest
+
+import bench_suite
+
+
+def _reports(out):
+    out.put({"corpus": "random-10k", "index_type": "flat", "stages": {}})
+
+
+def _exits(out):
+    os._exit(3)
+
+
+def _killed(out):
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def _hangs(out):
+    time.sleep(60)
+
+
+def run(target, timeout=0):
+    ctx = mp.get_context("spawn")
+    out = ctx.Queue()
+    p = ctx.Process(target=target, args=(out,))
+    p.start()
+    case = bench_suite.wait_case(p, out, "10k", "random", "flat", timeout)
+    p.join()
+    return case
+
+
+@pytest.fixture(autouse=True)
+def fast_poll(monkeypatch):
+    monkeypatch.setattr(bench_suite, "CASE_POLL_S", 0.2)
+
+
+def test_result_is_returned():
+    assert run(_reports) == {"corpus": "random-10k", "index_type": "flat", "stages": {}}
+
+
+@pytest.mark.parametrize("target,how", [(_exits, "exit code 3"), (_killed, f"killed by signal {int(signal.SIGKILL)}")])
+def test_dead_worker_becomes_error_case(target, how):
+    case = run(target)
+    assert case["corpus"] == "random-10k" and how in case["error"]
+
+
+def test_timeout_terminates_worker():
+    t0 = time.monotonic()
+    case = run(_hangs, timeout=1)
+    assert "timed out" in case["error"] and time.monotonic() - t0 < 30
@@ -0,0 +1,107 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+import cache
+from cache import LRUCache, QueryCache, bytes_key, pixel_key
+
+
+def png_bytes(color=(200, 30, 30), fmt="PNG"):
+    buf = io.BytesIO()
+    Image.new("RGB", (16, 12), color).save(buf, fmt)
+    return buf.getvalue()
+
+
+def test_lru_evicts_least_recently_used():
+    c = LRUCache(max_entries=2)
+    c.put("a", 1)
+    c.put("b", 2)
+    assert c.get("a") == 1                   # "b" is now the oldest
+    c.put("c", 3)
+    assert c.get("b") is None and c.get("a") == 1 and c.get("c") == 3
+    assert c.stats()["evictions"] == 1
+
+
+def test_lru_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    c = LRUCache(max_entries=4, ttl=10)
+    c.put("a", 1)
+    now[0] += 5
+    assert c.get("a") == 1
+    now[0] += 6
+    assert c.get("a") is None and len(c) == 0
+
+
+def test_pixel_key_survives_reencoding():
+    png, bmp = png_bytes(), png_bytes(fmt="BMP")
+    assert bytes_key(png) != bytes_key(bmp)
+    assert pixel_key(Image.open(io.BytesIO(png)).convert("RGB")) == pixel_key(Image.open(io.BytesIO(bmp)).convert("RGB"))
+
+
+def test_query_cache_clears_when_watched_files_change(tmp_path):
+    index = tmp_path / "image_index.faiss"
+    index.write_bytes(b"v1")
+    c = QueryCache(max_entries=8, watch_paths=[str(index)], check_interval=0)
+    c.put("q", ["hit"])
+    assert c.get("q") == ["hit"]
+
+    index.write_bytes(b"v2 is longer")
+    os.utime(index, ns=(1, 1))
+    assert c.get("q") is None
+    assert c.stats()["invalidations"] == 1
+
+
+def test_query_cache_watch_drops_entries(tmp_path):
+    c = QueryCache(max_entries=8, watch_paths=[str(tmp_path / "a")], check_interval=0)
+    c.put("q", 1)
+    c.watch([str(tmp_path / "b")])
+    assert c.get("q") is None and c.watch_paths == [str(tmp_path / "b")]
+
+
+@pytest.fixture
+def server_module(monkeypatch):
+    pytest.importorskip("flask")
+    pytest.importorskip("torch")
+    import server
+
+    class Searcher:
+        version = "v1"
+        calls = 0
+
+        def search(self, img, **kwargs):
+            Searcher.calls += 1
+            return [{"version": self.version, **{k: v for k, v in kwargs.items() if v}}], None, None
+
+    monkeypatch.setattr(server, "image_searcher", Searcher())
+    monkeypatch.setattr(server, "search_batcher", None)
+    monkeypatch.setattr(server, "query_cache", QueryCache(max_entries=16))
+    return server
+
+
+def test_server_cache_key_includes_version_and_options(server_module):
+    server, data = server_module, png_bytes()
+    searcher = server.image_searcher
+
+    first = server.search_image_bytes(data)
+    assert server.search_image_bytes(data) is first and searcher.calls == 1
+
+    server.search_image_bytes(data, top_k=3)
+    server.search_image_bytes(data, filters={"sampler": "k_lms"})
+    server.search_image_bytes(data, diversify={"lambda": 0.5})
+    assert searcher.calls == 4
+    server.search_image_bytes(data, top_k=3)
+    assert searcher.calls == 4
+
+    searcher.version = "v2"                  # reloaded index: old results must not answer
+    assert server.search_image_bytes(data)[0][0]["version"] == "v2"
+    assert searcher.calls == 5
+
+
+def test_server_cache_hits_reencoded_upload(server_module):
+    server = server_module
+    server.search_image_bytes(png_bytes())
+    server.search_image_bytes(png_bytes(fmt="BMP"))
+    assert server.image_searcher.calls == 1
@@ -0,0 +1,30 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from clip_features import StackedVisionEncoder
+
+
+@pytest.fixture(scope="module")
+def encoder():
+    torch.manual_seed(0)
+    cfg = transformers.CLIPVisionConfig(hidden_size=64, intermediate_size=128, num_hidden_layers=5,
+                                        num_attention_heads=4, patch_size=32, projection_dim=32)
+    vision_model = transformers.CLIPVisionModel(cfg).vision_model.eval()
+    return StackedVisionEncoder(vision_model, torch.nn.Linear(64, 32, bias=False)).eval()
+
+
+def test_layer_masks_match_installed_transformers(encoder):
+    assert "attention_mask" in encoder.layer_kwargs
+    assert all(v is None for v in encoder.layer_kwargs.values())
+
+
+def test_matches_hidden_states_path(encoder):
+    pixels = torch.randn(3, 3, 224, 224)
+    with torch.no_grad():
+        fast = encoder(pixels)
+        ref = encoder.reference_forward(pixels)
+    for a, b in zip(fast, ref):
+        torch.testing.assert_close(a, b)
+    assert fast[0].shape == (3, 64) and fast[1].shape == (3, 32)
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from diversify import DEFAULTS, MAX_CANDIDATES, candidates, diversify, parse_options, select
+
+PLAIN = {**DEFAULTS, "lambda": 1.0, "max_similarity": 1.0, "collapse_prompts": False}
+
+
+def unit(*rows):
+    v = np.asarray(rows, dtype=np.float32)
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("raw", [None, False, "", "0", "off", b"false"])
+def test_parse_options_off(raw):
+    assert parse_options(raw) is None
+
+
+def test_parse_options_values():
+    assert parse_options(True) == DEFAULTS and parse_options("1") == DEFAULTS
+    opts = parse_options('{"lambda": 0.5, "overfetch": "8"}')
+    assert opts["lambda"] == 0.5 and opts["overfetch"] == 8 and opts["collapse_prompts"] is True
+
+
+@pytest.mark.parametrize("raw", [{"lambda": 1.5}, {"max_similarity": 0}, {"overfetch": 0}, {"beta": 1}, 3])
+def test_parse_options_rejects(raw):
+    with pytest.raises(ValueError):
+        parse_options(raw)
+
+
+def test_candidates():
+    assert candidates(5, None) == 5
+    assert candidates(5, DEFAULTS) == 20
+    assert candidates(500, DEFAULTS) == MAX_CANDIDATES
+    assert candidates(2000, DEFAULTS) == 2000
+
+
+def test_plain_settings_keep_score_order():
+    scores = np.array([0.9, 0.8, 0.7, 0.6], dtype=np.float32)
+    vecs = unit([1, 0], [0.8, 0.6], [0, 1], [0.6, 0.8])
+    np.testing.assert_array_equal(select(scores, vecs, None, 3, PLAIN), [0, 1, 2])
+
+
+def test_near_copies_dropped():
+    scores = np.array([0.9, 0.89, 0.5], dtype=np.float32)
+    vecs = unit([1, 0, 0], [1, 0.01, 0], [0, 1, 0])
+    opts = {**PLAIN, "max_similarity": 0.95}
+    np.testing.assert_array_equal(select(scores, vecs, None, 3, opts), [0, 2])
+
+
+def test_mmr_prefers_dissimilar_hit():
+    # 1 is a close (but not duplicate) variant of 0; 2 scores a bit lower but is different
+    scores = np.array([0.90, 0.88, 0.80], dtype=np.float32)
+    vecs = unit([1, 0], [0.9, 0.3], [0, 1])
+    opts = {**PLAIN, "lambda": 0.5}
+    np.testing.assert_array_equal(select(scores, vecs, None, 2, opts), [0, 2])
+    np.testing.assert_array_equal(select(scores, vecs, None, 2, {**opts, "lambda": 1.0}), [0, 1])
+
+
+def test_collapse_prompts_keeps_best_per_prompt():
+    scores = np.array([0.9, 0.8, 0.7, 0.6], dtype=np.float32)
+    groups = np.array([3, 3, 7, 7])
+    opts = {**PLAIN, "collapse_prompts": True}
+    np.testing.assert_array_equal(select(scores, None, groups, 4, opts), [0, 2])
+    np.testing.assert_array_equal(select(scores, unit([1, 0], [1, 0], [0, 1], [0, 1]), groups, 4, opts), [0, 2])
+
+
+def test_diversify_pads_like_faiss():
+    dots = np.array([[0.9, 0.89, 0.5, -np.inf], [0.7, -np.inf, -np.inf, -np.inf]], dtype=np.float32)
+    idxs = np.array([[10, 11, 12, -1], [20, -1, -1, -1]])
+    vecs = {10: [1, 0], 11: [1, 0.001], 12: [0, 1], 20: [1, 1]}
+    out_d, out_i = diversify(dots, idxs, 3, DEFAULTS, vectors_of=lambda ids: unit(*[vecs[i] for i in ids]))
+    np.testing.assert_array_equal(out_i, [[10, 12, -1], [20, -1, -1]])
+    assert out_d[0, 0] == np.float32(0.9) and np.isneginf(out_d[0, 2]) and np.isneginf(out_d[1, 1:]).all()
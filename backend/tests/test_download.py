@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("alive_progress")
+
+import download
+import fake_diffusiondb_server as fake
+
+
+class RecordingHandler(fake.PartHandler):
+    seen = []                        # request headers, in order
+
+    def do_GET(self, body=True):
+        RecordingHandler.seen.append({k: self.headers.get(k) for k in ("Range", "If-Range")})
+        super().do_GET(body)
+
+
+@pytest.fixture(scope="module")
+def server():
+    data = fake.make_part(1, images=8, image_bytes=16 * 1024)
+    RecordingHandler.parts = {1: (data, hashlib.sha256(data).hexdigest())}
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), RecordingHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_port}/", data
+    httpd.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def fresh(monkeypatch):
+    RecordingHandler.seen = []
+    monkeypatch.setattr(RecordingHandler, "drop_rate", 0.0)
+    monkeypatch.setattr(download.time, "sleep", lambda s: None)
+
+
+def fetch(server, tmp_path, **kwargs):
+    base_url, _ = server
+    dest = str(tmp_path / "part-000001.zip")
+    return download.fetch_part(download.make_session(1), download.part_url(1, base_url=base_url), dest, **kwargs)
+
+
+def write_partial(tmp_path, data, validator):
+    partial = tmp_path / "part-000001.zip.partial"
+    partial.write_bytes(data)
+    (tmp_path / "part-000001.zip.partial.json").write_text(json.dumps({"validator": validator, "total": None}))
+    return partial
+
+
+def test_fresh_download_verifies_advertised_sha(server, tmp_path):
+    _, data = server
+    dest = fetch(server, tmp_path)
+    assert open(dest, "rb").read() == data
+    assert RecordingHandler.seen == [{"Range": None, "If-Range": None}]
+    assert not os.path.exists(dest + ".partial") and not os.path.exists(dest + ".partial.json")
+
+
+def test_resumes_with_range_and_if_range(server, tmp_path):
+    _, data = server
+    etag = f'"{hashlib.sha256(data).hexdigest()}"'
+    half = len(data) // 2
+    write_partial(tmp_path, data[:half], etag)
+    dest = fetch(server, tmp_path)
+    assert open(dest, "rb").read() == data
+    assert RecordingHandler.seen == [{"Range": f"bytes={half}-", "If-Range": etag}]
+
+
+def test_changed_remote_restarts_from_zero(server, tmp_path):
+    _, data = server
+    write_partial(tmp_path, b"stale bytes of an older version", '"0000"')
+    dest = fetch(server, tmp_path)
+    assert open(dest, "rb").read() == data                   # 200 with the full body, not appended
+
+
+def test_partial_longer_than_remote_starts_over(server, tmp_path):
+    _, data = server
+    etag = f'"{hashlib.sha256(data).hexdigest()}"'
+    write_partial(tmp_path, data + b"junk", etag)
+    dest = fetch(server, tmp_path, retries=1)
+    assert open(dest, "rb").read() == data
+    assert RecordingHandler.seen[-1] == {"Range": None, "If-Range": None}
+
+
+def test_dropped_connection_is_resumed(server, tmp_path, monkeypatch):
+    _, data = server
+    rolls = iter([0.0])                                      # drop the first response only
+    monkeypatch.setattr(fake.random, "random", lambda: next(rolls, 1.0))
+    monkeypatch.setattr(RecordingHandler, "drop_rate", 0.5)
+    monkeypatch.setattr(download, "CHUNK_BYTES", 4096)       # a drop loses the chunk in flight
+    dest = fetch(server, tmp_path, retries=2)
+    assert open(dest, "rb").read() == data
+    assert len(RecordingHandler.seen) == 2
+    assert RecordingHandler.seen[1]["Range"].startswith("bytes=")
+    assert int(RecordingHandler.seen[1]["Range"][6:-1]) > 0
+
+
+def test_sha256_mismatch_is_rejected(server, tmp_path):
+    with pytest.raises(download.VerificationError, match="sha256"):
+        fetch(server, tmp_path, expected_sha="0" * 64, retries=0)
+    assert not (tmp_path / "part-000001.zip").exists()
+    assert not (tmp_path / "part-000001.zip.partial").exists()   # bad bytes are not resumed
+
+
+def test_missing_part_is_not_retried(server, tmp_path):
+    base_url, _ = server
+    with pytest.raises(download.requests.HTTPError):
+        download.fetch_part(download.make_session(1), download.part_url(2, base_url=base_url),
+                            str(tmp_path / "part-000002.zip"), retries=3)
+    assert len(RecordingHandler.seen) == 1
+
+
+def test_download_extracts_and_skips_finished_parts(server, tmp_path, monkeypatch):
+    base_url, _ = server
+    monkeypatch.setattr(download, "HARDCODED_OUTPUT_DIR", str(tmp_path))
+    download.download(index=1, range_index=2, unzip=True, workers=1, extract_workers=1, base_url=base_url)
+    assert (tmp_path / "part-000001.json").exists() and (tmp_path / "000001-0000.png").exists()
+    assert not (tmp_path / "part-000001.zip").exists()
+    assert (tmp_path / download.MANIFEST).read_text().split() == [download.part_url(1, base_url=base_url)]
+
+    RecordingHandler.seen = []
+    download.download(index=1, range_index=2, unzip=True, workers=1, extract_workers=1, base_url=base_url)
+    assert RecordingHandler.seen == []
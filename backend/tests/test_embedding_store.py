@@ -0,0 +1,92 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from embedding_store import MANIFEST, EmbeddingStore
+
+ARRAYS = {"stacked": 4, "final": 2}
+KEYS = [f"{i:04}.png" for i in range(10)]
+
+
+def rows_for(keys, salt=0.0):
+    base = np.array([[int(k[:4]) + salt] for k in keys], dtype=np.float32)
+    return {"stacked": np.repeat(base, 4, axis=1), "final": np.repeat(-base, 2, axis=1)}
+
+
+def fingerprints(keys, version="1"):
+    return [f"{version}:{k}" for k in keys]
+
+
+def append(store, keys, salt=0.0, version="1"):
+    store.append(keys, fingerprints(keys, version), rows_for(keys, salt))
+
+
+def interrupted_build(root):
+    """Two committed shards, then a crash while the third was being written."""
+    store = EmbeddingStore(root, ARRAYS)
+    append(store, KEYS[:4])
+    append(store, KEYS[4:7])
+    # shard 2: arrays and keys on disk, but the process died before the manifest rewrite
+    np.save(os.path.join(root, "shard-000002.stacked.npy"), rows_for(KEYS[7:], 100.0)["stacked"])
+    np.save(os.path.join(root, "shard-000002.final.npy"), rows_for(KEYS[7:], 100.0)["final"])
+    with open(os.path.join(root, "shard-000002.keys.json"), "w", encoding="utf-8") as fp:
+        json.dump([[k, f] for k, f in zip(KEYS[7:], fingerprints(KEYS[7:]))], fp)
+    with open(os.path.join(root, MANIFEST + ".tmp"), "w", encoding="utf-8") as fp:
+        fp.write('{"arrays": {"stacked": 4, "final"')         # half-written manifest
+    return root
+
+
+def test_only_committed_rows_are_visible(tmp_path):
+    store = EmbeddingStore(interrupted_build(str(tmp_path)), ARRAYS)
+    assert len(store) == 7 and sorted(store.keys()) == KEYS[:7]
+    assert KEYS[7] not in store
+    np.testing.assert_array_equal(store.gather("stacked", KEYS[:7])[:, 0], np.arange(7))
+
+
+def test_build_resumes_at_first_uncommitted_key(tmp_path):
+    root = interrupted_build(str(tmp_path))
+    store = EmbeddingStore(root, ARRAYS)
+    todo = [k for k in KEYS if not store.is_current(k, fingerprints([k])[0])]
+    assert todo == KEYS[7:]
+
+    append(store, todo, salt=0.5)                         # the resumed run rewrites shard 2
+    reopened = EmbeddingStore(root, ARRAYS)
+    assert len(reopened) == 10
+    np.testing.assert_array_equal(reopened.gather("stacked", KEYS)[:, 0],
+                                  [*range(7), 7.5, 8.5, 9.5])
+    np.testing.assert_array_equal(np.asarray(reopened.rows("final", KEYS[6:9]))[:, 1], [-6, -7.5, -8.5])
+
+
+def test_changed_fingerprint_is_redone_and_newest_wins(tmp_path):
+    store = EmbeddingStore(str(tmp_path), ARRAYS)
+    append(store, KEYS[:3])
+    assert store.is_current(KEYS[1], "1:" + KEYS[1])
+    assert not store.is_current(KEYS[1], "2:" + KEYS[1])   # image file changed
+
+    append(store, KEYS[1:2], salt=0.25, version="2")
+    reopened = EmbeddingStore(str(tmp_path), ARRAYS)
+    assert len(reopened) == 3 and reopened.is_current(KEYS[1], "2:" + KEYS[1])
+    np.testing.assert_array_equal(reopened.gather("stacked", KEYS[:3])[:, 0], [0, 1.25, 2])
+
+
+def test_rows_view_streams_in_chunks(tmp_path):
+    store = EmbeddingStore(str(tmp_path), ARRAYS)
+    append(store, KEYS[:6])
+    append(store, KEYS[6:])
+    view = store.rows("stacked", KEYS[::-1])
+    assert view.shape == (10, 4)
+    chunks = list(view[2:].chunks(3))
+    assert [start for start, _ in chunks] == [0, 3, 6]
+    np.testing.assert_array_equal(np.vstack([c for _, c in chunks])[:, 0], np.arange(7, -1, -1))
+    np.testing.assert_array_equal(view[np.array([0, 9])][:, 0], [9, 0])
+
+
+def test_array_layout_must_match(tmp_path):
+    append(EmbeddingStore(str(tmp_path), ARRAYS), KEYS[:2])
+    with pytest.raises(ValueError):
+        EmbeddingStore(str(tmp_path), {"stacked": 4})
+    with pytest.raises(ValueError):
+        EmbeddingStore(str(tmp_path), ARRAYS).append(KEYS[2:3], ["x"], {"stacked": np.zeros((1, 4)),
+                                                                         "final": np.zeros((2, 2))})
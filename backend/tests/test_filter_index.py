@@ -0,0 +1,110 @@
+import faiss
+import numpy as np
+import pytest
+
+from filter_index import FilterIndex, search_params, write_filter_index
+from metadata_store import MetadataStore, write_metadata_store
+
+N, D = 2000, 16
+SAMPLERS = ("k_lms", "k_euler_a", "ddim", "plms")
+
+
+@pytest.fixture(scope="module")
+def store(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp("meta"))
+    rng = np.random.default_rng(0)
+    write_metadata_store(root, [{
+        "image_name": f"{i}.png", "prompt": f"p{i % 50}", "seed": int(rng.integers(0, 40)) if i % 7 else None,
+        "cfg": float(rng.choice([5.0, 7.3, 7.5, 12.1])), "steps": int(rng.integers(10, 60)),
+        "sampler": SAMPLERS[int(rng.integers(len(SAMPLERS)))],
+    } for i in range(N)])
+    write_filter_index(root)
+    meta = MetadataStore(root)
+    return meta, FilterIndex(root, meta.columns["sampler"].values)
+
+
+def brute_force(meta, filters):
+    rows = meta.rows(np.arange(N))
+    keep = np.ones(N, dtype=bool)
+    for i, r in enumerate(rows):
+        samplers = filters.get("sampler")
+        if isinstance(samplers, str):
+            samplers = [samplers]
+        if samplers is not None and r["sampler"] not in samplers:
+            keep[i] = False
+        if "seed" in filters and r["seed"] != filters["seed"]:
+            keep[i] = False
+        for col in ("cfg", "steps"):
+            if f"{col}_min" in filters and r[col] < filters[f"{col}_min"]:
+                keep[i] = False
+            if f"{col}_max" in filters and r[col] > filters[f"{col}_max"]:
+                keep[i] = False
+    return keep
+
+
+@pytest.mark.parametrize("filters", [
+    {"sampler": "ddim"},
+    {"sampler": ["k_lms", "plms"], "steps_min": 30},
+    {"cfg_min": 7.3, "cfg_max": 7.3},
+    {"cfg_max": 7.5, "steps_min": 20, "steps_max": 25},
+    {"seed": 3},
+    {"sampler": "no-such-sampler"},
+])
+def test_mask_matches_brute_force(store, filters):
+    meta, fidx = store
+    np.testing.assert_array_equal(fidx.mask(filters), brute_force(meta, filters))
+
+
+def test_no_filters_is_no_mask(store):
+    assert store[1].mask(None) is None and store[1].mask({}) is None
+
+
+def test_unknown_filter_rejected(store):
+    with pytest.raises(ValueError, match="unknown filter"):
+        store[1].mask({"guidance": 7})
+
+
+def vectors():
+    return np.random.default_rng(1).standard_normal((N, D)).astype(np.float32)
+
+
+def check_filtered_search(index, mask, k=10):
+    params, _keep = search_params(index, mask)
+    _, idxs = index.search(vectors()[:5], k, params=params)
+    assert (idxs >= 0).all(), "a selective filter should still fill k"
+    assert mask[idxs].all()
+    return params
+
+
+def test_ivf_nprobe_widened_by_selectivity():
+    xb = vectors()
+    index = faiss.IndexIVFFlat(faiss.IndexFlatIP(D), D, 64, faiss.METRIC_INNER_PRODUCT)
+    index.train(xb)
+    index.add(xb)
+    index.nprobe = 4
+    mask = np.zeros(N, dtype=bool)
+    mask[::20] = True                                        # 5% selectivity
+    params = check_filtered_search(index, mask)
+    assert params.nprobe == 64                               # ceil(4 / 0.05) = 80, capped at nlist
+
+    mask[:] = False
+    mask[: N // 2] = True
+    assert search_params(index, mask)[0].nprobe == 8
+
+
+def test_hnsw_ef_search_widened():
+    xb = vectors()
+    index = faiss.IndexHNSWFlat(D, 16, faiss.METRIC_INNER_PRODUCT)
+    index.add(xb)
+    index.hnsw.efSearch = 32
+    mask = np.zeros(N, dtype=bool)
+    mask[::10] = True
+    assert check_filtered_search(index, mask).efSearch == 320
+
+
+def test_flat_bitmap_only():
+    index = faiss.IndexFlatIP(D)
+    index.add(vectors())
+    mask = np.zeros(N, dtype=bool)
+    mask[7::13] = True
+    check_filtered_search(index, mask)
@@ -0,0 +1,132 @@
+import os
+import time
+
+import faiss
+import numpy as np
+import pytest
+
+from index_bundle import (CURRENT_FILE, VERSIONS_DIR, CurrentWatcher, IndexBundle, IndexMismatch,
+                          current_version, list_versions, prune_versions, publish, resolve_index_dir)
+from metadata_store import write_metadata_store
+from search import ImageSearcher
+
+D = 8
+
+
+def make_version(root, version, rows, prompt_rows=None):
+    """A minimal flat-index build of ``rows`` images under versions/<version>/."""
+    path = os.path.join(root, VERSIONS_DIR, version)
+    os.makedirs(path)
+    rng = np.random.default_rng(rows)
+    for name, n in (("image_index.faiss", rows), ("prompt_index.faiss", rows if prompt_rows is None else prompt_rows)):
+        index = faiss.IndexFlatIP(D)
+        index.add(rng.standard_normal((n, D)).astype(np.float32))
+        faiss.write_index(index, os.path.join(path, name))
+    write_metadata_store(os.path.join(path, "metadata"), [
+        {"image_name": f"{version}-{i}.png", "prompt": f"p{i}", "seed": i, "cfg": 7.5, "steps": 30,
+         "sampler": "k_lms"} for i in range(rows)])
+    return path
+
+
+@pytest.fixture
+def root(tmp_path):
+    make_version(str(tmp_path), "20240101-000000", rows=5)
+    make_version(str(tmp_path), "20240102-000000", rows=7)
+    return str(tmp_path)
+
+
+@pytest.fixture
+def searcher(root):
+    publish(root, "20240101-000000")
+    s = ImageSearcher(index_root=root, lazy=True)
+    s._load_indexes()                                    # indexes only, no CLIP
+    assert s.index_error is None
+    return s
+
+
+def test_publish_and_resolve(root):
+    assert current_version(root) is None and resolve_index_dir(root) == root
+    publish(root, "20240102-000000")
+    assert current_version(root) == "20240102-000000"
+    assert resolve_index_dir(root) == os.path.join(root, VERSIONS_DIR, "20240102-000000")
+    assert not os.path.exists(os.path.join(root, CURRENT_FILE + ".tmp"))
+    with pytest.raises(FileNotFoundError):
+        publish(root, "20991231-000000")
+    assert current_version(root) == "20240102-000000"
+
+
+def test_reload_switches_and_rolls_back(root, searcher):
+    assert searcher.version == "20240101-000000" and len(searcher.metadata) == 5
+    first = searcher.bundle
+
+    publish(root, "20240102-000000")
+    info = searcher.reload()
+    assert info["previous"] == "20240101-000000" and info["version"] == "20240102-000000"
+    assert searcher.image_index.ntotal == 7 and searcher.metadata.rows([6])[0]["image_name"] == "20240102-000000-6.png"
+    assert first.image_index.ntotal == 5                 # in-flight queries keep their bundle
+
+    publish(root, "20240101-000000")                     # roll back
+    assert searcher.reload()["version"] == "20240101-000000" and len(searcher.metadata) == 5
+
+
+@pytest.mark.parametrize("breakage", ["missing_index", "truncated_index", "row_mismatch", "no_metadata"])
+def test_broken_version_is_rejected(root, searcher, breakage):
+    bad = make_version(root, "20240103-000000", rows=6, prompt_rows=4 if breakage == "row_mismatch" else None)
+    if breakage == "missing_index":
+        os.remove(os.path.join(bad, "prompt_index.faiss"))
+    elif breakage == "truncated_index":
+        path = os.path.join(bad, "image_index.faiss")
+        with open(path, "r+b") as fp:
+            fp.truncate(os.path.getsize(path) // 2)
+    elif breakage == "no_metadata":
+        os.remove(os.path.join(bad, "metadata", "meta.json"))    # build stopped before its commit point
+
+    publish(root, "20240103-000000")
+    with pytest.raises(IndexMismatch if breakage == "row_mismatch" else Exception):
+        searcher.reload()
+    assert searcher.version == "20240101-000000"          # old bundle still serving
+    assert searcher.image_index.ntotal == 5 and len(searcher.metadata) == 5
+
+
+def test_bundle_checks_sizes(root):
+    bad = make_version(root, "20240104-000000", rows=3, prompt_rows=2)
+    with pytest.raises(IndexMismatch, match="prompt_index"):
+        IndexBundle(bad)
+
+
+def test_prune_keeps_current(root):
+    make_version(root, "20240103-000000", rows=2)
+    publish(root, "20240101-000000")                     # oldest is live (e.g. after a rollback)
+    prune_versions(root, keep=1)
+    assert list_versions(root) == ["20240101-000000", "20240103-000000"]
+    prune_versions(root, keep=0)                         # keep=0 deletes nothing
+    assert list_versions(root) == ["20240101-000000", "20240103-000000"]
+    publish(root, "20240103-000000")
+    prune_versions(root, keep=1)
+    assert list_versions(root) == ["20240103-000000"]
+
+
+def test_watcher_calls_back_and_survives_failures(root):
+    publish(root, "20240101-000000")
+    seen = []
+
+    def on_change(version):
+        seen.append(version)
+        if version == "20240102-000000":
+            raise RuntimeError("broken build")
+
+    watcher = CurrentWatcher(root, on_change, interval=0.01)
+    try:
+        publish(root, "20240102-000000")
+        _wait(lambda: seen == ["20240102-000000"])
+        publish(root, "20240101-000000")
+        _wait(lambda: seen == ["20240102-000000", "20240101-000000"])
+    finally:
+        watcher.close()
+
+
+def _wait(cond, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline, "watcher did not fire"
+        time.sleep(0.01)
@@ -0,0 +1,60 @@
+import numpy as np
+
+from metadata_store import MetadataStore, PromptGroups, normalise_prompt, write_metadata_store, write_prompt_groups
+
+
+def make_rows(n, cfgs=(7.3, 7.5, 12.1)):
+    return [{"image_name": f"{i}.png", "prompt": f"prompt {i % 3}", "seed": i if i % 4 else None,
+             "cfg": cfgs[i % len(cfgs)], "steps": 20 + i % 3, "sampler": "k_lms"} for i in range(n)]
+
+
+def test_rows_round_trip(tmp_path):
+    rows = make_rows(8)
+    write_metadata_store(str(tmp_path), rows)
+    store = MetadataStore(str(tmp_path))
+    assert len(store) == 8
+    out = store.rows([5, 0, 7])
+    assert [r["image_name"] for r in out] == ["5.png", "0.png", "7.png"]
+    assert out[1]["seed"] is None and out[0]["seed"] == 5
+    assert store[2]["prompt"] == "prompt 2"
+
+
+def test_cfg_reads_back_exactly(tmp_path):
+    write_metadata_store(str(tmp_path), make_rows(3))
+    assert [r["cfg"] for r in MetadataStore(str(tmp_path)).rows([0, 1, 2])] == [7.3, 7.5, 12.1]
+
+
+def test_float32_cfg_from_older_stores(tmp_path):
+    write_metadata_store(str(tmp_path), make_rows(3))
+    np.save(tmp_path / "cfg.npy", np.array([7.3, 7.5, 12.1], dtype=np.float32))
+    assert [r["cfg"] for r in MetadataStore(str(tmp_path)).rows([0, 1, 2])] == [7.3, 7.5, 12.1]
+
+
+def test_normalise_prompt():
+    assert normalise_prompt("  A  Castle\tat DUSK\n") == "a castle at dusk"
+    assert normalise_prompt(None) == ""
+
+
+def test_prompt_groups_csr(tmp_path):
+    rng = np.random.default_rng(0)
+    prompt_of_image = rng.integers(0, 40, size=500)
+    prompt_of_image[prompt_of_image == 17] = 18              # prompt 17 has no images
+    assert not PromptGroups.exists(str(tmp_path))
+    write_prompt_groups(str(tmp_path), prompt_of_image)
+    assert PromptGroups.exists(str(tmp_path))
+
+    groups = PromptGroups(str(tmp_path))
+    assert len(groups) == int(prompt_of_image.max()) + 1
+    np.testing.assert_array_equal(groups.prompt_of_image, prompt_of_image)
+    for p in range(len(groups)):
+        np.testing.assert_array_equal(groups.images(p), np.flatnonzero(prompt_of_image == p))
+    assert len(groups.images(17)) == 0
+    assert groups.offsets[-1] == len(prompt_of_image)
+
+
+def test_prompt_mask(tmp_path):
+    write_prompt_groups(str(tmp_path), np.array([0, 0, 1, 2, 2, 2, 3]))
+    groups = PromptGroups(str(tmp_path))
+    image_mask = np.array([False, True, False, False, False, True, False])
+    np.testing.assert_array_equal(groups.prompt_mask(image_mask), [True, False, True, False])
+    assert not groups.prompt_mask(np.zeros(7, dtype=bool)).any()
@@ -0,0 +1,33 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import preprocess
+
+
+def reference_pixels(data: bytes) -> np.ndarray:
+    """CLIPImageProcessor's path: full decode, bicubic shortest-edge resize, center crop, normalise."""
+    img = Image.open(io.BytesIO(data)).convert("RGB")
+    size = preprocess.IMAGE_SIZE
+    new_w, new_h = preprocess._resize_size(*img.size)
+    img = img.resize((new_w, new_h), Image.BICUBIC)
+    left, top = (new_w - size) // 2, (new_h - size) // 2
+    arr = np.asarray(img.crop((left, top, left + size, top + size)), dtype=np.float32) / 255.0
+    return ((arr - preprocess.CLIP_MEAN) / preprocess.CLIP_STD).transpose(2, 0, 1)
+
+
+@pytest.mark.parametrize("w,h", preprocess.PARITY_SIZES)
+def test_parity_with_full_decode(w, h):
+    data = preprocess.synthetic_jpeg(w, h)
+    fast = preprocess.load_pixels([data])[0]
+    assert fast.shape == (3, preprocess.IMAGE_SIZE, preprocess.IMAGE_SIZE)
+    assert np.abs(fast - reference_pixels(data)).mean() <= preprocess.MEAN_ABS_TOLERANCE
+
+
+def test_draft_keeps_margin():
+    size = preprocess.IMAGE_SIZE
+    for w, h in preprocess.PARITY_SIZES:
+        img = preprocess.open_image(preprocess.synthetic_jpeg(w, h))
+        assert min(img.size) >= min(min(w, h), size * preprocess.DRAFT_MARGIN)
@@ -0,0 +1,36 @@
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("torch")
+
+import server
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_TOKEN", "")
+    monkeypatch.setattr(server, "ADMIN_TRUST_LOCALHOST", False)
+    monkeypatch.setattr(server, "reload_index", lambda version=None: {"version": version or "v2"})
+    return server.app.test_client()
+
+
+def test_admin_routes_closed_without_token(client):
+    # the Flask test client connects from 127.0.0.1, as a same-host reverse proxy would
+    assert client.post("/api/admin/reload").status_code == 403
+    assert client.get("/api/admin/profile").status_code == 403
+
+
+def test_token_required_when_configured(client, monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_TOKEN", "s3cret")
+    assert client.post("/api/admin/reload", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    resp = client.post("/api/admin/reload", headers={"X-Admin-Token": "s3cret"}, json={"version": "v1"})
+    assert resp.status_code == 200 and resp.get_json()["version"] == "v1"
+
+
+def test_loopback_only_with_opt_in(monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_TOKEN", "")
+    monkeypatch.setattr(server, "ADMIN_TRUST_LOCALHOST", False)
+    assert not server.admin_allowed("", "127.0.0.1")
+    monkeypatch.setattr(server, "ADMIN_TRUST_LOCALHOST", True)
+    assert server.admin_allowed("", "127.0.0.1") and server.admin_allowed("", "::1")
+    assert not server.admin_allowed("", "10.0.0.7")
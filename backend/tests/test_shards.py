@@ -0,0 +1,87 @@
+import faiss
+import numpy as np
+import pytest
+
+from filter_index import search_params
+from shards import ShardPool, ShardedIndex, merge_topk, save_sharded, shard_bounds, write_manifest
+
+ROWS, D, K = 1001, 16, 10
+
+
+def hits(*rows):
+    d = np.array([[s for s, _ in r] for r in rows], dtype=np.float32)
+    i = np.array([[i for _, i in r] for r in rows], dtype=np.int64)
+    return d, i
+
+
+def test_merge_topk_interleaves_shards():
+    a = hits([(0.9, 3), (0.5, 1), (0.1, 0)], [(0.8, 2), (0.7, 0), (0.6, 1)])
+    b = hits([(0.7, 103), (0.6, 104), (0.2, 100)], [(0.95, 101), (-np.inf, -1), (-np.inf, -1)])
+    d, i = merge_topk([a, b], n=2, k=4)
+    np.testing.assert_array_equal(i, [[3, 103, 104, 1], [101, 2, 0, 1]])
+    np.testing.assert_allclose(d, [[0.9, 0.7, 0.6, 0.5], [0.95, 0.8, 0.7, 0.6]])
+
+
+def test_merge_topk_pads_when_shards_are_short():
+    # one shard smaller than k (searched with k = its row count), one fully padded
+    a = hits([(0.4, 7), (0.3, 8)])
+    b = hits([(-np.inf, -1), (-np.inf, -1), (-np.inf, -1)])
+    d, i = merge_topk([a, b], n=1, k=4)
+    np.testing.assert_array_equal(i, [[7, 8, -1, -1]])
+    assert np.isneginf(d[0, 2:]).all()
+    d, i = merge_topk([], n=2, k=3)
+    assert (i == -1).all() and np.isneginf(d).all()
+
+
+def test_shard_bounds_cover_all_rows():
+    bounds = shard_bounds(ROWS, 3)
+    assert bounds[0][0] == 0 and bounds[-1][1] == ROWS
+    assert all(a[1] == b[0] for a, b in zip(bounds, bounds[1:]))
+
+
+@pytest.fixture(scope="module")
+def sharded(tmp_path_factory):
+    rng = np.random.default_rng(0)
+    xb = rng.standard_normal((ROWS, D)).astype(np.float32)
+    xb /= np.linalg.norm(xb, axis=1, keepdims=True)
+
+    def build_flat(_, vectors):
+        index = faiss.IndexFlatIP(vectors.shape[1])
+        index.add(vectors)
+        return index, {"type": "flat"}
+
+    root = str(tmp_path_factory.mktemp("sharded"))
+    _, entries = save_sharded(root, "image_index", xb, 3, build_flat)
+    write_manifest(root, {"image_index": entries}, {"image_index": D})
+    pool = ShardPool(root, workers=2, mmap=True)          # worker 0 holds shards 0 and 2
+    single, _ = build_flat(None, xb)
+    yield ShardedIndex(pool, "image_index"), single, xb[rng.choice(ROWS, 20, replace=False)]
+    pool.close()
+
+
+def test_pool_matches_single_index(sharded):
+    index, single, xq = sharded
+    assert index.ntotal == ROWS and index.d == D
+    d_ref, i_ref = single.search(xq, K)
+    d, i = index.search(xq, K)
+    np.testing.assert_array_equal(i, i_ref)
+    np.testing.assert_allclose(d, d_ref, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("pick", ["sparse", "last_shard_only", "few"])
+def test_mask_is_sliced_per_shard(sharded, pick):
+    index, single, xq = sharded
+    mask = np.zeros(ROWS, dtype=bool)
+    if pick == "sparse":
+        mask[np.random.default_rng(1).random(ROWS) < 0.1] = True
+    elif pick == "last_shard_only":
+        mask[shard_bounds(ROWS, 3)[2][0] + 5 :] = True
+    else:
+        mask[[0, 400, 1000]] = True                      # one row in each shard, fewer than k
+    params, _keep = search_params(single, mask)
+    d_ref, i_ref = single.search(xq, K, params=params)
+    d, i = index.search(xq, K, mask=mask)
+    np.testing.assert_array_equal(i, i_ref)
+    assert mask[i[i >= 0]].all()
+    if pick == "few":
+        assert (i[:, 3:] == -1).all()